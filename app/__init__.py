@@ -6,9 +6,9 @@ from flask_jwt_extended import JWTManager
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 from flask_migrate import Migrate
 from config import Config
+from app.utils.rate_limit import identity_or_address, configure_rate_limits
 
 
 
@@ -17,15 +17,18 @@ bcrypt = Bcrypt()
 jwt = JWTManager()
 migrate = Migrate()
 
-# Rate limiter para prevenir ataques de fuerza bruta
-limiter = Limiter(
-    key_func=get_remote_address,
-    default_limits=["200 per day", "50 per hour"]
-)
+# Rate limiter para prevenir ataques de fuerza bruta. Los límites por defecto
+# y el almacenamiento compartido se leen de la configuración (ver
+# configure_rate_limits); el webhook de WhatsApp tiene su propia política.
+limiter = Limiter(key_func=identity_or_address)
 
 def create_app( config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+
+    # Logging estructurado (cola no bloqueante, redacción de tokens y teléfonos)
+    from app.utils.log import configure_logging
+    log_handler = configure_logging(app)
     
     # Inicializar extensiones
     db.init_app(app)
@@ -33,6 +36,7 @@ def create_app( config_class=Config):
     jwt.init_app(app)
     migrate.init_app(app,db)
     CORS(app, origins=app.config['CORS_ORIGINS'])
+    configure_rate_limits(app)
     limiter.init_app(app)
     
      # Importar blueprints **después** de inicializar extensiones
@@ -51,9 +55,62 @@ def create_app( config_class=Config):
     app.register_blueprint(whatsapp_bp)
     app.register_blueprint(driver_bp)
 
+    # Métricas del bot (incluye el conteo de consultas SQL por mensaje)
+    from app.services.whatsapp.metrics import metrics
+    metrics.init_app(app)
+    metrics.register_gauge("log_records_dropped", lambda: log_handler.dropped)
+
+    # Despachador por shards para procesar los mensajes de WhatsApp en segundo plano
+    from app.services.whatsapp.worker import message_dispatcher
+    from app.services.whatsapp.whatsapp_controller import process_messages
+    from app.services.whatsapp.dedup import message_deduplicator
+    message_dispatcher.init_app(app, process_messages)
+    message_deduplicator.init_app(app)
+
+    # Control de admisión del webhook (difiere o descarta mensajes con el backend saturado)
+    from app.services.whatsapp.admission import admission_controller
+    admission_controller.init_app(app)
+
+    # Caché del estado de conversación con escritura diferida (desactivada por defecto)
+    from app.services.whatsapp.state_cache import conversation_cache
+    conversation_cache.init_app(app)
+
+    # Expiración de conversaciones inactivas (archiva y reinicia por lotes)
+    from app.services.whatsapp.sessions import session_sweeper
+    session_sweeper.init_app(app)
+
+    # Asignación de conductores por cercanía (índice espacial de posiciones)
+    from app.services.driver_matching import driver_matcher
+    driver_matcher.init_app(app)
+
+    # Ingesta de posiciones de conductores (memoria + upserts por lotes a driver_locations)
+    from app.services.driver_locations import driver_locations
+    driver_locations.init_app(app)
+
+    # Registro de eventos de conversación para replay (desactivado sin WHATSAPP_EVENT_LOG_DIR)
+    from app.services.whatsapp.event_log import conversation_log
+    conversation_log.init_app(app)
+
+    # Cliente de la Graph API (credenciales y URL de app.config)
+    from app.services.whatsapp.client import configure_client
+    configure_client(app)
+
+    # Outbox de mensajes salientes (se envían después del commit)
+    from app.services.whatsapp.outbox import outbox_sender
+    from app.services.whatsapp.rate_scheduler import outbound_scheduler
+    outbox_sender.init_app(app)
+    outbound_scheduler.init_app(app)
+
     # # Crear tablas
     with app.app_context():
         db.create_all()
+
+        # Posiciones vigentes de los conductores para el índice de cercanía
+        try:
+            driver_locations.load()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("No se pudieron cargar las posiciones de los conductores")
     
     # Manejadores de errores JWT
     @jwt.expired_token_loader
@@ -1,10 +1,12 @@
 from flask import request, jsonify
 from app import db
+from app.utils.transaction import ServiceTransaction
 from app.models.custom import CustomTrip
 from app.models.enums import CustomTripType, TripStatus, AddressType, TripType
 from app.models.one_way import OneWayTrip
 from app.models.round import RoundTrip
 from app.models.tour import TourTrip
+from app.services.trip_claims import claim_trip
 
 from datetime import datetime
 from sqlalchemy.exc import SQLAlchemyError
@@ -124,7 +126,7 @@ class CustomTripController:
             return jsonify({"error": f"Error inesperado: {str(e)}"}), 500
 
     @staticmethod
-    def create_custom_trip_service(data: dict) -> dict:
+    def create_custom_trip_service(data: dict, commit: bool = True) -> dict:
         """
         Servicio para crear un nuevo viaje personalizado.
         
@@ -153,9 +155,13 @@ class CustomTripController:
                 // Tour: "includes_driver_expenses", "rental_days", "daily_rate"
             }
             
+            commit: False para dejar el commit al llamador (el viaje se crea en un savepoint)
+
         Returns:
             dict: Resultado con 'success', 'data' o 'error'
         """
+        transaction = ServiceTransaction(commit)
+
         try:
             # === Validaciones básicas ===
             if not data:
@@ -208,7 +214,7 @@ class CustomTripController:
             # === Validar el viaje ===
             trip.validate()
 
-            db.session.commit()
+            transaction.commit()
 
             return {
                 "success": True,
@@ -217,21 +223,21 @@ class CustomTripController:
             }
 
         except ValueError as ve:
-            db.session.rollback()
+            transaction.rollback()
             return {
                 "success": False,
                 "error": str(ve),
                 "error_type": "validation"
             }
         except SQLAlchemyError as e:
-            db.session.rollback()
+            transaction.rollback()
             return {
                 "success": False,
                 "error": f"Error de base de datos: {str(e)}",
                 "error_type": "database"
             }
         except Exception as e:
-            db.session.rollback()
+            transaction.rollback()
             return {
                 "success": False,
                 "error": f"Error inesperado: {str(e)}",
@@ -587,29 +593,29 @@ class CustomTripController:
         data = request.get_json()
         action = data.get("action")
 
-        customTrip = CustomTrip.query.get(trip_id)
-        if not customTrip:
-            return jsonify({"error": "Paquete no encontrado"}), 404
+        if action != "accept":
+            return jsonify({"error": "Acción inválida. Usa 'accept'."}), 400
 
-        if customTrip.status not in [ TripStatus.AVAILABLE]:
-            print("Este paquete ya fue gestionado")
-            return jsonify({"error": "Este paquete ya fue gestionado"}), 400
+        driver_id = data.get("driver_id")
+        vehicle_id = data.get("vehicle_id")
+        if not driver_id:
+            return jsonify({"error": "driver_id requerido para aceptar"}), 400
 
-        if action == "accept":
-            driver_id = data.get("driver_id")
-            vehicle_id = data.get("vehicle_id")
-            if not driver_id:
-                print("driver_id requerido para aceptar")
-                return jsonify({"error": "driver_id requerido para aceptar"}), 400
+        # Un solo UPDATE condicional: si varios conductores aceptan a la vez, gana uno
+        result = claim_trip(CustomTrip, trip_id, driver_id, vehicle_id)
 
-            customTrip.driver_id = driver_id
-            customTrip.vehicle_id= vehicle_id
-            customTrip.status = TripStatus.PENDING
-            db.session.commit()
-            return jsonify({"message": "Paquete aceptado", "trips": customTrip.to_dict()})
+        if not result.found:
+            return jsonify({"error": "Paquete no encontrado"}), 404
 
-        else:
-            print("Acción inválida. Usa 'accept'")
-            return jsonify({"error": "Acción inválida. Usa 'accept'."}), 400
+        if not result.claimed:
+            return jsonify({
+                "error": "Este paquete ya fue gestionado",
+                "claimed": False,
+                "status": result.status.value if result.status else None,
+                "driver_id": result.driver_id
+            }), 409
+
+        customTrip = CustomTrip.query.get(trip_id)
+        return jsonify({"message": "Paquete aceptado", "claimed": True, "trips": customTrip.to_dict()})
 
 
@@ -1,5 +1,13 @@
+import time
+
 from flask import jsonify, request
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
 from app.models.driver import Driver
+from app.models.enums import DriverStatus
+from app.services.driver_feed import FEED_MAX_PAGE_SIZE, FEED_PAGE_SIZE, available_work, decode_cursor
+from app.services.driver_locations import driver_locations, known_driver_ids, parse_ping
 from app import db
 
 def get_all_drivers():
@@ -18,6 +26,105 @@ def get_driver_by_id_or_name(identifier):
         return jsonify(driver.to_dict()), 200
     return jsonify({"message": "Driver not found"}), 404
 
+def report_driver_locations():
+    """
+    Recibe una posición o un lote de posiciones del conductor autenticado:
+    {"latitude", "longitude", "timestamp"?} o {"locations": [...]}.
+    Los administradores pueden reportar por otros conductores con "driver_id".
+    """
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and "locations" in body:
+        items = body["locations"]
+    elif isinstance(body, list):
+        items = body
+    else:
+        items = [body]
+
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'message': 'No se enviaron posiciones'}), 400
+    if len(items) > driver_locations.max_batch:
+        return jsonify({
+            'success': False,
+            'message': f'Máximo {driver_locations.max_batch} posiciones por petición'
+        }), 413
+
+    is_driver = get_jwt().get('role') == 'driver'
+    identity = get_jwt_identity()
+    now = time.time()
+
+    pings = []
+    errors = []
+    for position, item in enumerate(items):
+        try:
+            lat, lng, ts = parse_ping(item, now)
+            driver_id = int(identity if is_driver else item["driver_id"])
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append({'index': position, 'message': str(e) or 'Posición inválida'})
+            continue
+        pings.append((position, driver_id, lat, lng, ts))
+
+    if not is_driver:
+        # Un driver_id inexistente haría fallar la escritura por lotes a driver_locations
+        known = known_driver_ids(ping[1] for ping in pings)
+        for position, driver_id, _, _, _ in pings:
+            if driver_id not in known:
+                errors.append({'index': position, 'message': f'Conductor {driver_id} no encontrado'})
+        pings = [ping for ping in pings if ping[1] in known]
+
+    pings = [ping[1:] for ping in pings]
+    accepted = driver_locations.record(pings) if pings else 0
+
+    return jsonify({
+        'success': not errors,
+        'accepted': accepted,
+        'ignored': len(pings) - accepted,
+        'errors': errors
+    }), 202 if pings else 400
+
+
+def get_driver_feed(driver_id):
+    """
+    Trabajo disponible para el conductor (paquetes y viajes personalizados),
+    paginado por cursor: ?limit=20&cursor=<next_cursor>&include=addresses.
+    Responde 304 si el cliente envía If-None-Match con el ETag de la misma página.
+    """
+    claims = get_jwt()
+    if claims.get('role') == 'driver' and str(get_jwt_identity()) != str(driver_id):
+        return jsonify({
+            'success': False,
+            'message': 'No tienes permisos para acceder a este recurso'
+        }), 403
+
+    driver = DriverService.get_driver_with_vehicle(driver_id)
+    if not driver:
+        return jsonify({"message": "Driver not found"}), 404
+
+    try:
+        limit = int(request.args.get('limit', FEED_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if limit <= 0:
+        return jsonify({'success': False, 'message': 'limit debe ser un entero positivo'}), 400
+    limit = min(limit, FEED_MAX_PAGE_SIZE)
+
+    try:
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    items, next_cursor = available_work(
+        limit=limit,
+        after=after,
+        max_passengers=driver.vehicle.seats if driver.vehicle else None,
+        include_addresses=request.args.get('include') == 'addresses'
+    )
+
+    response = jsonify({'items': items, 'next_cursor': next_cursor})
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
 
 class DriverService:
     
@@ -36,4 +143,29 @@ class DriverService:
         """Obtiene un conductor por ID o nombre."""
         return Driver.query.filter(
             (Driver.id == identifier) | (Driver.full_name.ilike(f"%{identifier}%"))
-        ).first()
\ No newline at end of file
+        ).first()
+
+    @staticmethod
+    def get_available_drivers(limit, after=None):
+        """
+        Página de conductores disponibles (con su vehículo), ordenados por nombre.
+        after: (full_name, id) del último conductor de la página anterior.
+        """
+        query = (
+            Driver.query
+            .options(joinedload(Driver.vehicle))
+            .filter(Driver.status == DriverStatus.AVAILABLE)
+        )
+        if after is not None:
+            query = query.filter(tuple_(Driver.full_name, Driver.id) > tuple(after))
+        return query.order_by(Driver.full_name, Driver.id).limit(limit).all()
+
+    @staticmethod
+    def get_driver_with_vehicle(driver_id):
+        """Obtiene un conductor por ID con su vehículo."""
+        return (
+            Driver.query
+            .options(joinedload(Driver.vehicle))
+            .filter(Driver.id == driver_id)
+            .first()
+        )
@@ -4,18 +4,21 @@ from datetime import datetime
 from flask import jsonify, request
 from sqlalchemy.exc import SQLAlchemyError
 from app import db
+from app.utils.transaction import ServiceTransaction
 from app.models.driver import Driver
 from app.models.enums import AddressType, DriverStatus, TripStatus, TripType
 from app.models.package import PackageTrip
 from app.models.trip_addresses import Address
+from app.services.trip_claims import claim_trip
 
 
-def create_package_trip_service(data: dict) -> dict:
+def create_package_trip_service(data: dict, commit: bool = True) -> dict:
     """
     Servicio para crear un viaje de paquete.
     
     Args:
         data: Diccionario con los datos del paquete
+        commit: False para dejar el commit al llamador (el paquete se crea en un savepoint)
         
     Returns:
         dict: Resultado de la operación con 'success', 'data' o 'error'
@@ -24,6 +27,8 @@ def create_package_trip_service(data: dict) -> dict:
         ValueError: Si faltan campos obligatorios o datos inválidos
         Exception: Otros errores durante la creación
     """
+    transaction = ServiceTransaction(commit)
+
     try:
         # === Validaciones básicas ===
         if not data.get("package_description"):
@@ -83,7 +88,7 @@ def create_package_trip_service(data: dict) -> dict:
         )
 
         db.session.add(package_trip)
-        db.session.commit()
+        transaction.commit()
 
         return {
             "success": True,
@@ -92,14 +97,14 @@ def create_package_trip_service(data: dict) -> dict:
         }
 
     except ValueError as ve:
-        db.session.rollback()
+        transaction.rollback()
         return {
             "success": False,
             "error": str(ve),
             "error_type": "validation"
         }
     except Exception as e:
-        db.session.rollback()
+        transaction.rollback()
         return {
             "success": False,
             "error": str(e),
@@ -232,30 +237,30 @@ def handle_package_request(package_id):
     data = request.get_json()
     action = data.get("action")
 
-    package = PackageTrip.query.get(package_id)
-    if not package:
-        return jsonify({"error": "Paquete no encontrado"}), 404
+    if action != "accept":
+        return jsonify({"error": "Acción inválida. Usa 'accept'."}), 400
 
-    if package.status not in [ TripStatus.AVAILABLE]:
-        print("Este paquete ya fue gestionado")
-        return jsonify({"error": "Este paquete ya fue gestionado"}), 400
+    driver_id = data.get("driver_id")
+    vehicle_id = data.get("vehicle_id")
+    if not driver_id:
+        return jsonify({"error": "driver_id requerido para aceptar"}), 400
 
-    if action == "accept":
-        driver_id = data.get("driver_id")
-        vehicle_id = data.get("vehicle_id")
-        if not driver_id:
-            print("driver_id requerido para aceptar")
-            return jsonify({"error": "driver_id requerido para aceptar"}), 400
-
-        package.driver_id = driver_id
-        package.vehicle_id= vehicle_id
-        package.status = TripStatus.PENDING
-        db.session.commit()
-        return jsonify({"message": "Paquete aceptado", "package_trip": package.to_dict()})
+    # Un solo UPDATE condicional: si varios conductores aceptan a la vez, gana uno
+    result = claim_trip(PackageTrip, package_id, driver_id, vehicle_id)
 
-    else:
-        print("Acción inválida. Usa 'accept'")
-        return jsonify({"error": "Acción inválida. Usa 'accept'."}), 400
+    if not result.found:
+        return jsonify({"error": "Paquete no encontrado"}), 404
+
+    if not result.claimed:
+        return jsonify({
+            "error": "Este paquete ya fue gestionado",
+            "claimed": False,
+            "status": result.status.value if result.status else None,
+            "driver_id": result.driver_id
+        }), 409
+
+    package = PackageTrip.query.get(package_id)
+    return jsonify({"message": "Paquete aceptado", "claimed": True, "package_trip": package.to_dict()})
 
 # 6️⃣ Cancelar un paquete asignado
 def cancel_package(package_id):
@@ -1,17 +1,21 @@
 from functools import wraps
 from flask import jsonify
 from flask_jwt_extended import verify_jwt_in_request, get_jwt
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
 
 def token_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
         try:
             verify_jwt_in_request()
-            claims = get_jwt()
-            print("🔑 Token detectado:", claims)
+            log.debug("Token verificado", sample=0.01, role=get_jwt().get("role"))
             return fn(*args, **kwargs)
         except Exception as e:
-            print("❌ Error en token_required:", e)
+            log.info("Token rechazado", error=type(e).__name__)
             return jsonify({
                 'success': False,
                 'message': 'Token inválido o expirado'
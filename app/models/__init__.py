@@ -1,5 +1,6 @@
 from app.models.admin import Admin
 from app.models.driver import Driver
+from app.models.driver_location import DriverLocation
 from app.models.superAdmin import SuperUser
 from app.models.traveler import Traveler
 from app.models.user import User, admin_driver
@@ -16,7 +17,7 @@ from app.models.tour import TourTrip
 
 
 __all__ = [
-    'User', 'SuperUser', 'Admin', 'Driver', 'Traveler', 'admin_driver',
+    'User', 'SuperUser', 'Admin', 'Driver', 'DriverLocation', 'Traveler', 'admin_driver',
     'AddressType', 'FreightMode', 'TripStatus', 'TripType', 'CustomTripType',
     'Trip', 'TripAddress', 'Address', 'PackageTrip', 'CustomTrip','OneWayTrip','RoundTrip','TourTrip', 'NormalTrip', 'Vehicle'
 ]
@@ -0,0 +1,27 @@
+from app import db
+from datetime import datetime
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+class ConversationArchive(db.Model):
+    """
+    Historial de conversaciones abandonadas.
+
+    El SessionSweeper copia aquí el flow/step/temp_data de las sesiones
+    inactivas antes de reiniciarlas, para que whatsapp_users conserve solo
+    el estado vivo de cada conversación.
+    """
+    __tablename__ = "whatsapp_conversation_archive"
+
+    id = db.Column(db.Integer, primary_key=True)
+    whatsapp_user_id = db.Column(db.Integer, nullable=False, index=True)
+    phone = db.Column(db.String(20), nullable=False)
+    flow = db.Column(db.String(50), nullable=True)
+    step = db.Column(db.String(50), nullable=True)
+    temp_data = db.Column(db.JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), "postgresql"), nullable=True)
+
+    last_activity_at = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<ConversationArchive(id={self.id}, phone='{self.phone}', flow='{self.flow}', step='{self.step}')>"
@@ -0,0 +1,30 @@
+from app import db
+from datetime import datetime
+
+
+class DriverLocation(db.Model):
+    """
+    Última posición conocida de cada conductor (una fila por conductor).
+
+    La escribe DriverLocationService con upserts por lotes; las posiciones
+    vigentes se mantienen en memoria (LocationStore) y esta tabla sirve para
+    recuperarlas al reiniciar y para consultas de administración.
+    """
+    __tablename__ = "driver_locations"
+
+    driver_id = db.Column(db.Integer, db.ForeignKey('drivers.id', ondelete='CASCADE'), primary_key=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    reported_at = db.Column(db.DateTime, nullable=False, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_dict(self):
+        return {
+            'driver_id': self.driver_id,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'reported_at': self.reported_at.isoformat() if self.reported_at else None
+        }
+
+    def __repr__(self):
+        return f"<DriverLocation(driver_id={self.driver_id}, lat={self.latitude}, lng={self.longitude})>"
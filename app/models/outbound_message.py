@@ -0,0 +1,54 @@
+from app import db
+from datetime import datetime
+
+
+class OutboundMessage(db.Model):
+    """
+    Outbox de mensajes salientes de WhatsApp.
+
+    Los flujos insertan aquí los mensajes en la misma transacción que el cambio
+    de estado; el OutboxSender los envía después del commit, en orden por
+    destinatario. Un rollback descarta también los mensajes pendientes.
+
+    El payload puede llevar datos sensibles (p. ej. la contraseña temporal
+    del registro): se borra (NULL) cuando el mensaje queda enviado o fallido.
+    """
+    __tablename__ = "outbound_messages"
+
+    STATUS_PENDING = "pending"
+    STATUS_SENDING = "sending"
+    STATUS_SENT = "sent"
+    STATUS_FAILED = "failed"
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(20), nullable=False, index=True)
+    payload = db.Column(db.Text, nullable=True)  # JSON ya serializado; NULL al terminar
+    status = db.Column(db.String(20), nullable=False, default=STATUS_PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    provider_message_id = db.Column(db.String(128), nullable=True)  # wamid devuelto por la API
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)  # reintento con backoff
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_outbound_messages_status_id", "status", "id"),
+    )
+
+    def __repr__(self):
+        return f"<OutboundMessage(id={self.id}, to='{self.recipient}', status='{self.status}')>"
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "recipient": self.recipient,
+            "status": self.status,
+            "attempts": self.attempts,
+            "next_attempt_at": self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            "last_error": self.last_error,
+            "provider_message_id": self.provider_message_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "sent_at": self.sent_at.isoformat() if self.sent_at else None
+        }
@@ -0,0 +1,16 @@
+from app import db
+from datetime import datetime
+
+
+class ProcessedMessage(db.Model):
+    """
+    Registro de mensajes de WhatsApp ya procesados (por wamid).
+    Permite descartar reenvíos de Meta entre distintos procesos/workers.
+    """
+    __tablename__ = "whatsapp_processed_messages"
+
+    wamid = db.Column(db.String(128), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<ProcessedMessage(wamid='{self.wamid}')>"
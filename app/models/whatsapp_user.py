@@ -1,5 +1,6 @@
 from app import db
 from datetime import datetime
+from sqlalchemy.dialects.postgresql import JSONB
 
 class WhatsAppUser(db.Model):
     __tablename__ = "whatsapp_users"
@@ -17,10 +18,23 @@ class WhatsAppUser(db.Model):
     flow = db.Column(db.String(50), nullable=True)
     step = db.Column(db.String(50), nullable=True)
 
-    temp_data = db.Column(db.JSON, nullable=True)  # datos temporales del flujo
+    # datos temporales del flujo (ver ConversationContext); JSONB en PostgreSQL
+    # para actualizar solo las claves modificadas. None se guarda como NULL.
+    temp_data = db.Column(
+        db.JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), "postgresql"),
+        nullable=True
+    )
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # último mensaje recibido (ver SessionSweeper)
+    last_activity_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=True)
+
+    __table_args__ = (
+        # barrido por lotes de sesiones inactivas (keyset sobre last_activity_at, id)
+        db.Index("ix_whatsapp_users_last_activity", "last_activity_at", "id"),
+    )
+
     traveler = db.relationship("Traveler", backref="whatsapp_user", uselist=False)
     
     def to_dict(self):
@@ -31,5 +45,6 @@ class WhatsAppUser(db.Model):
             "flow": self.flow,
             "step": self.step,
             "temp_data": self.temp_data,
-            "created_at": self.created_at.isoformat() if self.created_at else None
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "last_activity_at": self.last_activity_at.isoformat() if self.last_activity_at else None
         }
\ No newline at end of file
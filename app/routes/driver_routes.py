@@ -1,8 +1,43 @@
-from flask import Blueprint
-from app.controllers.driver_controller import get_all_drivers, get_drivers_by_status, get_driver_by_id_or_name
+from flask import Blueprint, current_app
+from app import limiter
+from app.middleware.auth_middleware import staff_required
+from app.controllers.driver_controller import (
+    get_all_drivers, get_drivers_by_status, get_driver_by_id_or_name, report_driver_locations,
+    get_driver_feed
+)
 
 driver_bp = Blueprint('drivers', __name__, url_prefix='/api/drivers')
 
+# Los conductores reportan su posición cada pocos segundos: los límites por
+# defecto de la API (por hora/día) no aplican a esta ruta
+LOCATIONS_RATE_LIMIT = "120 per minute"
+
+# El feed se consulta periódicamente (las respuestas 304 son baratas)
+FEED_RATE_LIMIT = "60 per minute"
+
+
+def locations_rate_limit():
+    return current_app.config.get("DRIVER_LOCATION_RATE_LIMIT", LOCATIONS_RATE_LIMIT)
+
+
+def feed_rate_limit():
+    return current_app.config.get("DRIVER_FEED_RATE_LIMIT", FEED_RATE_LIMIT)
+
+
+@driver_bp.route('/locations', methods=['POST'])
+@limiter.limit(locations_rate_limit)
+@staff_required
+def post_driver_locations():
+    return report_driver_locations()
+
+
+@driver_bp.route('/<int:driver_id>/feed', methods=['GET'])
+@limiter.limit(feed_rate_limit)
+@staff_required
+def fetch_driver_feed(driver_id):
+    return get_driver_feed(driver_id)
+
+
 @driver_bp.route('', methods=['GET'])
 def fetch_all_drivers():
     return get_all_drivers()
@@ -0,0 +1,149 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import or_, select, tuple_
+
+from app import db
+from app.models.custom import CustomTrip
+from app.models.enums import TripStatus
+from app.models.package import PackageTrip
+from app.models.trip import Trip
+from app.models.trip_addresses import Address, TripAddress
+
+
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 100
+
+packages = PackageTrip.__table__
+customs = CustomTrip.__table__
+
+
+def encode_cursor(created_at, trip_id):
+    raw = f"{created_at.isoformat()}|{trip_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(created_at, id) del cursor; ValueError si no es válido"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, trip_id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(trip_id)
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+
+def available_work(limit=FEED_PAGE_SIZE, after=None, max_passengers=None, include_addresses=False):
+    """
+    Página de trabajo disponible para un conductor: paquetes y viajes
+    personalizados en AVAILABLE, del más reciente al más antiguo.
+
+    Una sola consulta sobre trips con outer join a package_trips y
+    custom_trips, que trae solo las columnas del listado (sin cargar los
+    objetos ni sus direcciones). Paginación por (created_at, id): cada página
+    cuesta lo mismo sin importar cuántas haya antes.
+
+    :param after: (created_at, id) del último elemento de la página anterior
+    :param max_passengers: omitir viajes personalizados con más pasajeros (cupos del vehículo)
+    :param include_addresses: agregar las direcciones de cada elemento (dos consultas más)
+    :return: (items, cursor de la página siguiente o None)
+    """
+    query = (
+        select(
+            Trip.id, Trip.price, Trip.notes, Trip.created_at, Trip.departure_time,
+            packages.c.id.label("package_id"), packages.c.title, packages.c.package_description,
+            packages.c.weight, packages.c.dimensions,
+            packages.c.pickup_address_id, packages.c.delivery_address_id,
+            customs.c.id.label("custom_id"), customs.c.custom_trip_type, customs.c.passenger_count
+        )
+        .select_from(Trip.__table__)
+        .outerjoin(packages, packages.c.id == Trip.id)
+        .outerjoin(customs, customs.c.id == Trip.id)
+        .where(
+            Trip.status == TripStatus.AVAILABLE,
+            or_(packages.c.id.isnot(None), customs.c.id.isnot(None))
+        )
+    )
+
+    if max_passengers is not None:
+        query = query.where(or_(customs.c.id.is_(None), customs.c.passenger_count <= max_passengers))
+
+    if after is not None:
+        query = query.where(tuple_(Trip.created_at, Trip.id) < tuple(after))
+
+    # Un elemento extra indica si hay página siguiente
+    rows = db.session.execute(
+        query.order_by(Trip.created_at.desc(), Trip.id.desc()).limit(limit + 1)
+    ).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = [_project(row) for row in rows]
+
+    if include_addresses and items:
+        _attach_addresses(items, rows)
+
+    next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None
+    return items, next_cursor
+
+
+def _project(row):
+    item = {
+        "id": row.id,
+        "kind": "package" if row.package_id is not None else "custom",
+        "price": float(row.price) if row.price is not None else None,
+        "notes": row.notes,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "departure_time": row.departure_time.isoformat() if row.departure_time else None
+    }
+
+    if row.package_id is not None:
+        item.update({
+            "title": row.title,
+            "package_description": row.package_description,
+            "weight": row.weight,
+            "dimensions": row.dimensions,
+            "pickup_address_id": row.pickup_address_id,
+            "delivery_address_id": row.delivery_address_id
+        })
+    else:
+        item.update({
+            "custom_trip_type": row.custom_trip_type.value if row.custom_trip_type else None,
+            "passenger_count": row.passenger_count
+        })
+    return item
+
+
+def _attach_addresses(items, rows):
+    """Direcciones de la página: recogida/entrega de los paquetes y trip_addresses de los viajes"""
+    address_ids = {
+        address_id
+        for row in rows if row.package_id is not None
+        for address_id in (row.pickup_address_id, row.delivery_address_id)
+    }
+    custom_ids = [row.id for row in rows if row.custom_id is not None]
+
+    addresses = {}
+    if address_ids:
+        addresses = {
+            address.id: address.to_dict()
+            for address in Address.query.filter(Address.id.in_(address_ids))
+        }
+
+    trip_addresses = {}
+    if custom_ids:
+        links = (
+            db.session.query(TripAddress.trip_id, Address)
+            .join(Address, Address.id == TripAddress.address_id)
+            .filter(TripAddress.trip_id.in_(custom_ids))
+            .order_by(TripAddress.trip_id, Address.order)
+        )
+        for trip_id, address in links:
+            trip_addresses.setdefault(trip_id, []).append(address.to_dict())
+
+    for item in items:
+        if item["kind"] == "package":
+            item["pickup_address"] = addresses.get(item["pickup_address_id"])
+            item["delivery_address"] = addresses.get(item["delivery_address_id"])
+        else:
+            item["addresses"] = trip_addresses.get(item["id"], [])
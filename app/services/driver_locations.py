@@ -0,0 +1,407 @@
+import atexit
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import case
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from app import db
+from app.models.driver import Driver
+from app.models.driver_location import DriverLocation
+from app.services.driver_matching import driver_matcher
+from app.services.whatsapp.metrics import metrics
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+# Diferencia máxima aceptada entre el reloj del dispositivo y el del servidor
+MAX_CLOCK_SKEW_SECONDS = 60
+
+
+class LocationStore:
+    """
+    Tabla en memoria de la última posición de cada conductor.
+
+    Columnas en arrays contiguos (id, lat, lng, ts) y un índice
+    driver_id -> fila: unos 32 bytes por conductor en lugar de un dict por
+    posición, y actualizar una posición no crea objetos nuevos.
+
+    Las filas modificadas desde la última escritura a la BD quedan marcadas
+    (dirty) hasta que take_dirty las entrega.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.lats = array("d")
+        self.lngs = array("d")
+        self.timestamps = array("d")
+        self._rows = {}
+        self._dirty = {}  # driver_id -> None, en orden de llegada
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def update(self, driver_id, lat, lng, ts, dirty=True):
+        """Guarda la posición si es más reciente que la conocida. Devuelve True si se guardó."""
+        with self._lock:
+            row = self._rows.get(driver_id)
+            if row is None:
+                self._rows[driver_id] = len(self.ids)
+                self.ids.append(driver_id)
+                self.lats.append(lat)
+                self.lngs.append(lng)
+                self.timestamps.append(ts)
+            elif ts >= self.timestamps[row]:
+                self.lats[row] = lat
+                self.lngs[row] = lng
+                self.timestamps[row] = ts
+            else:
+                return False
+
+            if dirty:
+                self._dirty[driver_id] = None
+            return True
+
+    def get(self, driver_id):
+        """(lat, lng, ts) o None"""
+        with self._lock:
+            row = self._rows.get(driver_id)
+            if row is None:
+                return None
+            return self.lats[row], self.lngs[row], self.timestamps[row]
+
+    def pending(self):
+        return len(self._dirty)
+
+    def take_dirty(self, limit):
+        """Hasta limit filas modificadas [(driver_id, lat, lng, ts)], que dejan de estar marcadas"""
+        with self._lock:
+            batch = []
+            while self._dirty and len(batch) < limit:
+                driver_id = next(iter(self._dirty))
+                del self._dirty[driver_id]
+                row = self._rows[driver_id]
+                batch.append((driver_id, self.lats[row], self.lngs[row], self.timestamps[row]))
+            return batch
+
+    def remove(self, driver_id):
+        """Olvida al conductor (la última fila ocupa su lugar)"""
+        with self._lock:
+            row = self._rows.pop(driver_id, None)
+            self._dirty.pop(driver_id, None)
+            if row is None:
+                return
+
+            last = len(self.ids) - 1
+            if row != last:
+                moved_id = self.ids[last]
+                self.ids[row] = moved_id
+                self.lats[row] = self.lats[last]
+                self.lngs[row] = self.lngs[last]
+                self.timestamps[row] = self.timestamps[last]
+                self._rows[moved_id] = row
+            for column in (self.ids, self.lats, self.lngs, self.timestamps):
+                column.pop()
+
+    def mark_dirty(self, driver_ids):
+        with self._lock:
+            for driver_id in driver_ids:
+                self._dirty.setdefault(driver_id, None)
+
+
+class DriverLocationService:
+    """
+    Ingesta de posiciones de conductores (POST /api/drivers/locations).
+
+    Cada ping actualiza la tabla en memoria (LocationStore) y el índice de
+    cercanía (driver_matcher); la BD (driver_locations) se actualiza en
+    segundo plano cada DRIVER_LOCATION_FLUSH_INTERVAL con un upsert por lote
+    que solo lleva la última posición de cada conductor, así miles de
+    conductores reportando cada pocos segundos no generan un commit por ping.
+
+    Al arrancar, las posiciones vigentes de la tabla se cargan en memoria.
+
+    Las posiciones de conductores que no existen en drivers (p. ej. borrados)
+    se descartan antes del upsert, y las que siguen fallando después de
+    DRIVER_LOCATION_MAX_FLUSH_ATTEMPTS escrituras dejan de reintentarse, así
+    una fila inválida no bloquea la escritura de las demás.
+
+    Métricas: driver_locations_received, driver_locations_rejected,
+    driver_locations_flushed, driver_locations_dropped, driver_location_flush_batch;
+    gauges driver_locations_tracked y driver_locations_pending.
+
+    Configuración (app.config):
+    - DRIVER_LOCATION_FLUSH_INTERVAL: segundos entre escrituras a la BD (default 5)
+    - DRIVER_LOCATION_FLUSH_BATCH_SIZE: filas por upsert (default 1000)
+    - DRIVER_LOCATION_MAX_BATCH: pings por petición (default 500)
+    - DRIVER_LOCATION_MAX_FLUSH_ATTEMPTS: escrituras fallidas antes de dejar de reintentar una posición (default 5)
+    - DRIVER_POSITION_MAX_AGE: antigüedad máxima de las posiciones cargadas al arrancar (default 600)
+    """
+
+    def __init__(self, flush_interval=5, flush_batch_size=1000, max_batch=500, max_age=600, max_flush_attempts=5):
+        self.app = None
+        self.store = LocationStore()
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.max_batch = max_batch
+        self.max_age = max_age
+        self.max_flush_attempts = max_flush_attempts
+        self._failures = {}  # driver_id -> escrituras fallidas seguidas
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = app.config.get("DRIVER_LOCATION_FLUSH_INTERVAL", self.flush_interval)
+        self.flush_batch_size = app.config.get("DRIVER_LOCATION_FLUSH_BATCH_SIZE", self.flush_batch_size)
+        self.max_batch = app.config.get("DRIVER_LOCATION_MAX_BATCH", self.max_batch)
+        self.max_age = app.config.get("DRIVER_POSITION_MAX_AGE", self.max_age)
+        self.max_flush_attempts = app.config.get("DRIVER_LOCATION_MAX_FLUSH_ATTEMPTS", self.max_flush_attempts)
+
+        metrics.register_gauge("driver_locations_tracked", lambda: len(self.store))
+        metrics.register_gauge("driver_locations_pending", self.store.pending)
+
+        # Escribir las posiciones pendientes al detener el proceso
+        atexit.register(self.flush_all)
+
+    # ============== INGESTA ==============
+
+    def record(self, pings):
+        """
+        Registra pings ya validados [(driver_id, lat, lng, ts), ...].
+        Devuelve cuántos se guardaron (los más viejos que la posición conocida se ignoran).
+        """
+        accepted = 0
+        for driver_id, lat, lng, ts in pings:
+            if self.store.update(driver_id, lat, lng, ts):
+                driver_matcher.update_position(driver_id, lat, lng, ts)
+                accepted += 1
+
+        metrics.incr("driver_locations_received", accepted)
+        if len(pings) > accepted:
+            metrics.incr("driver_locations_rejected", len(pings) - accepted)
+
+        self._ensure_started()
+        if self.store.pending() >= self.flush_batch_size:
+            self._wakeup.set()
+        return accepted
+
+    # ============== ESCRITURA A LA BD ==============
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="driver-locations-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            try:
+                with self.app.app_context():
+                    while self.flush() >= self.flush_batch_size:
+                        pass
+            except Exception:
+                log.exception("Error escribiendo posiciones de conductores")
+
+    def flush(self):
+        """Escribe un lote de posiciones modificadas con un solo upsert. Devuelve su tamaño."""
+        with self._flush_lock:
+            batch = self.store.take_dirty(self.flush_batch_size)
+            if not batch:
+                return 0
+
+            started_at = time.monotonic()
+
+            # Conductores borrados o inexistentes: el upsert fallaría por la FK
+            # de todo el lote
+            known = known_driver_ids(driver_id for driver_id, _, _, _ in batch)
+            unknown = [driver_id for driver_id, _, _, _ in batch if driver_id not in known]
+            if unknown:
+                self.forget(unknown)
+                log.warning("Posiciones de conductores inexistentes descartadas", driver_ids=unknown)
+                metrics.incr("driver_locations_dropped", len(unknown))
+
+            now = datetime.utcnow()
+            rows = [
+                {
+                    "driver_id": driver_id,
+                    "latitude": lat,
+                    "longitude": lng,
+                    "reported_at": datetime.utcfromtimestamp(ts),
+                    "updated_at": now
+                }
+                for driver_id, lat, lng, ts in batch
+                if driver_id in known
+            ]
+
+            if rows:
+                try:
+                    db.session.execute(_upsert_statement(_dialect_name()), rows)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    self._retry_later([row["driver_id"] for row in rows])
+                    raise
+
+                for row in rows:
+                    self._failures.pop(row["driver_id"], None)
+
+        metrics.incr("driver_locations_flushed", len(rows))
+        metrics.observe("driver_location_flush_batch", time.monotonic() - started_at)
+        return len(batch)
+
+    def _retry_later(self, driver_ids):
+        """Vuelve a marcar las posiciones, salvo las que ya fallaron max_flush_attempts veces"""
+        retry = []
+        dropped = []
+        for driver_id in driver_ids:
+            failures = self._failures.get(driver_id, 0) + 1
+            if failures >= self.max_flush_attempts:
+                self._failures.pop(driver_id, None)
+                dropped.append(driver_id)
+            else:
+                self._failures[driver_id] = failures
+                retry.append(driver_id)
+
+        # Se vuelven a marcar: el próximo lote lleva la posición más reciente
+        self.store.mark_dirty(retry)
+        if dropped:
+            # La posición sigue en memoria (y en el índice); solo no se persiste
+            log.error("Posiciones descartadas tras varios intentos de escritura", driver_ids=dropped)
+            metrics.incr("driver_locations_dropped", len(dropped))
+
+    def forget(self, driver_ids):
+        """Quita a los conductores de la tabla en memoria y del índice de cercanía"""
+        for driver_id in driver_ids:
+            self.store.remove(driver_id)
+            driver_matcher.remove_position(driver_id)
+            self._failures.pop(driver_id, None)
+
+    def flush_all(self):
+        if self.app is None or not self.store.pending():
+            return
+        try:
+            with self.app.app_context():
+                while self.flush():
+                    pass
+        except Exception as e:
+            log.error("No se pudieron escribir posiciones de conductores", pending=self.store.pending(), error=str(e))
+
+    def load(self):
+        """Carga en memoria (y en el índice de cercanía) las posiciones vigentes de la BD"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.max_age)
+        rows = (
+            db.session.query(
+                DriverLocation.driver_id, DriverLocation.latitude,
+                DriverLocation.longitude, DriverLocation.reported_at
+            )
+            .filter(DriverLocation.reported_at >= cutoff)
+            .all()
+        )
+
+        for driver_id, lat, lng, reported_at in rows:
+            ts = (reported_at - datetime(1970, 1, 1)).total_seconds()
+            if self.store.update(driver_id, lat, lng, ts, dirty=False):
+                driver_matcher.update_position(driver_id, lat, lng, ts)
+        return len(rows)
+
+
+def known_driver_ids(driver_ids):
+    """Subconjunto de driver_ids que existe en drivers"""
+    driver_ids = set(driver_ids)
+    if not driver_ids:
+        return set()
+    return {
+        driver_id
+        for (driver_id,) in db.session.query(Driver.id).filter(Driver.id.in_(driver_ids))
+    }
+
+
+def _dialect_name():
+    return db.session.get_bind(mapper=DriverLocation.__mapper__).dialect.name
+
+
+def _upsert_statement(dialect):
+    """Upsert por driver_id para el dialecto: ON CONFLICT (PostgreSQL, SQLite) u ON DUPLICATE KEY (MySQL)"""
+    if dialect in ("mysql", "mariadb"):
+        return _mysql_upsert_statement()
+
+    insert = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}.get(dialect)
+    if insert is None:
+        raise RuntimeError(f"Upsert de driver_locations no soportado en {dialect}")
+
+    statement = insert(DriverLocation)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[DriverLocation.driver_id],
+        set_={
+            "latitude": excluded.latitude,
+            "longitude": excluded.longitude,
+            "reported_at": excluded.reported_at,
+            "updated_at": excluded.updated_at
+        },
+        # Un lote atrasado no pisa una posición más reciente
+        where=DriverLocation.reported_at <= excluded.reported_at
+    )
+
+
+def _mysql_upsert_statement():
+    """
+    ON DUPLICATE KEY UPDATE no admite WHERE: cada columna conserva su valor
+    si la posición guardada es más reciente. MySQL aplica las asignaciones
+    en orden, por eso reported_at va al final.
+    """
+    statement = mysql.insert(DriverLocation)
+    inserted = statement.inserted
+    newer = DriverLocation.reported_at <= inserted.reported_at
+
+    return statement.on_duplicate_key_update([
+        (column, case((newer, getattr(inserted, column)), else_=getattr(DriverLocation, column)))
+        for column in ("latitude", "longitude", "updated_at", "reported_at")
+    ])
+
+
+def parse_ping(item, now):
+    """
+    (lat, lng, ts) de un ping {"latitude", "longitude", "timestamp"?}.
+    timestamp: epoch en segundos o ISO 8601 (UTC); sin él se usa la hora del servidor.
+    Lanza ValueError si el ping no es válido.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Cada posición debe ser un objeto")
+
+    lat = float(item["latitude"])
+    lng = float(item["longitude"])
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Coordenadas fuera de rango")
+
+    ts = item.get("timestamp")
+    if ts is None:
+        ts = now
+    elif isinstance(ts, str):
+        reported_at = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+        if reported_at.tzinfo is None:
+            reported_at = reported_at.replace(tzinfo=timezone.utc)
+        ts = reported_at.timestamp()
+    else:
+        ts = float(ts)
+
+    if ts > now + MAX_CLOCK_SKEW_SECONDS:
+        raise ValueError("Fecha de la posición en el futuro")
+    return lat, lng, min(ts, now)
+
+
+driver_locations = DriverLocationService()
@@ -0,0 +1,277 @@
+import heapq
+import math
+import threading
+import time
+
+from sqlalchemy.orm import joinedload
+
+from app import db
+from app.models.driver import Driver
+from app.models.enums import DriverStatus
+from app.models.vehicle import Vehicle
+from app.services.whatsapp.metrics import metrics
+from app.utils.geo import haversine
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+# Kilómetros por grado de latitud
+KM_PER_DEGREE = 111.32
+
+# Búsquedas por asignación si los candidatos del índice dejaron de ser elegibles
+MAX_MATCH_ROUNDS = 3
+
+
+class DriverGridIndex:
+    """
+    Índice espacial en memoria de la última posición de cada conductor.
+
+    El plano se divide en celdas de cell_degrees x cell_degrees (0.01° ≈ 1.1 km);
+    cada celda guarda el conjunto de conductores que están en ella. La búsqueda
+    de los k más cercanos recorre anillos de celdas alrededor del punto y se
+    detiene cuando el siguiente anillo ya no puede tener a nadie más cerca que
+    el k-ésimo encontrado, así solo se mide la distancia a los conductores
+    cercanos y no a toda la flota.
+    """
+
+    def __init__(self, cell_degrees=0.01):
+        self.cell_degrees = cell_degrees
+        self._positions = {}  # driver_id -> (lat, lng, cell, ts)
+        self._cells = {}      # cell -> {driver_id}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def cell_for(self, lat, lng):
+        return (math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees))
+
+    def update(self, driver_id, lat, lng, ts=None):
+        cell = self.cell_for(lat, lng)
+        ts = ts if ts is not None else time.time()
+
+        with self._lock:
+            previous = self._positions.get(driver_id)
+            if previous is not None and previous[2] != cell:
+                self._discard_from_cell(driver_id, previous[2])
+            self._positions[driver_id] = (lat, lng, cell, ts)
+            self._cells.setdefault(cell, set()).add(driver_id)
+
+    def remove(self, driver_id):
+        with self._lock:
+            previous = self._positions.pop(driver_id, None)
+            if previous is not None:
+                self._discard_from_cell(driver_id, previous[2])
+
+    def _discard_from_cell(self, driver_id, cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(driver_id)
+            if not members:
+                del self._cells[cell]
+
+    def position(self, driver_id):
+        entry = self._positions.get(driver_id)
+        return entry[:2] + entry[3:] if entry else None
+
+    def nearest(self, lat, lng, k=5, max_km=25, accept=None, min_ts=None):
+        """
+        Los k conductores más cercanos a (lat, lng) dentro de max_km.
+
+        :param accept: función driver_id -> bool (elegibilidad)
+        :param min_ts: ignorar posiciones reportadas antes de este timestamp
+        :return: [(driver_id, km), ...] ordenados por distancia
+        """
+        center_x, center_y = self.cell_for(lat, lng)
+
+        # Ancho mínimo de una celda en km (las celdas se angostan hacia los polos)
+        widest_lat = min(abs(lat) + max_km / KM_PER_DEGREE, 89.0)
+        cell_km = self.cell_degrees * KM_PER_DEGREE * math.cos(math.radians(widest_lat))
+        max_rings = int(max_km / cell_km) + 1
+
+        best = []  # heap de (-km, driver_id) con los k mejores
+
+        with self._lock:
+            for ring in range(max_rings + 1):
+                for cell in _ring_cells(center_x, center_y, ring):
+                    for driver_id in self._cells.get(cell, ()):
+                        d_lat, d_lng, _, ts = self._positions[driver_id]
+                        if min_ts is not None and ts < min_ts:
+                            continue
+                        if accept is not None and not accept(driver_id):
+                            continue
+
+                        km = haversine(lat, lng, d_lat, d_lng)
+                        if km > max_km:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-km, driver_id))
+                        elif km < -best[0][0]:
+                            heapq.heapreplace(best, (-km, driver_id))
+
+                # El anillo siguiente está a más de ring * cell_km del punto
+                if len(best) >= k and -best[0][0] <= ring * cell_km:
+                    break
+
+        return sorted(((driver_id, -neg_km) for neg_km, driver_id in best), key=lambda item: item[1])
+
+
+def _ring_cells(center_x, center_y, ring):
+    """Celdas a distancia de Chebyshev exactamente ring de la celda central"""
+    if ring == 0:
+        yield (center_x, center_y)
+        return
+
+    for dx in range(-ring, ring + 1):
+        yield (center_x + dx, center_y - ring)
+        yield (center_x + dx, center_y + ring)
+    for dy in range(-ring + 1, ring):
+        yield (center_x - ring, center_y + dy)
+        yield (center_x + ring, center_y + dy)
+
+
+class DriverMatcher:
+    """
+    Asignación de conductores por cercanía al punto de recogida.
+
+    Combina el índice de posiciones (DriverGridIndex) con una tabla en memoria
+    de los conductores elegibles (DriverStatus.AVAILABLE, is_verified y cupos
+    del vehículo), que se recarga de la BD cada DRIVER_MATCH_REFRESH_SECONDS.
+    Así la búsqueda de los k más cercanos no consulta la BD; solo se cargan
+    los conductores elegidos (con su vehículo) al final.
+
+    Las posiciones se informan con update_position. Sin posiciones o sin punto
+    de recogida se usan los conductores elegibles mejor calificados.
+
+    Métricas: driver_match (duración de la búsqueda en el índice) y
+    driver_match_stale (candidatos descartados por la tabla atrasada).
+
+    Configuración (app.config):
+    - DRIVER_MATCH_CELL_DEGREES: tamaño de celda del índice (default 0.01)
+    - DRIVER_MATCH_MAX_KM: distancia máxima de búsqueda (default 25)
+    - DRIVER_MATCH_REFRESH_SECONDS: recarga de la tabla de elegibles (default 30)
+    - DRIVER_POSITION_MAX_AGE: segundos en que una posición se considera vigente (default 600)
+    """
+
+    def __init__(self, cell_degrees=0.01, max_km=25, refresh_seconds=30, position_max_age=600):
+        self.index = DriverGridIndex(cell_degrees)
+        self.max_km = max_km
+        self.refresh_seconds = refresh_seconds
+        self.position_max_age = position_max_age
+        self._eligible = {}  # driver_id -> cupos del vehículo
+        self._refreshed_at = 0
+        self._refresh_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.index = DriverGridIndex(app.config.get("DRIVER_MATCH_CELL_DEGREES", self.index.cell_degrees))
+        self.max_km = app.config.get("DRIVER_MATCH_MAX_KM", self.max_km)
+        self.refresh_seconds = app.config.get("DRIVER_MATCH_REFRESH_SECONDS", self.refresh_seconds)
+        self.position_max_age = app.config.get("DRIVER_POSITION_MAX_AGE", self.position_max_age)
+
+    def update_position(self, driver_id, lat, lng, ts=None):
+        self.index.update(driver_id, lat, lng, ts)
+
+    def remove_position(self, driver_id):
+        self.index.remove(driver_id)
+
+    def refresh(self):
+        """Recarga de la BD los conductores elegibles y sus cupos"""
+        rows = (
+            db.session.query(Driver.id, Vehicle.seats)
+            .outerjoin(Vehicle, Vehicle.driver_id == Driver.id)
+            .filter(Driver.status == DriverStatus.AVAILABLE, Driver.is_verified.is_(True))
+            .all()
+        )
+        self._eligible = {driver_id: seats or 0 for driver_id, seats in rows}
+        self._refreshed_at = time.monotonic()
+
+    def _refresh_if_stale(self):
+        if time.monotonic() - self._refreshed_at < self.refresh_seconds:
+            return
+        # Un solo hilo recarga; los demás usan la tabla anterior
+        if not self._refresh_lock.acquire(blocking=not self._refreshed_at):
+            return
+        try:
+            if time.monotonic() - self._refreshed_at >= self.refresh_seconds:
+                self.refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def nearest(self, lat, lng, k=5, min_seats=1):
+        """[(driver_id, km), ...] de los k conductores elegibles más cercanos"""
+        self._refresh_if_stale()
+        eligible = self._eligible
+
+        return self.index.nearest(
+            lat, lng,
+            k=k,
+            max_km=self.max_km,
+            accept=lambda driver_id: eligible.get(driver_id, -1) >= min_seats,
+            min_ts=time.time() - self.position_max_age
+        )
+
+    def find_drivers(self, point, k=1, min_seats=1):
+        """
+        Conductores para un punto de recogida (lat, lng) o None.
+        Devuelve [(Driver, km o None), ...] con el vehículo ya cargado.
+
+        La tabla de elegibles puede estar atrasada (se recarga cada
+        refresh_seconds): los candidatos se vuelven a validar al cargarlos y
+        los que ya no son elegibles se quitan de la tabla y se busca de nuevo.
+        """
+        for _ in range(MAX_MATCH_ROUNDS):
+            matches = []
+            if point is not None:
+                started_at = time.perf_counter()
+                matches = self.nearest(point[0], point[1], k=k, min_seats=min_seats)
+                metrics.observe("driver_match", time.perf_counter() - started_at)
+                log.debug("Búsqueda de conductores cercanos", found=len(matches), indexed=len(self.index))
+
+            if not matches:
+                break
+
+            distances = dict(matches)
+            drivers = _eligible_drivers(min_seats).filter(Driver.id.in_(distances)).all()
+
+            stale = set(distances) - {driver.id for driver in drivers}
+            if stale:
+                self._mark_ineligible(stale)
+
+            if drivers or not stale:
+                drivers.sort(key=lambda driver: distances[driver.id])
+                return [(driver, distances[driver.id]) for driver in drivers]
+
+        # Sin candidatos cercanos (sin punto o sin posiciones vigentes): los elegibles mejor calificados
+        drivers = (
+            _eligible_drivers(min_seats)
+            .order_by(Driver.rating.desc(), Driver.id)
+            .limit(k)
+            .all()
+        )
+        return [(driver, None) for driver in drivers]
+
+    def _mark_ineligible(self, driver_ids):
+        """Quita de la tabla de elegibles a conductores que dejaron de serlo (hasta la próxima recarga)"""
+        eligible = dict(self._eligible)
+        for driver_id in driver_ids:
+            eligible.pop(driver_id, None)
+        self._eligible = eligible
+        metrics.incr("driver_match_stale", len(driver_ids))
+
+
+def _eligible_drivers(min_seats):
+    """Conductores disponibles, verificados y con cupos suficientes, con su vehículo"""
+    return (
+        Driver.query
+        .options(joinedload(Driver.vehicle))
+        .join(Vehicle, Vehicle.driver_id == Driver.id)
+        .filter(
+            Driver.status == DriverStatus.AVAILABLE,
+            Driver.is_verified.is_(True),
+            Vehicle.seats >= min_seats
+        )
+    )
+
+
+driver_matcher = DriverMatcher()
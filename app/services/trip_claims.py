@@ -0,0 +1,74 @@
+from collections import namedtuple
+
+from sqlalchemy import exists, select, update
+
+from app import db
+from app.models.enums import TripStatus
+from app.models.trip import Trip
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Resultado de un intento de tomar un viaje:
+# - claimed: este conductor lo tomó (ganador)
+# - found: el viaje existe (y es del tipo pedido)
+# - status / driver_id: estado y conductor actuales (del ganador si otro lo tomó antes)
+ClaimResult = namedtuple("ClaimResult", "claimed found status driver_id")
+
+
+def claim_trip(model, trip_id, driver_id, vehicle_id=None):
+    """
+    Asigna el viaje al conductor solo si sigue disponible, con un único
+    UPDATE condicional:
+
+        UPDATE trips SET driver_id=..., vehicle_id=..., status='PENDING'
+        WHERE id=:id AND status='AVAILABLE' [RETURNING id]
+
+    La base de datos serializa los UPDATE sobre la misma fila: con muchos
+    conductores aceptando a la vez exactamente uno lo toma y los demás no
+    actualizan nada, sin bloquear la fila entre la lectura y la escritura.
+
+    :param model: subclase de Trip (PackageTrip, CustomTrip); el viaje debe
+                  existir en su tabla
+    :return: ClaimResult (la transacción queda confirmada)
+    """
+    subtype_table = model.__table__
+    statement = (
+        update(Trip)
+        .where(
+            Trip.id == trip_id,
+            Trip.status == TripStatus.AVAILABLE,
+            exists().where(subtype_table.c.id == Trip.id)
+        )
+        .values(driver_id=driver_id, vehicle_id=vehicle_id, status=TripStatus.PENDING)
+        .execution_options(synchronize_session=False)
+    )
+
+    dialect = db.session.get_bind(mapper=Trip.__mapper__).dialect
+    try:
+        if dialect.update_returning:
+            claimed = db.session.execute(statement.returning(Trip.id)).first() is not None
+        else:
+            claimed = db.session.execute(statement).rowcount == 1
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if claimed:
+        log.info("Viaje tomado", trip_id=trip_id, driver_id=driver_id)
+        return ClaimResult(True, True, TripStatus.PENDING, driver_id)
+
+    # Perdedor (o viaje inexistente): estado actual para el mensaje de respuesta
+    current = db.session.execute(
+        select(Trip.status, Trip.driver_id)
+        .where(Trip.id == trip_id, exists().where(subtype_table.c.id == Trip.id))
+    ).first()
+
+    if current is None:
+        return ClaimResult(False, False, None, None)
+
+    log.info("Viaje ya tomado", trip_id=trip_id, driver_id=driver_id, winner=current.driver_id)
+    return ClaimResult(False, True, current.status, current.driver_id)
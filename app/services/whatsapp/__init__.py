@@ -1,7 +1,19 @@
-from config import Config
+import threading
+from contextlib import contextmanager
 from flask import Blueprint
-import requests
 from datetime import datetime, timedelta
+from app.services.whatsapp.payloads import (
+    payload_registry,
+    slot,
+    serialize_payload,
+    build_text_payload,
+    build_buttons_payload,
+    build_list_payload
+)
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
 
 
 whatsapp_bp = Blueprint("whatsapp", __name__)
@@ -54,15 +66,38 @@ whatsapp_bp = Blueprint("whatsapp", __name__)
 #         print(f"Error extrayendo mensaje: {e}")
 #         return None, None, None
     
+def extract_messages(data):
+    """
+    Recorre todas las entradas, cambios y mensajes de un payload de webhook.
+    Meta puede agrupar varios mensajes (y varios remitentes) en un solo POST.
+
+    Yields:
+        tuple: (message_id, sender, text, location_data) por cada mensaje, en orden.
+        message_id es el wamid asignado por WhatsApp (clave de idempotencia).
+    """
+    for entry in data.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+
+            # 🚫 A veces WhatsApp manda eventos sin mensajes (statuses, etc.)
+            for message in value.get("messages") or []:
+                yield (message.get("id"),) + parse_message(message)
+
+
 def extract_message(data):
+    """Devuelve solo el primer mensaje del payload (ver extract_messages)"""
     try:
-        value = data["entry"][0]["changes"][0]["value"]
+        for _, sender, text, location_data in extract_messages(data):
+            return sender, text, location_data
+        return None, None, None
+
+    except Exception:
+        log.exception("Error extrayendo mensaje")
+        return None, None, None
 
-        # 🚫 A veces WhatsApp manda eventos sin mensajes (statuses, etc.)
-        if "messages" not in value:
-            return None, None, None
 
-        message = value["messages"][0]
+def parse_message(message):
+    try:
         sender = message.get("from")
         message_type = message.get("type")
 
@@ -118,80 +153,121 @@ def extract_message(data):
         # =========================
         return sender, None, None
 
-    except Exception as e:
-        print(f"❌ Error extrayendo mensaje: {e}")
+    except Exception:
+        log.exception("Error extrayendo mensaje")
         return None, None, None
 
-def send_message(to, text):
-    url = f"https://graph.facebook.com/v20.0/{Config.PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {Config.ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
+_capture = threading.local()
+
+
+@contextmanager
+def capture_outbound():
+    """
+    Acumula los mensajes salientes [(to, body), ...] en lugar de agregarlos
+    al outbox (lo usa el FlowEngine mientras ejecuta los pasos de un flujo).
+    """
+    previous = getattr(_capture, "messages", None)
+    _capture.messages = []
+    try:
+        yield _capture.messages
+    finally:
+        _capture.messages = previous
+
+
+def enqueue_message(to, payload):
+    """
+    Agrega un mensaje saliente al outbox en la transacción actual.
+    Se envía cuando se hace commit (ver OutboxSender); un rollback lo descarta.
+
+    :param payload: dict del mensaje o JSON ya serializado (str)
+    """
+    body = payload if isinstance(payload, str) else serialize_payload(payload)
+
+    captured = getattr(_capture, "messages", None)
+    if captured is not None:
+        captured.append((to, body))
+        return None
 
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "text",
-        "text": {"body": text}
-    }
+    from app import db
+    from app.models.outbound_message import OutboundMessage
+    from app.services.whatsapp.metrics import thread_counters
 
-    requests.post(url, headers=headers, json=payload)
+    thread_counters.incr("outbound_messages")
+    message = OutboundMessage(recipient=to, payload=body)
+    db.session.add(message)
+    return message
+
+
+def send_template(phone, template, **values):
+    """Envía un payload precompilado (ver payload_registry) al destinatario"""
+    return enqueue_message(phone, template.render(to=phone, **values))
+
+
+def send_message(to, text):
+    return enqueue_message(to, build_text_payload(to, text))
 
 def send_interactive_menu(phone, body, buttons):
     """
-    Envía botones interactivos (máximo 3)
+    Envía botones interactivos (máximo 3) a través del outbox
     Raises ValueError si hay más de 3 botones
-    Raises Exception si la API falla
     """
-   
-
-    # ✅ Validar límite de 3 botones
-    if len(buttons) > 3:
-        raise ValueError(f"WhatsApp solo permite máximo 3 botones interactivos. Se intentaron enviar {len(buttons)}")
-
-    url = f"https://graph.facebook.com/v20.0/{Config.PHONE_NUMBER_ID}/messages"
-
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": phone,
-        "type": "interactive",
-        "interactive": {
-            "type": "button",
-            "body": {"text": body},
-            "action": {
-                "buttons": [
-                    {
-                        "type": "reply",
-                        "reply": {
-                            "id": btn["id"],
-                            "title": btn["title"][:20]  # ✅ WhatsApp limita títulos a 20 caracteres
-                        }
-                    }
-                    for btn in buttons
-                ]
-            }
-        }
-    }
+    payload = build_buttons_payload(phone, body, buttons)
 
-    headers = {
-        "Authorization": f"Bearer {Config.ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
+    log.debug("Enviando mensaje interactivo", phone=phone, buttons=len(buttons))
 
-    print(f"📤 Enviando mensaje interactivo a {phone}")
-    print(f"   Botones: {[btn['title'] for btn in buttons]}")
+    return enqueue_message(phone, payload)
+
+def send_interactive_list(phone, body, sections, button_text="Ver opciones", header=None, footer=None):
+    """
+    Envía un mensaje interactivo de tipo lista (hasta 10 opciones en total)
+
+    :param sections: [{"title": str (opcional), "rows": [{"id", "title", "description"}]}]
+    :param button_text: texto del botón que abre la lista (máximo 20 caracteres)
+    Raises ValueError si se superan los límites de WhatsApp
+    """
+    payload = build_list_payload(phone, body, sections, button_text, header, footer)
+
+    log.debug("Enviando lista interactiva", phone=phone, sections=len(sections))
+
+    return enqueue_message(phone, payload)
+
+
+def send_options(phone, body, options, button_text="Ver opciones"):
+    """
+    Envía un menú de opciones eligiendo el formato según la cantidad:
+    - 1 a 3 opciones: botones de respuesta
+    - 4 a 10 opciones: lista interactiva
+
+    :param options: [{"id": str, "title": str, "description": str (opcional)}]
+    Raises ValueError si hay más de 10 opciones
+    """
+    if len(options) <= 3:
+        return send_interactive_menu(phone, body=body, buttons=options)
+
+    return send_interactive_list(
+        phone,
+        body=body,
+        sections=[{"rows": options}],
+        button_text=button_text
+    )
+
+
+# Plantillas de confirmación con los botones por defecto (solo varía el texto)
+CONFIRMATION_TEMPLATE = payload_registry.register(
+    "confirmation",
+    build_buttons_payload(slot("to"), slot("body"), [
+        {"id": "confirm_yes", "title": "✅ Sí, confirmar"},
+        {"id": "confirm_no", "title": "❌ No, cancelar"}
+    ])
+)
+
+CONTINUE_TEMPLATE = payload_registry.register(
+    "continue",
+    build_buttons_payload(slot("to"), slot("body"), [
+        {"id": "confirm_yes", "title": "✅ Sí, Continuar"}
+    ])
+)
 
-    response = requests.post(url, headers=headers, json=payload)
-    
-    # ✅ Manejar errores de la API
-    if response.status_code != 200:
-        error_msg = f"WhatsApp API error {response.status_code}: {response.text}"
-        print(f"❌ {error_msg}")
-        raise Exception(error_msg)
-    
-    print(f"✅ Mensaje interactivo enviado exitosamente")
-    return response.json()
 
 def send_confirmation_message(phone, message, yes_id="confirm_yes", no_id="confirm_no",yes_title="✅ Sí, confirmar", no_title="❌ No, cancelar"):
     """
@@ -202,6 +278,8 @@ def send_confirmation_message(phone, message, yes_id="confirm_yes", no_id="confi
     :param yes_id: id del botón de confirmación
     :param no_id: id del botón de cancelación
     """
+    if (yes_id, no_id, yes_title, no_title) == ("confirm_yes", "confirm_no", "✅ Sí, confirmar", "❌ No, cancelar"):
+        return send_template(phone, CONFIRMATION_TEMPLATE, body=message)
 
     buttons = [
         {
@@ -230,6 +308,8 @@ def send_continue_message(phone, message, yes_id="confirm_yes"):
     :param yes_id: id del botón de confirmación
     :param no_id: id del botón de cancelación
     """
+    if yes_id == "confirm_yes":
+        return send_template(phone, CONTINUE_TEMPLATE, body=message)
 
     buttons = [
         {
@@ -0,0 +1,181 @@
+import queue
+import threading
+
+from limits import parse
+
+from app import limiter
+from app.services.whatsapp.client import get_client, WhatsAppAPIError
+from app.services.whatsapp.dedup import TTLSet
+from app.services.whatsapp.metrics import metrics
+from app.services.whatsapp.payloads import build_text_payload
+from app.services.whatsapp.rate_scheduler import outbound_scheduler
+from app.services.whatsapp.worker import message_dispatcher
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+ADMIT = "admit"
+DEFER = "defer"
+SHED = "shed"
+LIMITED = "limited"
+
+# Límite por remitente del webhook (WHATSAPP_WEBHOOK_RATE_LIMIT, None = sin límite)
+SENDER_RATE_LIMIT = "30 per minute"
+
+BUSY_REPLY = (
+    "⏳ En este momento estamos recibiendo muchos mensajes.\n\n"
+    "Por favor intenta de nuevo en un minuto."
+)
+
+
+class AdmissionController:
+    """
+    Control de admisión del webhook de WhatsApp.
+
+    Decide, antes de encolar cada mensaje en el despachador, si el backend
+    puede aceptarlo:
+
+    - limited: el remitente superó WHATSAPP_WEBHOOK_RATE_LIMIT. Se descartan
+      solo sus mensajes (el webhook responde 200): Meta agrupa varios
+      remitentes en una entrega y un 429 haría reenviar los de todos.
+    - admit: se encola normalmente.
+    - defer: el shard del remitente tiene WHATSAPP_DEFER_QUEUE_DEPTH mensajes
+      en espera (o está lleno). El webhook responde 503 y Meta reintenta la
+      entrega más tarde; el mensaje no se pierde.
+    - shed: hay WHATSAPP_MAX_IN_FLIGHT mensajes aceptados sin terminar (en
+      cola o en proceso). El mensaje se descarta (el webhook responde 200
+      para que Meta no lo reenvíe y agrave la sobrecarga) y el remitente
+      recibe una sola vez por ventana un aviso de "intenta en un minuto".
+
+    El aviso se envía directo a la Graph API desde un hilo propio (no pasa
+    por la BD ni por el outbox, que suelen ser la causa de la sobrecarga);
+    si su cola está llena se omite.
+
+    El límite por remitente usa el almacenamiento de Flask-Limiter
+    (RATELIMIT_STORAGE_URI, ver configure_rate_limits). Con "memory://", el
+    default, cada worker cuenta por separado: con N workers un remitente
+    puede enviar hasta N veces el límite. Para un límite global configurar
+    un almacenamiento compartido (p. ej. redis://). Si el almacenamiento no
+    responde el mensaje se admite.
+
+    Métricas: webhook_admitted, webhook_deferred, webhook_shed,
+    webhook_rate_limited, webhook_busy_replies, webhook_busy_replies_skipped.
+
+    Configuración (app.config):
+    - WHATSAPP_ADMISSION: activar el control de admisión (default True)
+    - WHATSAPP_MAX_IN_FLIGHT: mensajes aceptados sin terminar antes de descartar (default 1000)
+    - WHATSAPP_DEFER_QUEUE_DEPTH: mensajes en espera de un shard antes de diferir (default 200)
+    - WHATSAPP_WEBHOOK_RATE_LIMIT: mensajes por remitente, p. ej. "30 per minute" (default; None = sin límite)
+    - WHATSAPP_BUSY_REPLY_WINDOW: segundos entre avisos al mismo remitente (default 60)
+    - WHATSAPP_BUSY_REPLY: texto del aviso
+    """
+
+    def __init__(self, max_in_flight=1000, defer_depth=200, reply_window=60, reply_queue_size=100):
+        self.enabled = True
+        self.max_in_flight = max_in_flight
+        self.defer_depth = defer_depth
+        self.reply_window = reply_window
+        self.reply_text = BUSY_REPLY
+        self.reply_queue_size = reply_queue_size
+        self.sender_limit = parse(SENDER_RATE_LIMIT)
+        self.key_prefix = ""
+        self._notified = TTLSet(ttl_seconds=reply_window)
+        self._replies = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get("WHATSAPP_ADMISSION", self.enabled)
+        self.max_in_flight = app.config.get("WHATSAPP_MAX_IN_FLIGHT", self.max_in_flight)
+        self.defer_depth = app.config.get("WHATSAPP_DEFER_QUEUE_DEPTH", self.defer_depth)
+        self.reply_window = app.config.get("WHATSAPP_BUSY_REPLY_WINDOW", self.reply_window)
+        self.reply_text = app.config.get("WHATSAPP_BUSY_REPLY", self.reply_text)
+        self._notified = TTLSet(ttl_seconds=self.reply_window)
+
+        sender_limit = app.config.get("WHATSAPP_WEBHOOK_RATE_LIMIT", SENDER_RATE_LIMIT)
+        self.sender_limit = parse(sender_limit) if sender_limit else None
+        self.key_prefix = app.config.get("RATELIMIT_KEY_PREFIX", self.key_prefix)
+
+    def admit(self, message):
+        """
+        Decide y, si corresponde, encola el mensaje (message_id, sender, text, location_data).
+        Devuelve ADMIT, DEFER, SHED o LIMITED.
+        """
+        sender = message[1]
+
+        if not self.within_sender_limit(sender):
+            metrics.incr("webhook_rate_limited")
+            log.info("Remitente sobre el límite, mensaje descartado", sender=sender, message_id=message[0])
+            return LIMITED
+
+        if self.enabled:
+            if message_dispatcher.in_flight >= self.max_in_flight:
+                self.shed(sender)
+                return SHED
+
+            if message_dispatcher.shard_depth(sender) >= self.defer_depth:
+                metrics.incr("webhook_deferred")
+                return DEFER
+
+        if not message_dispatcher.submit(message):
+            metrics.incr("webhook_deferred")
+            return DEFER
+
+        metrics.incr("webhook_admitted")
+        return ADMIT
+
+    def within_sender_limit(self, sender):
+        """Cuenta el mensaje en el límite del remitente; False si lo supera"""
+        if self.sender_limit is None or not limiter.enabled:
+            return True
+
+        try:
+            identifiers = [self.key_prefix, "wa", sender] if self.key_prefix else ["wa", sender]
+            return limiter.limiter.hit(self.sender_limit, *identifiers)
+        except Exception as e:
+            log.warning("Almacenamiento del rate limit no disponible", error=str(e))
+            return True
+
+    def shed(self, sender):
+        metrics.incr("webhook_shed")
+
+        # Un solo aviso por remitente y ventana
+        if not self._notified.add(sender):
+            return
+
+        self._ensure_started()
+        try:
+            self._replies.put_nowait(sender)
+        except queue.Full:
+            metrics.incr("webhook_busy_replies_skipped")
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._replies = queue.Queue(maxsize=self.reply_queue_size)
+            self._thread = threading.Thread(target=self._run, name="whatsapp-busy-replies", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            sender = self._replies.get()
+            try:
+                client = get_client()
+                outbound_scheduler.acquire(client.phone_number_id, sender)
+                client.send(build_text_payload(sender, self.reply_text))
+                metrics.incr("webhook_busy_replies")
+            except WhatsAppAPIError as e:
+                metrics.incr("webhook_busy_replies_skipped")
+                log.warning("No se pudo enviar el aviso de sobrecarga", sender=sender, error=str(e))
+            except Exception:
+                metrics.incr("webhook_busy_replies_skipped")
+                log.exception("Error enviando el aviso de sobrecarga", sender=sender)
+
+
+admission_controller = AdmissionController()
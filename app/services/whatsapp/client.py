@@ -0,0 +1,170 @@
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class WhatsAppAPIError(Exception):
+    """Error devuelto por la Graph API (o de red) al enviar un mensaje"""
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class WhatsAppClient:
+    """
+    Cliente HTTP para la Graph API de WhatsApp.
+
+    Mantiene una requests.Session con pool de conexiones keep-alive (evita un
+    handshake TCP+TLS por mensaje), timeouts de conexión/lectura, y reintentos
+    con backoff exponencial con jitter ante 429 y 5xx. La URL y los headers de
+    autenticación se calculan una sola vez.
+    """
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        phone_number_id,
+        access_token,
+        api_version="v20.0",
+        base_url="https://graph.facebook.com",
+        pool_size=20,
+        connect_timeout=3.05,
+        read_timeout=10,
+        max_retries=3,
+        backoff_base=0.5,
+        backoff_max=8
+    ):
+        self.phone_number_id = phone_number_id
+        self.url = f"{base_url.rstrip('/')}/{api_version}/{phone_number_id}/messages"
+        self.headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Callback (phone_number_id, retry_after) invocado ante cada 429
+        self.throttle_listener = None
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def send(self, payload):
+        """Envía un payload (dict) a /messages y devuelve la respuesta JSON"""
+        return self.send_raw(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+    def send_raw(self, body):
+        """
+        Envía un payload ya serializado (bytes).
+        Raises WhatsAppAPIError si la API responde con error tras los reintentos.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(self.url, data=body, timeout=self.timeout)
+            except requests.exceptions.ConnectionError as e:
+                # Solo errores de conexión: el mensaje no llegó a enviarse.
+                # Un timeout de lectura no se reintenta para no duplicar mensajes.
+                if attempt >= self.max_retries:
+                    raise WhatsAppAPIError(f"Error de conexión con WhatsApp API: {e}")
+                self._sleep_backoff(attempt)
+                attempt += 1
+                continue
+            except requests.exceptions.Timeout as e:
+                raise WhatsAppAPIError(f"Timeout con WhatsApp API: {e}")
+
+            if response.status_code < 400:
+                return response.json() if response.content else {}
+
+            retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+
+            if response.status_code == 429 and self.throttle_listener is not None:
+                self.throttle_listener(self.phone_number_id, retry_after)
+
+            if response.status_code in self.RETRY_STATUS and attempt < self.max_retries:
+                self._sleep_backoff(attempt, retry_after)
+                attempt += 1
+                continue
+
+            raise WhatsAppAPIError(
+                f"WhatsApp API error {response.status_code}: {response.text}",
+                status_code=response.status_code,
+                retry_after=retry_after
+            )
+
+    def _sleep_backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            delay = min(retry_after, self.backoff_max)
+        else:
+            # Full jitter: evita que todos los workers reintenten a la vez
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        time.sleep(delay)
+
+
+def _parse_retry_after(value):
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+_client = None
+_client_settings = None
+_client_lock = threading.Lock()
+
+
+def configure_client(app):
+    """
+    Lee de app.config la configuración del cliente de la Graph API y descarta
+    el cliente anterior (se crea de nuevo en el próximo get_client). Se llama
+    en create_app: el cliente se usa desde hilos sin contexto de aplicación
+    (outbox, avisos de sobrecarga), por eso no lee current_app.
+
+    Configuración (app.config):
+    - PHONE_NUMBER_ID, ACCESS_TOKEN: credenciales de la Graph API
+    - WHATSAPP_API_BASE_URL (default "https://graph.facebook.com"; apuntar a
+      tools/graph_stub.py para pruebas locales)
+    - WHATSAPP_API_VERSION (default "v20.0")
+    - WHATSAPP_HTTP_POOL_SIZE (default 20)
+    - WHATSAPP_CONNECT_TIMEOUT / WHATSAPP_READ_TIMEOUT (default 3.05 / 10 s)
+    - WHATSAPP_MAX_RETRIES (default 3)
+    """
+    global _client, _client_settings
+
+    with _client_lock:
+        _client_settings = {
+            "phone_number_id": app.config.get("PHONE_NUMBER_ID"),
+            "access_token": app.config.get("ACCESS_TOKEN"),
+            "api_version": app.config.get("WHATSAPP_API_VERSION", "v20.0"),
+            "base_url": app.config.get("WHATSAPP_API_BASE_URL", "https://graph.facebook.com"),
+            "pool_size": app.config.get("WHATSAPP_HTTP_POOL_SIZE", 20),
+            "connect_timeout": app.config.get("WHATSAPP_CONNECT_TIMEOUT", 3.05),
+            "read_timeout": app.config.get("WHATSAPP_READ_TIMEOUT", 10),
+            "max_retries": app.config.get("WHATSAPP_MAX_RETRIES", 3)
+        }
+        _client = None
+
+
+def get_client():
+    """Devuelve el cliente compartido, creado en el primer uso (ver configure_client)"""
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if _client_settings is None:
+                    raise RuntimeError("Cliente de WhatsApp sin configurar (ver configure_client)")
+                _client = WhatsAppClient(**_client_settings)
+
+    return _client
@@ -0,0 +1,188 @@
+import copy
+import json
+
+from sqlalchemy import Text, cast, func, literal
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+
+from app import db
+from app.models.whatsapp_user import WhatsAppUser
+
+
+class ConversationContext(dict):
+    """
+    Datos temporales de la conversación (WhatsAppUser.temp_data) como dict nativo.
+
+    Se carga una sola vez por mensaje (get_context) y los flujos lo modifican
+    directamente; save_context lo escribe una vez al final del mensaje.
+    En PostgreSQL (columna JSONB) solo se envían las claves que cambiaron:
+        temp_data = (temp_data - claves_eliminadas) || claves_modificadas
+    En otros motores se reescribe el documento completo.
+
+    Los valores antiguos guardados como texto JSON (json.dumps) se leen igual
+    y se reescriben como JSON nativo en el primer guardado.
+    """
+
+    def __init__(self, raw=None):
+        legacy = isinstance(raw, str)
+        if legacy:
+            try:
+                raw = json.loads(raw)
+            except ValueError:
+                raw = {}
+
+        # Copia profunda: los flujos modifican dicts y listas anidados en el
+        # lugar y no deben tocar el valor cargado por el ORM (sin la copia,
+        # la reescritura completa asigna un valor igual al "original" ya
+        # modificado y SQLAlchemy no emite el UPDATE)
+        super().__init__(copy.deepcopy(raw) if isinstance(raw, dict) else {})
+        self._original = copy.deepcopy(dict(self))
+        # Reescritura completa si el valor guardado no era un objeto JSON
+        # (texto antiguo o null): el operador || solo combina objetos
+        self._rewrite = legacy or not isinstance(raw, dict)
+
+    # ============== ACCESOS TIPADOS ==============
+
+    def reset(self, values=None):
+        """Reemplaza todo el contexto (inicio de un flujo)"""
+        self.clear()
+        self.update(values or {})
+
+    @property
+    def previous_flow(self):
+        return self.get("previous_flow")
+
+    @property
+    def previous_step(self):
+        return self.get("previous_step")
+
+    def set_return_point(self, flow, step):
+        """Flujo y paso al que vuelven los subflujos (ubicaciones, conductor)"""
+        self["previous_flow"] = flow
+        self["previous_step"] = step
+
+    @property
+    def pickup_address(self):
+        return self.get("pickup_address")
+
+    @pickup_address.setter
+    def pickup_address(self, address):
+        self["pickup_address"] = address
+
+    @property
+    def delivery_address(self):
+        return self.get("delivery_address")
+
+    @delivery_address.setter
+    def delivery_address(self, address):
+        self["delivery_address"] = address
+
+    def locations(self, location_context):
+        """Lista de ubicaciones del contexto ('ida', 'vuelta', 'general')"""
+        return self.setdefault(f"locations_{location_context}", [])
+
+    @property
+    def locations_ida(self):
+        return self.locations("ida")
+
+    @property
+    def locations_vuelta(self):
+        return self.locations("vuelta")
+
+    def pickup_point(self):
+        """(lat, lng) del punto de recogida: pickup_address o la primera ubicación de ida"""
+        for location in (self.pickup_address, *(self.get("locations_ida") or ())[:1]):
+            if location and location.get("latitude") is not None and location.get("longitude") is not None:
+                return float(location["latitude"]), float(location["longitude"])
+        return None
+
+    @property
+    def current_location(self):
+        return self.setdefault("current_location", {})
+
+    @property
+    def selected_driver_id(self):
+        return self.get("selected_driver_id")
+
+    @property
+    def selected_driver_name(self):
+        return self.get("selected_driver_name")
+
+    @property
+    def driver_candidates(self):
+        """Conductores mostrados en la lista: {"ids": [...], "next": [nombre, id] o None}"""
+        return self.get("driver_candidates")
+
+    @driver_candidates.setter
+    def driver_candidates(self, candidates):
+        self["driver_candidates"] = candidates
+
+    def select_driver(self, driver):
+        self["selected_driver_id"] = driver.id
+        self["selected_driver_name"] = driver.full_name
+        self["selected_driver_vehicle_id"] = driver.vehicle.id if driver.vehicle else None
+        self["selected_driver_phone"] = driver.phone
+
+    # ============== PERSISTENCIA ==============
+
+    def changes(self):
+        """(claves modificadas con su valor, claves eliminadas) desde la carga"""
+        changed = {
+            key: value
+            for key, value in self.items()
+            if key not in self._original or self._original[key] != value
+        }
+        removed = [key for key in self._original if key not in self]
+        return changed, removed
+
+    def save(self, wa_user):
+        changed, removed = self.changes()
+        if not changed and not removed and not self._rewrite:
+            return False
+
+        if not self:
+            wa_user.temp_data = None
+        elif self._rewrite or not _supports_partial_update(wa_user):
+            wa_user.temp_data = copy.deepcopy(dict(self))
+        else:
+            # Actualización parcial: el UPDATE combina el documento guardado con los cambios
+            expression = func.coalesce(WhatsAppUser.temp_data, cast("{}", JSONB))
+            if removed:
+                expression = expression.op("-", return_type=JSONB)(literal(removed, ARRAY(Text)))
+            if changed:
+                expression = expression.op("||", return_type=JSONB)(literal(changed, JSONB))
+            wa_user.temp_data = expression
+
+        self._original = copy.deepcopy(dict(self))
+        self._rewrite = False
+        return True
+
+
+_CONTEXT_ATTR = "_conversation_context"
+
+
+def get_context(wa_user):
+    """Contexto de la conversación, cargado una sola vez por mensaje"""
+    context = wa_user.__dict__.get(_CONTEXT_ATTR)
+    if context is None:
+        context = ConversationContext(wa_user.temp_data)
+        wa_user.__dict__[_CONTEXT_ATTR] = context
+    return context
+
+
+def save_context(wa_user):
+    """Escribe los cambios del contexto (llamar una vez, al terminar el mensaje)"""
+    context = wa_user.__dict__.pop(_CONTEXT_ATTR, None)
+    if context is not None:
+        context.save(wa_user)
+
+
+def discard_context(wa_user):
+    """Descarta el contexto cargado sin guardarlo"""
+    wa_user.__dict__.pop(_CONTEXT_ATTR, None)
+
+
+def _supports_partial_update(wa_user):
+    # Un WhatsAppUser transitorio (caché de estado) guarda el documento completo
+    if wa_user not in db.session:
+        return False
+    return db.session.get_bind(mapper=WhatsAppUser.__mapper__).dialect.name == "postgresql"
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models.processed_message import ProcessedMessage
+from app.services.whatsapp.metrics import metrics
+
+
+class TTLSet:
+    """
+    Conjunto en memoria con expiración (TTL) y tamaño máximo (LRU).
+    Al superar max_entries se descartan los elementos usados hace más tiempo.
+    """
+
+    def __init__(self, ttl_seconds=3600, max_entries=100000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, key):
+        """Agrega la clave. Devuelve False si ya existía y no había expirado."""
+        now = time.monotonic()
+
+        with self._lock:
+            expires_at = self._items.get(key)
+            if expires_at is not None and expires_at > now:
+                self._items.move_to_end(key)
+                return False
+
+            self._items[key] = now + self.ttl_seconds
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+        return True
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+class MessageDeduplicator:
+    """
+    Capa de idempotencia para los mensajes entrantes, basada en el wamid.
+
+    - Camino rápido: TTLSet en memoria (mismo proceso).
+    - Opcional: tabla whatsapp_processed_messages, insertada en la misma
+      transacción que el procesamiento del mensaje, para deduplicar entre
+      workers/procesos. Si el procesamiento falla, el rollback libera el wamid.
+
+    Configuración (app.config):
+    - WHATSAPP_DEDUP_TTL: segundos que se recuerda un wamid (default 86400)
+    - WHATSAPP_DEDUP_MAX_ENTRIES: tamaño máximo en memoria (default 100000)
+    - WHATSAPP_DEDUP_DB: usar la tabla compartida (default True)
+    """
+
+    def __init__(self, ttl_seconds=86400, max_entries=100000, use_db=True):
+        self.ttl_seconds = ttl_seconds
+        self.use_db = use_db
+        self.purge_interval = 600
+        self._seen = TTLSet(ttl_seconds, max_entries)
+        self._last_purge = time.monotonic()
+
+    def init_app(self, app):
+        self.ttl_seconds = app.config.get("WHATSAPP_DEDUP_TTL", self.ttl_seconds)
+        self.use_db = app.config.get("WHATSAPP_DEDUP_DB", self.use_db)
+        self._seen = TTLSet(
+            self.ttl_seconds,
+            app.config.get("WHATSAPP_DEDUP_MAX_ENTRIES", self._seen.max_entries)
+        )
+
+        metrics.register_gauge("dedup_memory_entries", lambda: len(self._seen))
+
+    def claim(self, wamid):
+        """
+        Reserva el wamid para procesarlo.
+        Devuelve False si el mensaje ya fue (o está siendo) procesado.
+        Debe llamarse dentro de un app context.
+        """
+        if not wamid:
+            return True
+
+        if not self._seen.add(wamid):
+            metrics.incr("duplicates_suppressed")
+            metrics.incr("duplicates_suppressed_memory")
+            return False
+
+        if not self.use_db:
+            return True
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(ProcessedMessage(wamid=wamid))
+        except IntegrityError:
+            metrics.incr("duplicates_suppressed")
+            metrics.incr("duplicates_suppressed_db")
+            return False
+
+        self._purge_expired()
+        return True
+
+    def release(self, wamid):
+        """Libera un wamid cuyo procesamiento falló para permitir el reintento"""
+        if wamid:
+            self._seen.discard(wamid)
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl_seconds)
+        ProcessedMessage.query.filter(
+            ProcessedMessage.created_at < cutoff
+        ).delete(synchronize_session=False)
+
+
+message_deduplicator = MessageDeduplicator()
@@ -0,0 +1,305 @@
+import atexit
+import glob
+import gzip
+import heapq
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import inspect as sa_inspect
+
+from app.services.whatsapp.metrics import metrics
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+SEGMENT_PREFIX = "events-"
+SEGMENT_SUFFIX = ".jsonl.gz"
+# Segmento en escritura (se renombra al rotar)
+PARTIAL_SUFFIX = ".part"
+
+
+class ConversationEventLog:
+    """
+    Registro append-only de las conversaciones de WhatsApp.
+
+    Cada mensaje entrante y cada transición de estado se agrega como una línea
+    JSON compacta a un segmento comprimido con gzip:
+
+    - in:    mensaje recibido (wamid, remitente, texto, ubicación)
+    - step:  resultado del mensaje ya confirmado: estado inicial, pasos
+             ejecutados, estado final, diferencia de temp_data (set / del)
+             e ids de los mensajes salientes del outbox
+    - error: el mensaje falló y se revirtió
+
+    La serialización se hace en el hilo que procesa el mensaje; la compresión
+    y la escritura, en un hilo propio con una cola acotada (si se llena, el
+    evento se descarta y se cuenta en event_log_dropped: el registro nunca
+    frena el procesamiento).
+
+    Los segmentos se rotan por tamaño (bytes sin comprimir) o por antigüedad.
+    El nombre incluye la hora de apertura, el pid y un número de secuencia, así
+    varios workers pueden escribir en el mismo directorio. El segmento abierto termina en .part.
+    tools/replay.py vuelve a ejecutar los mensajes registrados.
+
+    Configuración (app.config):
+    - WHATSAPP_EVENT_LOG_DIR: directorio de los segmentos (default None = desactivado)
+    - WHATSAPP_EVENT_LOG_SEGMENT_BYTES: tamaño máximo de un segmento sin comprimir (default 64 MB)
+    - WHATSAPP_EVENT_LOG_SEGMENT_SECONDS: antigüedad máxima de un segmento (default 3600)
+    - WHATSAPP_EVENT_LOG_FLUSH_INTERVAL: segundos sin eventos antes de vaciar el buffer (default 5)
+    - WHATSAPP_EVENT_LOG_QUEUE_SIZE: eventos en espera de escritura (default 10000)
+    """
+
+    def __init__(self, segment_bytes=64 * 1024 * 1024, segment_seconds=3600,
+                 flush_interval=5, queue_size=10000, compresslevel=6):
+        self.directory = None
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.compresslevel = compresslevel
+        # Callback (event) por cada evento registrado (ver tools/replay.py)
+        self.listener = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.directory = app.config.get("WHATSAPP_EVENT_LOG_DIR", self.directory)
+        self.segment_bytes = app.config.get("WHATSAPP_EVENT_LOG_SEGMENT_BYTES", self.segment_bytes)
+        self.segment_seconds = app.config.get("WHATSAPP_EVENT_LOG_SEGMENT_SECONDS", self.segment_seconds)
+        self.flush_interval = app.config.get("WHATSAPP_EVENT_LOG_FLUSH_INTERVAL", self.flush_interval)
+        self.queue_size = app.config.get("WHATSAPP_EVENT_LOG_QUEUE_SIZE", self.queue_size)
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            metrics.register_gauge("event_log_queue_depth", lambda: self._queue.qsize() if self._queue else 0)
+
+    @property
+    def active(self):
+        return bool(self.directory) or self.listener is not None
+
+    # ============== EVENTOS ==============
+
+    def inbound(self, message_id, sender, text, location_data):
+        if not self.active:
+            return
+        self.record({
+            "type": "in",
+            "id": message_id,
+            "from": sender,
+            "text": text,
+            "loc": location_data
+        })
+
+    def transition(self, message_id, sender, result):
+        """Registra el resultado de FlowEngine.process (llamar después del commit)"""
+        if not self.active or result is None:
+            return
+
+        changed, removed = result.changes or ({}, [])
+        self.record({
+            "type": "step",
+            "id": message_id,
+            "from": sender,
+            "start": result.start,
+            "steps": result.steps,
+            "end": result.end,
+            "set": changed,
+            "del": removed,
+            "out": [_row_id(row) for row in result.outbound or ()]
+        })
+
+    def failure(self, message_id, sender, error):
+        if not self.active:
+            return
+        self.record({
+            "type": "error",
+            "id": message_id,
+            "from": sender,
+            "error": f"{type(error).__name__}: {error}"
+        })
+
+    def record(self, event):
+        event["ts"] = round(time.time(), 3)
+
+        if self.listener is not None:
+            self.listener(event)
+
+        if not self.directory:
+            return
+
+        line = json.dumps(event, ensure_ascii=False, separators=(",", ":"), default=str)
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            metrics.incr("event_log_dropped")
+
+    # ============== ESCRITURA ==============
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, name="whatsapp-event-log", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        writer = SegmentWriter(self.directory, self.segment_bytes, self.segment_seconds, self.compresslevel)
+
+        while True:
+            try:
+                line = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                writer.flush()
+                continue
+
+            try:
+                if line is None:
+                    writer.close()
+                    return
+                writer.write(line)
+                metrics.incr("event_log_written")
+            except Exception:
+                metrics.incr("event_log_errors")
+                log.exception("Error escribiendo el registro de eventos")
+            finally:
+                self._queue.task_done()
+
+    def close(self, timeout=5):
+        """Escribe los eventos pendientes y cierra el segmento actual"""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+class SegmentWriter:
+    """Escribe líneas en segmentos gzip rotados por tamaño o antigüedad"""
+
+    def __init__(self, directory, segment_bytes, segment_seconds, compresslevel=6):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.compresslevel = compresslevel
+        self._file = None
+        self._path = None
+        self._opened_at = 0
+        self._written = 0
+        self._sequence = 0
+
+    def write(self, line):
+        if self._file is None or self._should_rotate():
+            self.rotate()
+
+        data = (line + "\n").encode("utf-8")
+        self._file.write(data)
+        self._written += len(data)
+
+    def _should_rotate(self):
+        return (
+            self._written >= self.segment_bytes
+            or time.time() - self._opened_at >= self.segment_seconds
+        )
+
+    def rotate(self):
+        self.close()
+
+        opened_at = datetime.utcnow()
+        self._sequence += 1
+        name = (
+            f"{SEGMENT_PREFIX}{opened_at.strftime('%Y%m%dT%H%M%S')}"
+            f"-{os.getpid()}-{self._sequence:06d}{SEGMENT_SUFFIX}"
+        )
+        self._path = os.path.join(self.directory, name)
+        self._file = gzip.open(self._path + PARTIAL_SUFFIX, "wb", compresslevel=self.compresslevel)
+        self._opened_at = time.time()
+        self._written = 0
+
+    def flush(self):
+        # Z_SYNC_FLUSH: lo escrito hasta aquí se puede leer aunque el proceso muera
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        os.replace(self._path + PARTIAL_SUFFIX, self._path)
+        self._file = None
+
+
+# ============== LECTURA ==============
+
+def list_segments(directory):
+    """Segmentos del directorio (cerrados y abiertos), ordenados por nombre"""
+    paths = glob.glob(os.path.join(directory, f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}"))
+    paths += glob.glob(os.path.join(directory, f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}{PARTIAL_SUFFIX}"))
+    return sorted(paths)
+
+
+def read_segment(path):
+    """Eventos de un segmento; un segmento truncado (proceso caído) se lee hasta donde llegó"""
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+    except (EOFError, OSError):
+        return
+
+
+def read_events(directory, since=None, until=None, types=None):
+    """
+    Eventos de todos los segmentos en orden de ts (mezcla los segmentos de
+    varios workers). since / until: timestamps unix; types: {"in", "step", ...}
+    """
+    streams = [
+        read_segment(path)
+        for path in list_segments(directory)
+        # Un segmento abierto después de until no puede tener eventos anteriores
+        if until is None or _segment_opened_at(path) < until
+    ]
+
+    for event in heapq.merge(*streams, key=lambda event: event.get("ts", 0)):
+        ts = event.get("ts", 0)
+        if since is not None and ts < since:
+            continue
+        if until is not None and ts >= until:
+            continue
+        if types is not None and event.get("type") not in types:
+            continue
+        yield event
+
+
+def _segment_opened_at(path):
+    stamp = os.path.basename(path)[len(SEGMENT_PREFIX):].split("-", 1)[0]
+    try:
+        return (datetime.strptime(stamp, "%Y%m%dT%H%M%S") - datetime(1970, 1, 1)).total_seconds()
+    except ValueError:
+        return 0
+
+
+def _row_id(row):
+    # Después del commit la fila está expirada: leer el id de la identidad evita un SELECT
+    identity = sa_inspect(row).identity
+    return identity[0] if identity else None
+
+
+conversation_log = ConversationEventLog()
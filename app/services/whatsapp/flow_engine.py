@@ -0,0 +1,245 @@
+import time
+from collections import namedtuple
+
+from app import db
+from app.models.traveler import Traveler
+from app.models.whatsapp_user import WhatsAppUser
+from app.services.whatsapp import capture_outbound, enqueue_message
+from app.services.whatsapp.context import get_context, save_context, discard_context
+from app.services.whatsapp.metrics import metrics
+from app.services.whatsapp.sessions import touch_activity
+from app.services.whatsapp.state_cache import conversation_cache
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+_KEEP = object()
+
+
+class Transition(namedtuple("Transition", ["flow", "step", "run"])):
+    """
+    Cambio de estado devuelto por un paso.
+
+    - flow / step: estado destino (flow=_KEEP conserva el flujo actual)
+    - run: ejecutar el paso destino en el mismo mensaje (con texto vacío),
+      p. ej. para mostrar las opciones del flujo al que se entra
+    """
+
+
+def goto(step, run=False):
+    """Pasar a otro paso del mismo flujo"""
+    return Transition(_KEEP, step, run)
+
+
+def switch(flow, step="start", run=False):
+    """Pasar a otro flujo (p. ej. un subflujo de ubicaciones o de conductor)"""
+    return Transition(flow, step, run)
+
+
+def to_menu():
+    """Terminar el flujo actual y volver al menú"""
+    return Transition("menu", None, False)
+
+
+class FlowResult(namedtuple(
+    "FlowResult",
+    ["steps", "messages", "start", "end", "changes", "outbound"],
+    defaults=(None, None, None, None)
+)):
+    """
+    Resultado de un mensaje:
+    - steps: pasos ejecutados [(flow, step), ...]
+    - messages: mensajes generados [(to, body), ...]
+    - start / end: (flow, step) antes y después del mensaje
+    - changes: (claves modificadas de temp_data, claves eliminadas) (solo process)
+    - outbound: filas OutboundMessage agregadas al outbox (solo process)
+    """
+
+
+class Flow:
+    """
+    Tabla de pasos de un flujo de conversación.
+
+    Cada paso es una función (wa_user, data, text, location_data) que lee y
+    modifica el contexto (data) y devuelve una Transition, o None para
+    quedarse en el mismo paso. Los mensajes que envía (send_message, ...) se
+    acumulan y el FlowEngine los agrega al outbox al terminar.
+
+    Uso:
+        parcel_flow = Flow("parcel")
+
+        @parcel_flow.step("title")
+        def ask_description(wa_user, data, text, location_data):
+            ...
+            return goto("description")
+    """
+
+    def __init__(self, name, aliases=()):
+        self.name = name
+        self.aliases = tuple(aliases)
+        self.steps = {}
+        self.default = None
+
+    def step(self, *names):
+        """Registra el handler de uno o varios pasos"""
+        def decorator(handler):
+            for name in names:
+                if name in self.steps:
+                    raise ValueError(f"Paso duplicado en el flujo {self.name}: {name}")
+                self.steps[name] = handler
+            return handler
+        return decorator
+
+    def fallback(self, handler):
+        """Handler para cualquier paso sin entrada en la tabla"""
+        self.default = handler
+        return handler
+
+
+class FlowEngine:
+    """
+    Ejecuta los flujos de conversación de WhatsApp.
+
+    Las tablas de pasos de todos los flujos se compilan en un solo dict
+    (flow, step) -> handler, así el despacho de cada mensaje es una búsqueda
+    O(1) en lugar de las cadenas if/elif por flujo y por paso.
+
+    El motor se encarga de:
+    - cargar el usuario (caché de estado o tabla) y su contexto una vez por mensaje
+    - aplicar las transiciones devueltas por los pasos (y encadenar las que piden run)
+    - guardar el contexto y preparar el estado para el commit del mensaje
+    - agregar al outbox los mensajes generados, en orden
+    - medir la duración de cada paso (timing flow_step.<flujo>.<paso>)
+
+    El commit único del mensaje lo hace process_messages.
+    """
+
+    # Límite de pasos encadenados por mensaje (protege de ciclos entre flujos)
+    MAX_CHAINED_STEPS = 8
+
+    def __init__(self):
+        self.flows = {}
+        self._handlers = {}
+        self._defaults = {}
+
+    def register(self, flow):
+        for name in (flow.name,) + flow.aliases:
+            if name in self.flows:
+                raise ValueError(f"Flujo duplicado: {name}")
+            self.flows[name] = flow
+            self._defaults[name] = flow.default
+            for step, handler in flow.steps.items():
+                self._handlers[(name, step)] = handler
+        return flow
+
+    def process(self, sender, text, location_data):
+        """Procesa un mensaje entrante del remitente (sin commit)"""
+        # Estado de la conversación (desde la caché si está activa)
+        wa_user = conversation_cache.load(sender)
+
+        # 🆕 Usuario nuevo
+        if not wa_user:
+            log.info("Usuario nuevo", sender=sender)
+            wa_user = new_whatsapp_user(sender)
+
+        log.debug("Estado actual", flow=wa_user.flow, step=wa_user.step, traveler_id=wa_user.traveler_id)
+
+        if text is None and location_data is None:
+            return None
+
+        touch_activity(wa_user)
+
+        try:
+            result = self.run(wa_user, text, location_data)
+            changes = get_context(wa_user).changes()
+
+            # 💾 Contexto de la conversación: una sola escritura por mensaje
+            save_context(wa_user)
+            conversation_cache.stage(wa_user)
+        finally:
+            # Si el flujo falló, el próximo mensaje vuelve a leer el contexto de la BD
+            discard_context(wa_user)
+
+        # 📤 Mensajes salientes al outbox, en la misma transacción que el estado
+        outbound = [enqueue_message(to, body) for to, body in result.messages]
+
+        return result._replace(changes=changes, outbound=outbound)
+
+    def run(self, wa_user, text, location_data=None):
+        """
+        Ejecuta el paso actual del usuario (y los encadenados) sin tocar el outbox.
+        Devuelve un FlowResult con los pasos, los mensajes y el estado inicial y final.
+        """
+        data = get_context(wa_user)
+        text = text or ""
+        steps = []
+        start = (wa_user.flow, wa_user.step)
+
+        with capture_outbound() as messages:
+            while True:
+                flow, step = wa_user.flow, wa_user.step
+                handler = self.resolve(flow, step)
+
+                if handler is None:
+                    if flow not in self.flows:
+                        # ❌ Flujo desconocido
+                        log.warning("Flujo desconocido", flow=flow)
+                        wa_user.flow = "menu"
+                    else:
+                        log.warning("Paso sin handler", flow=flow, step=step)
+                    break
+
+                # Alias (None, "Menú", ...): guardar el nombre canónico del flujo
+                flow = self.flows[flow].name
+                wa_user.flow = flow
+
+                steps.append((flow, step))
+                started_at = time.monotonic()
+                transition = handler(wa_user, data, text, location_data)
+                metrics.observe(f"flow_step.{flow}.{step}", time.monotonic() - started_at)
+
+                if transition is None:
+                    break
+
+                if transition.flow is not _KEEP:
+                    wa_user.flow = transition.flow
+                wa_user.step = transition.step
+
+                if not transition.run:
+                    break
+                if len(steps) >= self.MAX_CHAINED_STEPS:
+                    raise RuntimeError(f"Demasiados pasos encadenados: {steps}")
+
+                # Los pasos encadenados no reciben el mensaje original
+                text, location_data = "", None
+
+        return FlowResult(steps, list(messages), start, (wa_user.flow, wa_user.step))
+
+    def resolve(self, flow, step):
+        handler = self._handlers.get((flow, step))
+        if handler is None:
+            handler = self._defaults.get(flow)
+        return handler
+
+
+def new_whatsapp_user(phone):
+    """
+    Crea (sin commit) el estado de conversación de un teléfono nuevo.
+    Si ya hay un viajero registrado con ese teléfono (p. ej. desde la API)
+    se vincula y la conversación empieza en el menú; si no, en el registro.
+    """
+    traveler = Traveler.query.filter_by(phone=phone).first()
+
+    wa_user = WhatsAppUser(
+        phone=phone,
+        traveler_id=traveler.id if traveler else None,
+        flow="menu" if traveler else "registration",
+        step=None if traveler else "start"
+    )
+    db.session.add(wa_user)
+    return wa_user
+
+
+flow_engine = FlowEngine()
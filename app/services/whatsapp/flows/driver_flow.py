@@ -1,210 +1,202 @@
-from app.services.whatsapp import send_confirmation_message, send_message, send_interactive_menu, send_continue_message
-from app import db
+from app.services.whatsapp import send_confirmation_message, send_message, send_continue_message, send_template
+from app.services.whatsapp.payloads import payload_registry, slot, build_buttons_payload
 from app.models.driver import Driver
-import json
+from app.models.enums import DriverStatus
 from app.controllers.driver_controller import DriverService
-from sqlalchemy.orm.attributes import flag_modified
+from app.services.driver_matching import driver_matcher
+from app.services.whatsapp.flow_engine import Flow, goto, switch, to_menu
+from app.utils.log import get_logger
 
 
-def get_temp_data(wa_user):
-    """Helper para deserializar temp_data de forma segura"""
-    if isinstance(wa_user.temp_data, str):
-        try:
-            return json.loads(wa_user.temp_data)
-        except:
-            return {}
-    elif wa_user.temp_data is None:
-        return {}
-    else:
-        return wa_user.temp_data.copy() if isinstance(wa_user.temp_data, dict) else {}
+log = get_logger(__name__)
 
 
-def save_temp_data(wa_user, data):
-    """Helper para guardar temp_data de forma segura"""
-    wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-    flag_modified(wa_user, 'temp_data')
-    db.session.commit()
+# Flujo independiente para selección de conductor
+#
+# Steps:
+# - start: Mostrar opciones (turno o elegir)
+# - choose_option: Procesar opción seleccionada
+# - select_from_list: Mostrar lista de conductores disponibles
+# - confirm_selection: Confirmar conductor seleccionado
+driver_flow = Flow("driver_selection")
 
+# Conductores por página en la lista y respuestas para ver la siguiente
+DRIVER_LIST_PAGE_SIZE = 10
+NEXT_PAGE_WORDS = ("mas", "más", "siguiente", "ver más", "ver mas")
 
-def driver_flow(wa_user, text, ):
-    """
-    Flujo independiente para selección de conductor
-    
-    Steps:
-    - start: Mostrar opciones (turno o elegir)
-    - choose_option: Procesar opción seleccionada
-    - select_from_list: Mostrar lista de conductores disponibles
-    - confirm_selection: Confirmar conductor seleccionado
-    """
+
+# Paso 1: Mostrar opciones iniciales
+@driver_flow.step("start", None, "")
+def start(wa_user, data, text, location_data):
+    log.debug("Mostrando opciones de selección de conductor")
+    return show_driver_selection_options(wa_user)
+
+
+# Paso 2: Usuario eligió una opción
+@driver_flow.step("choose_option")
+def choose_option(wa_user, data, text, location_data):
     text = text.strip()
-    step = wa_user.step
-    
-    print(f"🚗 Driver Flow - Step: {step}, Texto: '{text}'")
-    
-    data = get_temp_data(wa_user)
-    
-    # Paso 1: Mostrar opciones iniciales
-    if step == "start" or not step:
-        print("   → Mostrando opciones de selección")
-        show_driver_selection_options(wa_user)
-        return
-      
-    # Paso 2: Usuario eligió una opción
-    elif step == "choose_option":
-        if text == "1":
-            print("   → Seleccionado: Conductor en turno")
-            assign_driver_on_duty(wa_user)
-            return
-        
-        elif text == "2":
-            print("   → Mostrar lista de conductores")
-            show_available_drivers(wa_user)
-            return
-        
-        else:
-            send_message(
-                wa_user.phone,
-                "❌ Opción no válida.\n\nResponde *1* o *2*"
-            )
-            return
-    
-    # Paso 3: Usuario está seleccionando de la lista
-    elif step == "select_from_list":
-        try:
-            selection = int(text)
-            available_drivers = DriverService.get_all_drivers()
-            
-            if 1 <= selection <= len(available_drivers):
-                selected_driver = available_drivers[selection - 1]
-                confirm_driver_selection(wa_user, selected_driver)
-                return
-            else:
-                send_message(
-                    wa_user.phone,
-                    f"❌ Número inválido.\n\nPor favor elige un número entre 1 y {len(available_drivers)}"
-                )
-                return
-                
-        except ValueError:
-            send_message(
-                wa_user.phone,
-                "❌ Por favor responde con el número del conductor que deseas seleccionar."
-            )
-            return
-    
-    # Paso 4: Confirmar selección
-    elif step == "confirm_selection":
-
-        if text == "confirm_yes":
-            print("   → Usuario confirmó selección")
-            finalize_driver_selection(wa_user)
-            return
-
-        elif text == "confirm_no":
-            print("   → Usuario rechazó, volviendo a opciones")
-            wa_user.step = "start"
-            db.session.commit()
-            show_driver_selection_options(wa_user)
-            return
-
-        else:
+
+    if text == "1":
+        log.debug("Seleccionado: conductor en turno")
+        return assign_driver_on_duty(wa_user, data)
+
+    elif text == "2":
+        log.debug("Mostrando lista de conductores")
+        return show_available_drivers(wa_user, data)
+
+    send_message(
+        wa_user.phone,
+        "❌ Opción no válida.\n\nResponde *1* o *2*"
+    )
+    return None
+
+
+# Paso 3: Usuario está seleccionando de la lista
+@driver_flow.step("select_from_list")
+def select_from_list(wa_user, data, text, location_data):
+    candidates = data.driver_candidates or {}
+    if text.strip().lower() in NEXT_PAGE_WORDS and candidates.get("next"):
+        return show_available_drivers(wa_user, data, after=candidates["next"])
+
+    try:
+        selection = int(text.strip())
+    except ValueError:
+        send_message(
+            wa_user.phone,
+            "❌ Por favor responde con el número del conductor que deseas seleccionar."
+        )
+        return None
+
+    candidate_ids = candidates.get("ids") or []
+
+    if 1 <= selection <= len(candidate_ids):
+        selected_driver = DriverService.get_driver_with_vehicle(candidate_ids[selection - 1])
+
+        if selected_driver is None or selected_driver.status != DriverStatus.AVAILABLE:
             send_message(
                 wa_user.phone,
-                "Por favor usa los botones para confirmar la selección."
+                "❌ Ese conductor ya no está disponible.\n\n"
+                "Por favor elige otro número de la lista."
             )
-            return
+            return None
+
+        return confirm_driver_selection(wa_user, data, selected_driver)
+
+    send_message(
+        wa_user.phone,
+        f"❌ Número inválido.\n\nPor favor elige un número entre 1 y {len(candidate_ids)}"
+    )
+    return None
+
+
+# Paso 4: Confirmar selección
+@driver_flow.step("confirm_selection")
+def confirm_selection(wa_user, data, text, location_data):
+    text = text.strip()
 
+    if text == "confirm_yes":
+        log.debug("Usuario confirmó la selección de conductor")
+        return finalize_driver_selection(wa_user, data)
+
+    elif text == "confirm_no":
+        log.debug("Usuario rechazó la selección, volviendo a opciones")
+        return show_driver_selection_options(wa_user)
+
+    send_message(
+        wa_user.phone,
+        "Por favor usa los botones para confirmar la selección."
+    )
+    return None
+
+
+DRIVER_SELECTION_OPTIONS = payload_registry.register(
+    "driver_selection_options",
+    build_buttons_payload(
+        slot("to"),
+        body="🚗 *Selección de Conductor*\n\n¿Cómo deseas asignar el conductor?",
+        buttons=[
+            {"id": "1", "title": "👤 Conductor en turno"},
+            {"id": "2", "title": "📋 Elegir conductor"}
+        ]
+    )
+)
 
 
 def show_driver_selection_options(wa_user):
     """Muestra las opciones para seleccionar conductor"""
-    try:
-        send_interactive_menu(
-            wa_user.phone,
-            body="🚗 *Selección de Conductor*\n\n¿Cómo deseas asignar el conductor?",
-            buttons=[
-                {"id": "1", "title": "👤 Conductor en turno"},
-                {"id": "2", "title": "📋 Elegir conductor"}
-            ]
-        )
-        print("✅ Opciones de conductor enviadas (botones)")
-        
-    except Exception as e:
-        print(f"❌ Error con botones, usando texto: {e}")
-        send_message(
-            wa_user.phone,
-            "🚗 *Selección de Conductor*\n\n"
-            "¿Cómo deseas asignar el conductor?\n\n"
-            "1️⃣ Conductor en turno (automático)\n"
-            "2️⃣ Elegir conductor de la lista\n\n"
-            "Responde con el número de tu opción."
-        )
+    send_template(wa_user.phone, DRIVER_SELECTION_OPTIONS)
+    log.debug("Opciones de conductor enviadas")
     
-    wa_user.step = "choose_option"
-    db.session.commit()
+    return goto("choose_option")
 
 
-def assign_driver_on_duty(wa_user):
-    """Asigna automáticamente el conductor en turno"""
-    driver = DriverService.get_drivers_by_status("assigned").first()
+def assign_driver_on_duty(wa_user, data):
+    """Asigna automáticamente el conductor disponible más cercano al punto de recogida"""
+    matches = driver_matcher.find_drivers(
+        data.pickup_point(),
+        k=1,
+        min_seats=int(data.get("passenger_count") or 1)
+    )
     
-    if driver:
-        # ✅ FIX: Obtener y guardar datos correctamente
-        data = get_temp_data(wa_user)
-        
-        data["selected_driver_id"] = driver.id
-        data["selected_driver_name"] = driver.full_name
-        data["selected_driver_vehicle_id"] = driver.vehicle.id if driver.vehicle else None
-        data["selected_driver_phone"] = driver.phone
-        
-        # ✅ FIX: Guardar en base de datos
-        save_temp_data(wa_user, data)
+    if matches:
+        driver, distance_km = matches[0]
+        data.select_driver(driver)
         
         vehicle_info = f"{driver.vehicle.make} {driver.vehicle.plate}" if driver.vehicle else "Vehículo no asignado"
+        distance_info = f"📍 A {distance_km:.1f} km de tu punto de recogida\n" if distance_km is not None else ""
         
         message = (
             f"✅ *Conductor asignado automáticamente:*\n\n"
             f"👤 {driver.full_name}\n"
             f"🚗 {vehicle_info}\n"
-            f"📱 {driver.phone}\n\n"
+            f"📱 {driver.phone}\n"
+            f"{distance_info}\n"
             f"Continuando con tu solicitud..."
         )
         
         send_message(wa_user.phone, message)
         
         # ✅ FIX: Regresar al flujo anterior
-        return_to_previous_flow(wa_user)
+        return return_to_previous_flow(wa_user, data)
         
-    else:
-        send_message(
-            wa_user.phone,
-            "❌ No hay conductores disponibles en este momento.\n\n"
-            "Por favor intenta más tarde o escribe *menu* para volver."
-        )
-        wa_user.flow = "menu"
-        wa_user.step = None
-        db.session.commit()
+    send_message(
+        wa_user.phone,
+        "❌ No hay conductores disponibles en este momento.\n\n"
+        "Por favor intenta más tarde o escribe *menu* para volver."
+    )
+    return to_menu()
 
 
-def show_available_drivers(wa_user):
-    """Muestra lista numerada de conductores disponibles"""
-    available_drivers = DriverService.get_all_drivers()
+def show_available_drivers(wa_user, data, after=None):
+    """
+    Muestra una página numerada de conductores disponibles y guarda en el
+    contexto los IDs mostrados: la selección se resuelve contra esa lista
+    aunque la flota cambie mientras el usuario responde.
+    """
+    # Un conductor extra indica si hay página siguiente
+    page = DriverService.get_available_drivers(DRIVER_LIST_PAGE_SIZE + 1, after=after)
+    has_more = len(page) > DRIVER_LIST_PAGE_SIZE
+    page = page[:DRIVER_LIST_PAGE_SIZE]
     
-    if not available_drivers:
+    if not page:
         send_message(
             wa_user.phone,
             "❌ No hay conductores disponibles en este momento.\n\n"
             "Escribe *menu* para volver al menú principal."
         )
-        wa_user.flow = "menu"
-        wa_user.step = None
-        db.session.commit()
-        return
+        return to_menu()
+    
+    last = page[-1]
+    data.driver_candidates = {
+        "ids": [driver.id for driver in page],
+        "next": [last.full_name, last.id] if has_more else None
+    }
     
     # Construir mensaje con lista
     message = "🚗 *Conductores Disponibles*\n\n"
     
-    for i, driver in enumerate(available_drivers, 1):
+    for i, driver in enumerate(page, 1):
         vehicle = f"{driver.vehicle.make} {driver.vehicle.plate}" if driver.vehicle else "Vehículo no asignado"
         
         message += f"{i}. *{driver.full_name}*\n"
@@ -212,22 +204,16 @@ def show_available_drivers(wa_user):
         message += f"   📱 {driver.phone}\n\n"
     
     message += "Responde con el *número* del conductor que deseas seleccionar."
+    if has_more:
+        message += "\n\nEscribe *más* para ver más conductores."
     
     send_message(wa_user.phone, message)
     
-    wa_user.step = "select_from_list"
-    db.session.commit()
+    return goto("select_from_list")
 
 
-def confirm_driver_selection(wa_user, driver):
+def confirm_driver_selection(wa_user, data, driver):
     """Confirma la selección del conductor"""
-    data = get_temp_data(wa_user)
-    
-    data["selected_driver_id"] = driver.id
-    data["selected_driver_name"] = driver.full_name
-    data["selected_driver_vehicle_id"] = driver.vehicle.id if driver.vehicle else None
-    data["selected_driver_phone"] = driver.phone
-    
     vehicle_info = f"{driver.vehicle.make} {driver.vehicle.plate}" if driver.vehicle else "Vehículo no asignado"
     
     message = (
@@ -241,16 +227,15 @@ def confirm_driver_selection(wa_user, driver):
     # 👇 USAR TU SISTEMA REAL DE CONFIRMACIÓN
     send_confirmation_message(wa_user.phone, message)
 
-    save_temp_data(wa_user, data)
+    data.select_driver(driver)
 
-    wa_user.step = "confirm_selection"
-    db.session.commit()
+    return goto("confirm_selection")
 
 
-def finalize_driver_selection(wa_user):
+def finalize_driver_selection(wa_user, data):
     """Finaliza la selección y vuelve al flujo anterior"""
-    data = get_temp_data(wa_user)
-    driver_name = data.get("selected_driver_name", "Conductor")
+    data.pop("driver_candidates", None)
+    driver_name = data.selected_driver_name or "Conductor"
     
     send_message(
         wa_user.phone,
@@ -260,21 +245,15 @@ def finalize_driver_selection(wa_user):
     )
     
     # ✅ FIX: Llamar a return_to_previous_flow
-    return_to_previous_flow(wa_user)
+    return return_to_previous_flow(wa_user, data)
 
 
-def return_to_previous_flow(wa_user):
+def return_to_previous_flow(wa_user, data):
     """Regresa al flujo que invocó la selección de conductor"""
-    data = get_temp_data(wa_user)
-    
-    previous_flow = data.get('previous_flow')
-    previous_step = data.get('previous_step')  # ✅ FIX: Cambiado a 'notes' para parcel_flow
+    previous_flow = data.previous_flow
+    previous_step = data.previous_step
     
-    print(f"   → Regresando a flow: {previous_flow}, step: {previous_step}")
-    
-    wa_user.flow = previous_flow
-    wa_user.step = previous_step
-    db.session.commit()
+    log.debug("Regresando al flujo anterior", flow=previous_flow, step=previous_step)
     
     if previous_flow == "parcel":
         send_continue_message(
@@ -296,4 +275,5 @@ def return_to_previous_flow(wa_user):
                 "¿Tienes alguna nota o instrucción especial?\n\n"
                 "O escribe *skip* para omitir"
             )
-        
\ No newline at end of file
+
+    return switch(previous_flow, previous_step)
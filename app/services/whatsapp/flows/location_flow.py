@@ -1,243 +1,189 @@
-from app import db
 from app.services.whatsapp import send_confirmation_message, send_message
-from sqlalchemy.orm.attributes import flag_modified
-import json
-
-
-def location_flow(wa_user, text=None, location_data=None):
-    """
-    Flujo independiente para capturar ubicaciones (recogida y entrega)
-    
-    Args:
-        wa_user: Usuario de WhatsApp
-        text: Texto del mensaje (para direcciones manuales)
-        location_data: Datos de ubicación compartida desde WhatsApp
-    """
-    step = wa_user.step
-    
-    # Deserializar temp_data
-    if isinstance(wa_user.temp_data, str):
-        try:
-            data = json.loads(wa_user.temp_data)
-        except:
-            data = {}
-    elif wa_user.temp_data is None:
-        data = {}
-    else:
-        data = wa_user.temp_data.copy() if isinstance(wa_user.temp_data, dict) else {}
-    
-    # ---- UBICACIÓN DE RECOGIDA ----
-    if step == "pickup_location":
-        if location_data:
-            # Verificar si name y address están vacíos
-            name = location_data.get("name", "")
-            address = location_data.get("address", "")
-            
-            if not name and not address:
-                # Pedir dirección manual
-                data["pickup_temp"] = {
-                    "latitude": location_data.get("latitude"),
-                    "longitude": location_data.get("longitude")
-                }
-                wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-                wa_user.step = "pickup_location_text"
-                flag_modified(wa_user, 'temp_data')
-                
-                print("📝 Ubicación sin nombre/dirección - Solicitando texto manual")
-                db.session.commit()
-                
-                send_message(
-                    wa_user.phone,
-                    "📍 He recibido la ubicación GPS.\n\n"
-                    "Por favor, escribe la dirección completa de recogida:\n\n"
-                    "Ejemplo: Calle 123 #45-67, Bogotá"
-                )
-                return
-            else:
-                # Guardar ubicación con datos completos
-                location_text = name if name else address
-                if name and address:
-                    location_text = f"{name}, {address}"
-                
-                data["pickup_address"] = {
-                    "address_text": location_text,
-                    "latitude": location_data.get("latitude"),
-                    "longitude": location_data.get("longitude")
-                }
-                
-                wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-                wa_user.flow = "location"
-                wa_user.step = "delivery_location"
-                flag_modified(wa_user, 'temp_data')
-                
-                print("📝 Step PICKUP_LOCATION - Datos guardados:", wa_user.temp_data)
-                db.session.commit()
-                
-                send_message(
-                    wa_user.phone,
-                    f"✅ Ubicación de recogida guardada:\n{location_text}\n\n"
-                    "📍 *Ubicación de Entrega*\n\n"
-                    "Ahora comparte la ubicación donde se entregará el paquete.\n\n"
-                    "📎 Usa el botón de adjuntar → Ubicación"
-                )
-                return
-        else:
-            send_message(
-                wa_user.phone,
-                "❌ Por favor comparte una *ubicación* usando el botón de adjuntar.\n\n"
-                "📎 Adjuntar → Ubicación"
-            )
-            return
-    
-    # ---- TEXTO DE UBICACIÓN DE RECOGIDA ----
-    elif step == "pickup_location_text":
-        if text and text.strip():
-            pickup_temp = data.get("pickup_temp", {})
-            
-            data["pickup_address"] = {
-                "address_text": text.strip(),
-                "latitude": pickup_temp.get("latitude"),
-                "longitude": pickup_temp.get("longitude")
-            }
-            
-            # Limpiar dato temporal
-            if "pickup_temp" in data:
-                del data["pickup_temp"]
-            
-            wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-            wa_user.flow = "location"
-            wa_user.step = "delivery_location"
-            flag_modified(wa_user, 'temp_data')
-            
-            print("📝 Step PICKUP_LOCATION_TEXT - Datos guardados:", wa_user.temp_data)
-            db.session.commit()
-            
-            send_message(
-                wa_user.phone,
-                f"✅ Ubicación de recogida guardada:\n{text.strip()}\n\n"
-                "📍 *Ubicación de Entrega*\n\n"
-                "Ahora comparte la ubicación donde se entregará el paquete.\n\n"
-                "📎 Usa el botón de adjuntar → Ubicación"
-            )
-        else:
-            send_message(
-                wa_user.phone,
-                "❌ Por favor escribe la dirección de recogida.\n\n"
-                "Ejemplo: Calle 123 #45-67, Bogotá"
-            )
-        return
-    
-    # ---- UBICACIÓN DE ENTREGA ----
-    elif step == "delivery_location":
-        
-        if location_data:
-            # Verificar si name y address están vacíos
-            name = location_data.get("name", "")
-            address = location_data.get("address", "")
-            print("🚚 Location Data Received:", location_data)
-            print("🚚 Name:", name, "Address:", address)
-            print("🚚 wa_user.temp_data before processing:", data)
-
-
-
-            if not name and not address:
-                # Pedir dirección manual
-                data["delivery_temp"] = {
-                    "latitude": location_data.get("latitude"),
-                    "longitude": location_data.get("longitude")
-                }
-                wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-                wa_user.step = "delivery_location_text"
-                flag_modified(wa_user, 'temp_data')
-                
-                print("📝 Ubicación sin nombre/dirección - Solicitando texto manual")
-                db.session.commit()
-                
-                send_message(
-                    wa_user.phone,
-                    "📍 He recibido la ubicación GPS.\n\n"
-                    "Por favor, escribe la dirección completa de entrega:\n\n"
-                    "Ejemplo: Carrera 7 #32-16, Bogotá"
-                )
-                return
-            else:
-                # Guardar ubicación con datos completos
-                location_text = name if name else address
-                if name and address:
-                    location_text = f"{name}, {address}"
-                
-                data["delivery_address"] = {
-                    "address_text": location_text,
-                    "latitude": location_data.get("latitude"),
-                    "longitude": location_data.get("longitude")
-                }
-                
-                wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-                wa_user.flow = data.get("previous_flow", "menu")
-                wa_user.step = data.get("previous_step", "")
-                flag_modified(wa_user, 'temp_data')
-                
-                print("📝 Step DELIVERY_LOCATION - Datos guardados:", wa_user.temp_data)
-                db.session.commit()
-                if "previous_flow" in data and data["previous_flow"] == "parcel":
-                    send_message(
-                        wa_user.phone,
-                        "📝 ¿Alguna nota o instrucción especial?\n\n"
-                        "Ejemplo: Contiene alimentos perecederos\n\n"
-                        "O escribe *skip* para omitir"
-                    )
-                elif "previous_flow" in data and data["previous_flow"] == "trip_request":
-                    send_confirmation_message(
-                        wa_user.phone,
-                        message="¿Deseas seleccionar un conductor para el viaje ahora o dejar que los conductores acepten tu solicitud?\n\n"
-                    )
-        else:
-            send_message(
-                wa_user.phone,
-                "❌ Por favor comparte una *ubicación* usando el botón de adjuntar.\n\n"
-                "📎 Adjuntar → Ubicación"
-            )
-            return
-    
-    # ---- TEXTO DE UBICACIÓN DE ENTREGA ----
-    elif step == "delivery_location_text":
-        if text and text.strip():
-            delivery_temp = data.get("delivery_temp", {})
-            
-            data["delivery_address"] = {
-                "address_text": text.strip(),
-                "latitude": delivery_temp.get("latitude"),
-                "longitude": delivery_temp.get("longitude")
-            }
-            
-            # Limpiar dato temporal
-            if "delivery_temp" in data:
-                del data["delivery_temp"]
-            
-            wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-            wa_user.flow = data.get("previous_flow", "menu")
-            wa_user.step = data.get("previous_step", "")
-            flag_modified(wa_user, 'temp_data')
-            
-            print("📝 Step DELIVERY_LOCATION_TEXT - Datos guardados:", wa_user.temp_data)
-            db.session.commit()
-            
-            if "previous_flow" in data and data["previous_flow"] == "parcel":
-                    send_message(
-                        wa_user.phone,
-                        "📝 ¿Alguna nota o instrucción especial?\n\n"
-                        "Ejemplo: Contiene alimentos perecederos\n\n"
-                        "O escribe *skip* para omitir"
-                    )
-            elif "previous_flow" in data and data["previous_flow"] == "trip_request":
-                    send_confirmation_message(
-                        wa_user.phone,
-                        message="¿Deseas seleccionar un conductor para el viaje ahora o dejar que los conductores acepten tu solicitud?\n\n"
-                    )
-        else:
-            send_message(
-                wa_user.phone,
-                "❌ Por favor escribe la dirección de entrega.\n\n"
-                "Ejemplo: Carrera 7 #32-16, Bogotá"
-            )
-        return
\ No newline at end of file
+from app.services.whatsapp.flow_engine import Flow, goto, switch
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Flujo independiente para capturar ubicaciones (recogida y entrega).
+# Al terminar vuelve a data.previous_flow / data.previous_step.
+location_flow = Flow("location")
+
+
+def _location_text(location_data):
+    """Texto de la ubicación compartida, o None si no trae nombre ni dirección"""
+    name = location_data.get("name", "")
+    address = location_data.get("address", "")
+
+    if not name and not address:
+        return None
+
+    location_text = name if name else address
+    if name and address:
+        location_text = f"{name}, {address}"
+    return location_text
+
+
+def _ask_for_location(wa_user):
+    send_message(
+        wa_user.phone,
+        "❌ Por favor comparte una *ubicación* usando el botón de adjuntar.\n\n"
+        "📎 Adjuntar → Ubicación"
+    )
+
+
+def _ask_for_delivery(wa_user, location_text):
+    send_message(
+        wa_user.phone,
+        f"✅ Ubicación de recogida guardada:\n{location_text}\n\n"
+        "📍 *Ubicación de Entrega*\n\n"
+        "Ahora comparte la ubicación donde se entregará el paquete.\n\n"
+        "📎 Usa el botón de adjuntar → Ubicación"
+    )
+
+
+def _return_to_previous_flow(wa_user, data):
+    if data.previous_flow == "parcel":
+        send_message(
+            wa_user.phone,
+            "📝 ¿Alguna nota o instrucción especial?\n\n"
+            "Ejemplo: Contiene alimentos perecederos\n\n"
+            "O escribe *skip* para omitir"
+        )
+    elif data.previous_flow == "trip_request":
+        send_confirmation_message(
+            wa_user.phone,
+            message="¿Deseas seleccionar un conductor para el viaje ahora o dejar que los conductores acepten tu solicitud?\n\n"
+        )
+
+    return switch(data.previous_flow or "menu", data.previous_step or "")
+
+
+# ---- UBICACIÓN DE RECOGIDA ----
+@location_flow.step("pickup_location")
+def pickup_location(wa_user, data, text, location_data):
+    if not location_data:
+        _ask_for_location(wa_user)
+        return None
+
+    location_text = _location_text(location_data)
+
+    if location_text is None:
+        # Pedir dirección manual
+        data["pickup_temp"] = {
+            "latitude": location_data.get("latitude"),
+            "longitude": location_data.get("longitude")
+        }
+
+        log.debug("Ubicación sin nombre/dirección, se solicita texto")
+
+        send_message(
+            wa_user.phone,
+            "📍 He recibido la ubicación GPS.\n\n"
+            "Por favor, escribe la dirección completa de recogida:\n\n"
+            "Ejemplo: Calle 123 #45-67, Bogotá"
+        )
+        return goto("pickup_location_text")
+
+    # Guardar ubicación con datos completos
+    data.pickup_address = {
+        "address_text": location_text,
+        "latitude": location_data.get("latitude"),
+        "longitude": location_data.get("longitude")
+    }
+
+    log.debug("Contexto actualizado", step="pickup_location", keys=sorted(data))
+
+    _ask_for_delivery(wa_user, location_text)
+    return goto("delivery_location")
+
+
+# ---- TEXTO DE UBICACIÓN DE RECOGIDA ----
+@location_flow.step("pickup_location_text")
+def pickup_location_text(wa_user, data, text, location_data):
+    if not text.strip():
+        send_message(
+            wa_user.phone,
+            "❌ Por favor escribe la dirección de recogida.\n\n"
+            "Ejemplo: Calle 123 #45-67, Bogotá"
+        )
+        return None
+
+    pickup_temp = data.pop("pickup_temp", None) or {}
+
+    data.pickup_address = {
+        "address_text": text.strip(),
+        "latitude": pickup_temp.get("latitude"),
+        "longitude": pickup_temp.get("longitude")
+    }
+
+    log.debug("Contexto actualizado", step="pickup_location_text", keys=sorted(data))
+
+    _ask_for_delivery(wa_user, text.strip())
+    return goto("delivery_location")
+
+
+# ---- UBICACIÓN DE ENTREGA ----
+@location_flow.step("delivery_location")
+def delivery_location(wa_user, data, text, location_data):
+    if not location_data:
+        _ask_for_location(wa_user)
+        return None
+
+    log.debug("Ubicación recibida", location=location_data)
+    log.debug("Contexto antes de procesar", keys=sorted(data))
+
+    location_text = _location_text(location_data)
+
+    if location_text is None:
+        # Pedir dirección manual
+        data["delivery_temp"] = {
+            "latitude": location_data.get("latitude"),
+            "longitude": location_data.get("longitude")
+        }
+
+        log.debug("Ubicación sin nombre/dirección, se solicita texto")
+
+        send_message(
+            wa_user.phone,
+            "📍 He recibido la ubicación GPS.\n\n"
+            "Por favor, escribe la dirección completa de entrega:\n\n"
+            "Ejemplo: Carrera 7 #32-16, Bogotá"
+        )
+        return goto("delivery_location_text")
+
+    # Guardar ubicación con datos completos
+    data.delivery_address = {
+        "address_text": location_text,
+        "latitude": location_data.get("latitude"),
+        "longitude": location_data.get("longitude")
+    }
+
+    log.debug("Contexto actualizado", step="delivery_location", keys=sorted(data))
+
+    return _return_to_previous_flow(wa_user, data)
+
+
+# ---- TEXTO DE UBICACIÓN DE ENTREGA ----
+@location_flow.step("delivery_location_text")
+def delivery_location_text(wa_user, data, text, location_data):
+    if not text.strip():
+        send_message(
+            wa_user.phone,
+            "❌ Por favor escribe la dirección de entrega.\n\n"
+            "Ejemplo: Carrera 7 #32-16, Bogotá"
+        )
+        return None
+
+    delivery_temp = data.pop("delivery_temp", None) or {}
+
+    data.delivery_address = {
+        "address_text": text.strip(),
+        "latitude": delivery_temp.get("latitude"),
+        "longitude": delivery_temp.get("longitude")
+    }
+
+    log.debug("Contexto actualizado", step="delivery_location_text", keys=sorted(data))
+
+    return _return_to_previous_flow(wa_user, data)
@@ -1,148 +1,122 @@
-from app.services.whatsapp import send_message
-from app import db
-from app.services.whatsapp.flows.parcel_flow import parcel_flow
-from app.services.whatsapp.flows.one_way_flow import custom_trip_flow
-from app.services.whatsapp.flows.round_flow import round_trip_flow
+from app.services.whatsapp import send_message, send_template
+from app.services.whatsapp.payloads import payload_registry, slot, build_buttons_payload
+from app.services.whatsapp.flow_engine import Flow, switch, to_menu
+from app.utils.log import get_logger
 
-def menu_flow(wa_user, text):
+
+log = get_logger(__name__)
+
+
+menu_flow = Flow("menu", aliases=("Menu", "Menú", None))
+
+
+@menu_flow.fallback
+def handle_menu(wa_user, data, text, location_data):
     text = text.strip()
 
-    print(f"🍔 Menu Flow - Usuario: {wa_user.phone}, Texto: '{text}'")
+    log.debug("Menú", phone=wa_user.phone, text=text)
 
     # Mostrar menú principal
     if not text or text.lower() in ["menu", "hola", "menú", "hi", "hello"]:
-        print("📋 Mostrando menú principal")
+        log.debug("Mostrando menú principal")
         send_menu(wa_user.phone)
-        return
+        return None
 
     # Opción 1: Solicitar viaje
     if text == "1":
-        print("🚕 Opción 1: Solicitud de viaje")
-        wa_user.flow = "trip_request"
-        wa_user.step = "start"
-        db.session.commit()
-        
-        custom_trip_flow(wa_user, "")
-        return
+        log.debug("Opción de menú", option="trip_request")
+        return switch("trip_request", run=True)
 
     # Opción 2: Programar viaje
     elif text == "2":
-            print("🔄 Opción 2: Viaje Round Trip")
-            wa_user.flow = "round_trip"
-            wa_user.step = "start"
-            db.session.commit()
-            
-            round_trip_flow(wa_user, "")
-            return
-        
+        log.debug("Opción de menú", option="round_trip")
+        return switch("round_trip", run=True)
 
     # Opción 3: Encomiendas
     elif text == "3":
-        print("📦 Opción 3: Encomiendas")
-        wa_user.flow = "parcel"
-        wa_user.step = "start"
-        db.session.commit()
-        parcel_flow(wa_user, "")
-        return
+        log.debug("Opción de menú", option="parcel")
+        return switch("parcel", run=True)
 
     # Opción 4: Fletes
     elif text == "4":
-        print("🚚 Opción 4: Fletes")
-        wa_user.flow = "freight"
-        wa_user.step = "start"
-        db.session.commit()
+        log.debug("Opción de menú", option="freight")
         send_message(wa_user.phone, "🚚 *Fletes*\n\nDescribe el tipo de carga.")
-        return
+        return switch("freight")
 
     # "Más opciones" - mostrar segundo menú
     elif text.lower() == "more" or text == "más":
-        print("➕ Mostrando más opciones")
+        log.debug("Mostrando más opciones")
         send_more_menu(wa_user.phone)
-        return
+        return None
 
     # "Volver" - regresar al menú principal
     elif text.lower() == "back" or text == "volver":
-        print("⬅️ Volviendo al menú principal")
+        log.debug("Volviendo al menú principal")
         send_menu(wa_user.phone)
-        return
+        return None
 
     # Opción no válida
     else:
-        print(f"❌ Opción no válida: '{text}'")
+        log.debug("Opción de menú no válida", text=text)
         send_message(
             wa_user.phone,
             "❌ Opción no válida.\n\nEscribe *menu* para ver las opciones disponibles."
         )
-        return
+        return None
+
+
+# 🚚 Fletes (en desarrollo)
+freight_flow = Flow("freight")
+
+
+@freight_flow.fallback
+def handle_freight(wa_user, data, text, location_data):
+    log.debug("Procesando fletes")
+    send_message(wa_user.phone, "🚧 Función en desarrollo\n\nEscribe *menu* para volver al menú principal.")
+    return to_menu()
+
+
+# Menús estáticos: el payload se serializa una sola vez al importar el módulo
+MAIN_MENU = payload_registry.register(
+    "main_menu",
+    build_buttons_payload(
+        slot("to"),
+        body="📋 *Menú Principal*\n\n¿Qué servicio necesitas?",
+        buttons=[
+            {"id": "1", "title": "🚕 Solicitar Viaje ida"},
+            {"id": "2", "title": " 🔄 Solicitar Viaje ida y vuelta"},
+            {"id": "more", "title": "➕ Más opciones"}
+        ]
+    )
+)
+
+MORE_MENU = payload_registry.register(
+    "more_menu",
+    build_buttons_payload(
+        slot("to"),
+        body="📋 *Más Opciones*\n\n¿Qué necesitas?",
+        buttons=[
+            {"id": "3", "title": "📦 Encomiendas"},
+            {"id": "4", "title": "🚚 Fletes"},
+            {"id": "back", "title": "⬅️ Volver"}
+        ]
+    )
+)
 
 
 def send_menu(phone):
     """
     Envía el menú principal con 3 botones (límite de WhatsApp)
     """
-    from app.services.whatsapp import send_interactive_menu
-    
-    print(f"📤 Enviando menú principal a {phone}")
+    log.debug("Enviando menú principal", phone=phone)
     
-    try:
-        send_interactive_menu(
-            phone,
-            body="📋 *Menú Principal*\n\n¿Qué servicio necesitas?",
-            buttons=[
-                {"id": "1", "title": "🚕 Solicitar Viaje ida"},
-                {"id": "2", "title": " 🔄 Solicitar Viaje ida y vuelta"},
-                {"id": "more", "title": "➕ Más opciones"}
-            ]
-        )
-        print("✅ Menú principal enviado")
-        
-    except Exception as e:
-        print(f"❌ Error al enviar menú: {e}")
-        import traceback
-        traceback.print_exc()
-        
-        # Fallback a mensaje de texto
-        send_message(
-            phone,
-            "📋 *Menú Principal*\n\n"
-            "1️⃣ Solicitar viaje\n"
-            "2️⃣ Programar viaje\n"
-            "➕ Escribe *más* para ver más opciones\n\n"
-            "Responde con el número de tu opción."
-        )
+    send_template(phone, MAIN_MENU)
 
 
 def send_more_menu(phone):
     """
     Envía el menú de opciones adicionales
     """
-    from app.services.whatsapp import send_interactive_menu
-    
-    print(f"📤 Enviando menú de más opciones a {phone}")
+    log.debug("Enviando menú de más opciones", phone=phone)
     
-    try:
-        send_interactive_menu(
-            phone,
-            body="📋 *Más Opciones*\n\n¿Qué necesitas?",
-            buttons=[
-                {"id": "3", "title": "📦 Encomiendas"},
-                {"id": "4", "title": "🚚 Fletes"},
-                {"id": "back", "title": "⬅️ Volver"}
-            ]
-        )
-        print("✅ Menú de más opciones enviado")
-        
-    except Exception as e:
-        print(f"❌ Error al enviar menú: {e}")
-        import traceback
-        traceback.print_exc()
-        
-        # Fallback a mensaje de texto
-        send_message(
-            phone,
-            "📋 *Más Opciones*\n\n"
-            "3️⃣ Encomiendas\n"
-            "4️⃣ Fletes\n"
-            "⬅️ Escribe *volver* para el menú principal\n\n"
-            "Responde con el número de tu opción."
-        )
\ No newline at end of file
+    send_template(phone, MORE_MENU)
\ No newline at end of file
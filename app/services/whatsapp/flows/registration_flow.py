@@ -2,190 +2,152 @@ from app.models.user import User
 from app.models.traveler import Traveler
 from app import db
 from app.services.whatsapp import send_message,send_confirmation_message
-from sqlalchemy.orm.attributes import flag_modified
+from app.services.whatsapp.state_cache import conversation_cache
+from app.services.whatsapp.flow_engine import Flow, goto, switch, to_menu
 from app.services.whatsapp.flows.menu_flow import send_menu
 import secrets
-import json
-
-def registration_flow(wa_user, text):
-    step = wa_user.step 
-    
-    # Deserializar temp_data
-    if isinstance(wa_user.temp_data, str):
-        try:
-            data = json.loads(wa_user.temp_data)
-        except:
-            data = {}
-    elif wa_user.temp_data is None:
-        data = {}
-    else:
-        data = wa_user.temp_data.copy() if isinstance(wa_user.temp_data, dict) else {}
-
-    # ---- INICIO ----
-    if step == "start":
-        wa_user.temp_data = "{}"
-        wa_user.step = "name"
-        db.session.commit()
-        
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+registration_flow = Flow("registration")
+
+
+# ---- INICIO ----
+@registration_flow.step("start")
+def start(wa_user, data, text, location_data):
+    data.reset()
+
+    send_message(
+        wa_user.phone,
+        "👋 Bienvenido!\nPara registrarte, dime tu *nombre completo*"
+    )
+    return goto("name")
+
+
+# ---- NOMBRE ----
+@registration_flow.step("name")
+def ask_email(wa_user, data, text, location_data):
+    data["full_name"] = text.strip()
+
+    log.debug("Contexto actualizado", step="name", keys=sorted(data))
+
+    send_message(
+        wa_user.phone,
+        "📧 Ahora dime tu *correo electrónico*"
+    )
+    return goto("email")
+
+
+# ---- EMAIL ----
+@registration_flow.step("email")
+def ask_dni(wa_user, data, text, location_data):
+    data["email"] = text.strip().lower()
+
+    log.debug("Contexto actualizado", step="email", keys=sorted(data))
+
+    send_message(
+        wa_user.phone,
+        "🆔 Ingresa tu *Numero de Identificación*"
+    )
+    return goto("dni")
+
+
+# ---- DNI ----
+@registration_flow.step("dni")
+def ask_confirmation(wa_user, data, text, location_data):
+    data["dni"] = text.strip()
+
+    log.debug("Contexto actualizado", step="dni", keys=sorted(data))
+    message = f"✅ ¿Confirmas tu registro?\n\n"
+    message +=    f"*Nombre:* {data.get('full_name', 'N/A')}\n"
+    message +=    f"*Email:* {data.get('email', 'N/A')}\n"
+    message +=    f"*Numero de Identificación:* {data.get('dni', 'N/A')}\n\n"
+
+    send_confirmation_message(
+        wa_user.phone,
+        message
+    )
+    return goto("confirm")
+
+
+# ---- CONFIRMAR ----
+@registration_flow.step("confirm")
+def confirm(wa_user, data, text, location_data):
+    if text != "confirm_yes":
+        data.clear()
+
         send_message(
             wa_user.phone,
-            "👋 Bienvenido!\nPara registrarte, dime tu *nombre completo*"
+            "❌ Registro cancelado.\nEscribe *Hola* para empezar nuevamente."
         )
-        return
-
-    # ---- NOMBRE ----
-    elif step == "name":
-        data["full_name"] = text.strip()
-        wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-        wa_user.step = "email"
-        flag_modified(wa_user, 'temp_data')
-        
-        print("📝 Step NAME - Datos guardados:", wa_user.temp_data)
-        db.session.commit()
-        
+        return switch(None, None)
+
+    log.debug("Datos finales", keys=sorted(data))
+
+    required_fields = ["full_name", "email", "dni"]
+    missing = [f for f in required_fields if f not in data or not data[f]]
+
+    if missing:
+        log.warning("Faltan campos", missing=missing)
         send_message(
             wa_user.phone,
-            "📧 Ahora dime tu *correo electrónico*"
+            f"❌ Error: Faltan datos ({', '.join(missing)}).\nEmpecemos de nuevo.\nEscribe *Hola*"
         )
-        return
-
-    # ---- EMAIL ----
-    elif step == "email":
-        data["email"] = text.strip().lower()
-        wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-        wa_user.step = "dni"
-        flag_modified(wa_user, 'temp_data')
-        
-        print("📝 Step EMAIL - Datos guardados:", wa_user.temp_data)
-        db.session.commit()
-        
+        data.clear()
+        return switch(None, None)
+
+    password = secrets.token_urlsafe(8)
+
+    try:
+        # Savepoint: si falla la creación del viajero (p. ej. email duplicado)
+        # solo se revierte el registro, no el resto del mensaje
+        with db.session.begin_nested():
+            traveler = Traveler(
+                email=data["email"],
+                role="traveler",
+                full_name=data["full_name"],
+                dni=data["dni"],
+                phone=wa_user.phone
+            )
+
+            traveler.set_password(password)
+
+            log.info("Traveler creado", email=traveler.email, role=traveler.role)
+
+            db.session.add(traveler)
+            db.session.flush()
+
+
+        # ✅ Vincular y resetear ANTES del mensaje (se confirma junto con el viajero)
+        conversation_cache.require_durable(wa_user)
+        wa_user.traveler_id = traveler.id
+        email = data["email"]
+        data.clear()
+
+        log.info("Registro completado", traveler_id=traveler.id)
+
+        # ✅ Enviar mensaje de éxito
         send_message(
             wa_user.phone,
-            "🆔 Ingresa tu *Numero de Identificación*"
+            f"🎉 *Registro exitoso!*\n\n"
+            f"📧 Email: {email}\n"
+            f"🔑 Contraseña temporal: {password}\n\n"
+            f"¡Bienvenido a nuestro servicio!"
         )
-        return
-
-    # ---- DNI ----
-    elif step == "dni":
-        data["dni"] = text.strip()
-        wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-        wa_user.step = "confirm"
-        flag_modified(wa_user, 'temp_data')
-        
-        print("📝 Step DNI - Datos guardados:", wa_user.temp_data)
-        db.session.commit()
-        message = f"✅ ¿Confirmas tu registro?\n\n"
-        message +=    f"*Nombre:* {data.get('full_name', 'N/A')}\n"
-        message +=    f"*Email:* {data.get('email', 'N/A')}\n"
-        message +=    f"*Numero de Identificación:* {data.get('dni', 'N/A')}\n\n"
-        
-        send_confirmation_message(
+
+        # ✅ Mostrar menú (el outbox respeta el orden de envío)
+        send_menu(wa_user.phone)
+        return to_menu()
+
+    except Exception:
+        log.exception("Error en registro completo")
+
+        send_message(
             wa_user.phone,
-            message
+            "❌ Error al registrar. Intenta nuevamente.\nEscribe *Hola*"
         )
-        
-        return
-
-    # ---- CONFIRMAR ----
-    elif step == "confirm":
-        if text == "confirm_yes":
-            db.session.refresh(wa_user)
-            
-            if isinstance(wa_user.temp_data, str):
-                try:
-                    data = json.loads(wa_user.temp_data)
-                except:
-                    data = {}
-            else:
-                data = wa_user.temp_data or {}
-            
-            print("📝 Datos finales RECARGADOS:", data)
-            
-            required_fields = ["full_name", "email", "dni"]
-            missing = [f for f in required_fields if f not in data or not data[f]]
-            
-            if missing:
-                print(f"❌ Faltan campos: {missing}")
-                send_message(
-                    wa_user.phone,
-                    f"❌ Error: Faltan datos ({', '.join(missing)}).\nEmpecemos de nuevo.\nEscribe *Hola*"
-                )
-                wa_user.flow = None
-                wa_user.step = None
-                wa_user.temp_data = None
-                db.session.commit()
-                return
-            
-            password = secrets.token_urlsafe(8)
-            
-            try:
-                traveler = Traveler(
-                    email=data["email"],
-                    role="traveler",
-                    full_name=data["full_name"],
-                    dni=data["dni"],
-                    phone=wa_user.phone
-                )
-                
-                traveler.set_password(password)
-                
-                print(f"✅ Traveler creado - Email: {traveler.email}, Role: {traveler.role}")
-                
-                db.session.add(traveler)
-                db.session.flush()
-                
-                print(f"✅ Traveler ID asignado: {traveler.id}")
-
-                # ✅ Vincular y resetear ANTES del mensaje
-                wa_user.traveler_id = traveler.id
-                wa_user.flow = "menu"
-                wa_user.step = None
-                wa_user.temp_data = None
-                
-                db.session.commit()
-                
-                print(f"✅ Registro completado - Traveler ID: {traveler.id}")
-
-                # ✅ Enviar mensaje de éxito
-                send_message(
-                    wa_user.phone,
-                    f"🎉 *Registro exitoso!*\n\n"
-                    f"📧 Email: {data['email']}\n"
-                    f"🔑 Contraseña temporal: {password}\n\n"
-                    f"¡Bienvenido a nuestro servicio!"
-                )
-                
-                # ✅ Esperar un momento y mostrar menú
-                import time
-                time.sleep(1)  # Pequeña pausa para que los mensajes lleguen en orden
-                
-                from app.services.whatsapp.flows.menu_flow import send_menu
-                send_menu(wa_user.phone)
-                
-            except Exception as e:
-                db.session.rollback()
-                print(f"❌ Error en registro completo: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                
-                send_message(
-                    wa_user.phone,
-                    "❌ Error al registrar. Intenta nuevamente.\nEscribe *Hola*"
-                )
-                wa_user.flow = None
-                wa_user.step = None
-                wa_user.temp_data = None
-                db.session.commit()
-                
-        else:
-            wa_user.flow = None
-            wa_user.step = None
-            wa_user.temp_data = None
-            db.session.commit()
-            
-            send_message(
-                wa_user.phone,
-                "❌ Registro cancelado.\nEscribe *Hola* para empezar nuevamente."
-            )
-        
-        return
\ No newline at end of file
+        data.clear()
+        return switch(None, None)
@@ -1,303 +1,237 @@
-from app import db
 from app.services.whatsapp import (
     send_message, 
     send_confirmation_message,
-    send_interactive_menu,
     add_hours_to_now
 )
-from sqlalchemy.orm.attributes import flag_modified
+from app.services.whatsapp.flow_engine import Flow, goto, switch, to_menu
+from app.services.whatsapp.state_cache import conversation_cache
 from app.controllers.custom_trip_controller import CustomTripController
-import json
 from datetime import datetime
+from app.utils.log import get_logger
 
 
-def round_trip_flow(wa_user, text):
-    """
-    Flujo para crear viajes de ida y vuelta (Round Trip) desde WhatsApp
-    
-    Steps:
-    - start: Inicializar
-    - outbound_locations: Ubicaciones de ida (delega a location_manager_flow)
-    - return_locations_choice: ¿Reutilizar ubicaciones de ida?
-    - return_locations: Ubicaciones de vuelta (si no reutiliza)
-    - select_driver: Selección de conductor
-    - confirm_driver_selection: Confirmar selección de conductor
-    - notes: Notas adicionales
-    - requires_wait: ¿Requiere espera?
-    - wait_time: Tiempo de espera (si requiere)
-    - summary: Resumen
-    - confirm: Confirmación final
-    
-    Args:
-        wa_user: Usuario de WhatsApp
-        text: Texto del mensaje
-    """
-    step = wa_user.step
-    
-    # Deserializar temp_data
-    if isinstance(wa_user.temp_data, str):
-        try:
-            data = json.loads(wa_user.temp_data)
-        except:
-            data = {}
-    elif wa_user.temp_data is None:
-        data = {}
-    else:
-        data = wa_user.temp_data.copy() if isinstance(wa_user.temp_data, dict) else {}
-    
-    print(f"🔄 Round Trip Flow - Step: {step}, Text: '{text}'")
-    
-    # ---- INICIO ----
-    if step == "start":
-        wa_user.temp_data = json.dumps({
-            "custom_trip_type": "round",
-            "passenger_count": 1,
-            "requires_wait": False,
-            "reuse_outbound_locations": False
-        }, ensure_ascii=False)
-        wa_user.step = "outbound_locations"
-        db.session.commit()
-        
+log = get_logger(__name__)
+
+
+# Flujo para crear viajes de ida y vuelta (Round Trip) desde WhatsApp
+#
+# Steps:
+# - start: Inicializar
+# - outbound_locations: Ubicaciones de ida (delega a multilocation_flow)
+# - return_locations_choice: ¿Reutilizar ubicaciones de ida?
+# - return_locations: Ubicaciones de vuelta (si no reutiliza)
+# - select_driver: Selección de conductor
+# - confirm_driver_selection: Confirmar selección de conductor
+# - notes: Notas adicionales
+# - requires_wait: ¿Requiere espera?
+# - wait_time: Tiempo de espera (si requiere)
+# - summary: Resumen
+# - confirm: Confirmación final
+round_trip_flow = Flow("round_trip")
+
+
+# ---- INICIO ----
+@round_trip_flow.step("start")
+def start(wa_user, data, text, location_data):
+    data.reset({
+        "custom_trip_type": "round",
+        "passenger_count": 1,
+        "requires_wait": False,
+        "reuse_outbound_locations": False
+    })
+
+    send_message(
+        wa_user.phone,
+        "🔄 *Viaje de Ida y Vuelta*\n\n"
+        "Vamos a configurar las ubicaciones de tu viaje.\n\n"
+        "Primero, configuremos las *ubicaciones de IDA*."
+    )
+
+    # Iniciar flujo de ubicaciones para IDA
+    return start_location_manager(data, context='ida', next_step='return_locations_choice')
+
+
+# ---- UBICACIONES DE IDA (manejado por multilocation_flow) ----
+# Este paso se activa cuando multilocation_flow termina
+
+# ---- ELEGIR UBICACIONES DE VUELTA ----
+@round_trip_flow.step("return_locations_choice")
+def return_locations_choice(wa_user, data, text, location_data):
+    send_confirmation_message(
+        wa_user.phone,
+        "✅ Ubicaciones de ida configuradas.\n\n"
+        "Para las ubicaciones de VUELTA:\n\n"
+        "¿Deseas usar las mismas ubicaciones de ida pero en orden inverso?"
+    )
+    return goto("process_return_choice")
+
+
+# ---- PROCESAR ELECCIÓN DE VUELTA ----
+@round_trip_flow.step("process_return_choice")
+def process_return_choice(wa_user, data, text, location_data):
+    if text == "confirm_yes":
+        # Reutilizar ubicaciones de ida (invertidas)
+        data['reuse_outbound_locations'] = True
+
         send_message(
             wa_user.phone,
-            "🔄 *Viaje de Ida y Vuelta*\n\n"
-            "Vamos a configurar las ubicaciones de tu viaje.\n\n"
-            "Primero, configuremos las *ubicaciones de IDA*."
+            "✅ Se usarán las mismas ubicaciones en orden inverso para la vuelta."
         )
-        
-        # Iniciar flujo de ubicaciones para IDA
-        start_location_manager(wa_user, context='ida', next_step='return_locations_choice')
-        return
-    
-    # ---- UBICACIONES DE IDA (manejado por location_manager_flow) ----
-    # Este paso se activa cuando location_manager_flow termina
-    
-    # ---- ELEGIR UBICACIONES DE VUELTA ----
-    elif step == "return_locations_choice":
-        send_confirmation_message(
+
+        # Continuar con selección de conductor
+        return ask_driver_selection(wa_user)
+
+    elif text == "confirm_no":
+        # Configurar ubicaciones diferentes para vuelta
+        data['reuse_outbound_locations'] = False
+
+        send_message(
             wa_user.phone,
-            "✅ Ubicaciones de ida configuradas.\n\n"
-            "Para las ubicaciones de VUELTA:\n\n"
-            "¿Deseas usar las mismas ubicaciones de ida pero en orden inverso?"
+            "Ahora configuremos las *ubicaciones de VUELTA*."
         )
-        wa_user.step = "process_return_choice"
-        db.session.commit()
-        return
-    
-    # ---- PROCESAR ELECCIÓN DE VUELTA ----
-    elif step == "process_return_choice":
-        if text == "confirm_yes":
-            # Reutilizar ubicaciones de ida (invertidas)
-            data['reuse_outbound_locations'] = True
-            
-            wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-            wa_user.step = "select_driver"
-            flag_modified(wa_user, 'temp_data')
-            db.session.commit()
-            
-            send_message(
-                wa_user.phone,
-                "✅ Se usarán las mismas ubicaciones en orden inverso para la vuelta."
-            )
-            
-            # Continuar con selección de conductor
-            ask_driver_selection(wa_user)
-            return
-        
-        elif text == "confirm_no":
-            # Configurar ubicaciones diferentes para vuelta
-            data['reuse_outbound_locations'] = False
-            
-            wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-            wa_user.step = "return_locations"
-            flag_modified(wa_user, 'temp_data')
-            db.session.commit()
-            
-            send_message(
-                wa_user.phone,
-                "Ahora configuremos las *ubicaciones de VUELTA*."
-            )
-            
-            # Iniciar flujo de ubicaciones para VUELTA
-            start_location_manager(wa_user, context='vuelta', next_step='select_driver')
-            return
-        
-        else:
-            send_message(
-                wa_user.phone,
-                "Por favor usa los botones para responder."
-            )
-            return
-    
-    # ---- UBICACIONES DE VUELTA (manejado por location_manager_flow) ----
-    # Este paso se activa cuando location_manager_flow termina con vuelta
-    
-    # ---- SELECCIÓN DE CONDUCTOR ----
-    elif step == "select_driver":
-        ask_driver_selection(wa_user)
-        return
-    
-    # ---- CONFIRMAR SELECCIÓN DE CONDUCTOR ----
-    elif step == "confirm_driver_selection":
-        from app.services.whatsapp.flows.driver_flow import driver_flow
-        
-        if text == "confirm_yes":
-            data['previous_flow'] = "round_trip"
-            data['previous_step'] = "notes"
-            
-            wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-            wa_user.flow = "driver_selection"
-            wa_user.step = "start"
-            flag_modified(wa_user, 'temp_data')
-            db.session.commit()
-            
-            driver_flow(wa_user, "")
-        
-        elif text == "confirm_no":
-            wa_user.step = "notes"
-            db.session.commit()
-            
-            send_message(
-                wa_user.phone,
-                "📝 *Notas Adicionales*\n\n"
-                "¿Tienes alguna nota o instrucción especial?\n\n"
-                "O escribe *skip* para omitir"
-            )
-        
-        return
-    
-    # ---- NOTAS ----
-    elif step == "notes":
-        if text.lower().strip() != "skip":
-            data['notes'] = text.strip()
-        
-        wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-        wa_user.step = "requires_wait"
-        flag_modified(wa_user, 'temp_data')
-        db.session.commit()
-        
-        send_confirmation_message(
+
+        # Iniciar flujo de ubicaciones para VUELTA
+        return start_location_manager(data, context='vuelta', next_step='select_driver')
+
+    send_message(
+        wa_user.phone,
+        "Por favor usa los botones para responder."
+    )
+    return None
+
+
+# ---- UBICACIONES DE VUELTA (manejado por multilocation_flow) ----
+# Este paso se activa cuando multilocation_flow termina con vuelta
+
+# ---- SELECCIÓN DE CONDUCTOR ----
+@round_trip_flow.step("select_driver")
+def select_driver(wa_user, data, text, location_data):
+    return ask_driver_selection(wa_user)
+
+
+# ---- CONFIRMAR SELECCIÓN DE CONDUCTOR ----
+@round_trip_flow.step("confirm_driver_selection")
+def confirm_driver_selection(wa_user, data, text, location_data):
+    if text == "confirm_yes":
+        data.set_return_point("round_trip", "notes")
+        return switch("driver_selection", "start", run=True)
+
+    elif text == "confirm_no":
+        send_message(
             wa_user.phone,
-            "⏱️ ¿Requieres que el conductor espere en el destino antes de iniciar la vuelta?"
+            "📝 *Notas Adicionales*\n\n"
+            "¿Tienes alguna nota o instrucción especial?\n\n"
+            "O escribe *skip* para omitir"
         )
-        return
-    
-    # ---- ¿REQUIERE ESPERA? ----
-    elif step == "requires_wait":
-        if text == "confirm_yes":
-            data['requires_wait'] = True
-            
-            wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-            wa_user.step = "wait_time"
-            flag_modified(wa_user, 'temp_data')
-            db.session.commit()
-            
-            send_message(
-                wa_user.phone,
-                "⏱️ *Tiempo de Espera*\n\n"
-                "¿Cuántos minutos necesitas que el conductor espere?\n\n"
-                "Ejemplo: 30"
-            )
-            return
-        
-        elif text == "confirm_no":
-            data['requires_wait'] = False
-            data['wait_time_minutes'] = None
-            
-            # Configurar precio y tiempos
-            configure_trip_pricing(data)
-            
-            wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-            wa_user.step = "summary"
-            flag_modified(wa_user, 'temp_data')
-            db.session.commit()
-            
-            show_trip_summary(wa_user, data)
-            return
-        
-        else:
-            send_message(
-                wa_user.phone,
-                "Por favor usa los botones para responder."
-            )
-            return
-    
-    # ---- TIEMPO DE ESPERA ----
-    elif step == "wait_time":
-        try:
-            wait_minutes = int(text.strip())
-            
-            if wait_minutes < 0:
-                send_message(
-                    wa_user.phone,
-                    "❌ El tiempo de espera no puede ser negativo.\n\n"
-                    "Por favor ingresa un número válido de minutos."
-                )
-                return
-            
-            data['wait_time_minutes'] = wait_minutes
-            
-            # Configurar precio y tiempos
-            configure_trip_pricing(data)
-            
-            wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-            wa_user.step = "summary"
-            flag_modified(wa_user, 'temp_data')
-            db.session.commit()
-            
-            show_trip_summary(wa_user, data)
-            return
-            
-        except ValueError:
-            send_message(
-                wa_user.phone,
-                "❌ Por favor ingresa un número válido de minutos.\n\n"
-                "Ejemplo: 30"
-            )
-            return
-    
-    # ---- RESUMEN ----
-    elif step == "summary":
-        show_trip_summary(wa_user, data)
-        return
-    
-    # ---- CONFIRMAR ----
-    elif step == "confirm":
-        if text == "confirm_yes":
-            create_round_trip(wa_user, data)
-        
-        elif text == "confirm_no":
-            wa_user.flow = "menu"
-            wa_user.step = None
-            wa_user.temp_data = None
-            db.session.commit()
-            
-            send_message(
-                wa_user.phone,
-                "❌ Viaje cancelado.\n\nEscribe *menu* para volver al menú."
-            )
-        
-        return
+        return goto("notes")
+
+    return None
+
+
+# ---- NOTAS ----
+@round_trip_flow.step("notes")
+def notes(wa_user, data, text, location_data):
+    if text.lower().strip() != "skip":
+        data['notes'] = text.strip()
+
+    send_confirmation_message(
+        wa_user.phone,
+        "⏱️ ¿Requieres que el conductor espere en el destino antes de iniciar la vuelta?"
+    )
+    return goto("requires_wait")
+
+
+# ---- ¿REQUIERE ESPERA? ----
+@round_trip_flow.step("requires_wait")
+def requires_wait(wa_user, data, text, location_data):
+    if text == "confirm_yes":
+        data['requires_wait'] = True
+
+        send_message(
+            wa_user.phone,
+            "⏱️ *Tiempo de Espera*\n\n"
+            "¿Cuántos minutos necesitas que el conductor espere?\n\n"
+            "Ejemplo: 30"
+        )
+        return goto("wait_time")
+
+    elif text == "confirm_no":
+        data['requires_wait'] = False
+        data['wait_time_minutes'] = None
+
+        # Configurar precio y tiempos
+        configure_trip_pricing(data)
+
+        return show_trip_summary(wa_user, data)
+
+    send_message(
+        wa_user.phone,
+        "Por favor usa los botones para responder."
+    )
+    return None
+
+
+# ---- TIEMPO DE ESPERA ----
+@round_trip_flow.step("wait_time")
+def wait_time(wa_user, data, text, location_data):
+    try:
+        wait_minutes = int(text.strip())
+    except ValueError:
+        send_message(
+            wa_user.phone,
+            "❌ Por favor ingresa un número válido de minutos.\n\n"
+            "Ejemplo: 30"
+        )
+        return None
+
+    if wait_minutes < 0:
+        send_message(
+            wa_user.phone,
+            "❌ El tiempo de espera no puede ser negativo.\n\n"
+            "Por favor ingresa un número válido de minutos."
+        )
+        return None
+
+    data['wait_time_minutes'] = wait_minutes
+
+    # Configurar precio y tiempos
+    configure_trip_pricing(data)
+
+    return show_trip_summary(wa_user, data)
+
+
+# ---- RESUMEN ----
+@round_trip_flow.step("summary")
+def show_summary(wa_user, data, text, location_data):
+    return show_trip_summary(wa_user, data)
+
+
+# ---- CONFIRMAR ----
+@round_trip_flow.step("confirm")
+def confirm(wa_user, data, text, location_data):
+    if text == "confirm_yes":
+        return create_round_trip(wa_user, data)
+
+    elif text == "confirm_no":
+        data.clear()
+
+        send_message(
+            wa_user.phone,
+            "❌ Viaje cancelado.\n\nEscribe *menu* para volver al menú."
+        )
+        return to_menu()
+
+    return None
 
 
 # ============== FUNCIONES AUXILIARES ==============
 
-def start_location_manager(wa_user, context='general', next_step='summary'):
+def start_location_manager(data, context='general', next_step='summary'):
     """Inicia el flujo de gestión de ubicaciones"""
-    data = json.loads(wa_user.temp_data) if isinstance(wa_user.temp_data, str) else wa_user.temp_data or {}
-    
     data['location_context'] = context
-    data['previous_flow'] = 'round_trip'
-    data['previous_step'] = next_step
-    
-    wa_user.temp_data = json.dumps(data, ensure_ascii=False)
-    wa_user.flow = "multilocation"
-    wa_user.step = "start"
-    flag_modified(wa_user, 'temp_data')
-    db.session.commit()
-    
-    from app.services.whatsapp.flows.multilocation_flow import multilocation_flow
-    multilocation_flow(wa_user, "")
+    data.set_return_point('round_trip', next_step)
+
+    return switch("multilocation", "start", run=True)
 
 
 def ask_driver_selection(wa_user):
@@ -306,8 +240,7 @@ def ask_driver_selection(wa_user):
         wa_user.phone,
         "¿Deseas seleccionar un conductor para el viaje ahora o dejar que los conductores acepten tu solicitud?"
     )
-    wa_user.step = "confirm_driver_selection"
-    db.session.commit()
+    return goto("confirm_driver_selection")
 
 
 def configure_trip_pricing(data):
@@ -342,7 +275,7 @@ def show_trip_summary(wa_user, data):
     summary += f"*Precio:* ${data.get('price', 0):,.0f}\n"
     
     # Ubicaciones de ida
-    locations_ida = data.get('locations_ida', [])
+    locations_ida = data.locations_ida
     summary += f"\n📍 *Ubicaciones de IDA ({len(locations_ida)}):*\n"
     for i, loc in enumerate(locations_ida, 1):
         type_icon = {"pickup": "📍", "delivery": "🎯", "waypoint": "⏸️"}.get(loc['type'], '📍')
@@ -353,7 +286,7 @@ def show_trip_summary(wa_user, data):
         summary += f"\n📍 *Ubicaciones de VUELTA:*\n"
         summary += f"↩️ Mismas ubicaciones en orden inverso\n"
     else:
-        locations_vuelta = data.get('locations_vuelta', [])
+        locations_vuelta = data.locations_vuelta
         summary += f"\n📍 *Ubicaciones de VUELTA ({len(locations_vuelta)}):*\n"
         for i, loc in enumerate(locations_vuelta, 1):
             type_icon = {"pickup": "📍", "delivery": "🎯", "waypoint": "⏸️"}.get(loc['type'], '📍')
@@ -385,8 +318,7 @@ def show_trip_summary(wa_user, data):
     summary += f"\n¿Confirmas el viaje?\n\n"
     
     send_confirmation_message(wa_user.phone, summary)
-    wa_user.step = "confirm"
-    db.session.commit()
+    return goto("confirm")
 
 
 def create_round_trip(wa_user, data):
@@ -396,17 +328,11 @@ def create_round_trip(wa_user, data):
         trip_data = prepare_round_trip_data(data)
         
         # Llamar al servicio de creación
-        response = CustomTripController.create_custom_trip_service(trip_data)
+        response = CustomTripController.create_custom_trip_service(trip_data, commit=False)
         
         if response["success"]:
             trip_info = response["data"]
             
-            # Resetear flujo
-            wa_user.flow = "menu"
-            wa_user.step = None
-            wa_user.temp_data = None
-            db.session.commit()
-            
             # Mensaje de éxito
             success_msg = "🎉 *¡Viaje de Ida y Vuelta Creado!*\n\n"
             success_msg += f"📊 *ID:* {trip_info.get('id')}\n"
@@ -418,37 +344,30 @@ def create_round_trip(wa_user, data):
             
             # Volver al menú
             from app.services.whatsapp.flows.menu_flow import send_menu
-            import time
-            time.sleep(1)
             send_menu(wa_user.phone)
             
-        else:
-            error_msg = response.get("error", "Error desconocido")
-            send_message(
-                wa_user.phone,
-                f"❌ Error al crear el viaje:\n{error_msg}\n\n"
-                f"Intenta nuevamente. Escribe *menu*"
-            )
+            # Resetear flujo (se confirma junto con el viaje)
+            conversation_cache.require_durable(wa_user)
+            data.clear()
+            return to_menu()
             
-            wa_user.flow = "menu"
-            wa_user.step = None
-            wa_user.temp_data = None
-            db.session.commit()
+        error_msg = response.get("error", "Error desconocido")
+        send_message(
+            wa_user.phone,
+            f"❌ Error al crear el viaje:\n{error_msg}\n\n"
+            f"Intenta nuevamente. Escribe *menu*"
+        )
             
-    except Exception as e:
-        db.session.rollback()
-        print(f"❌ Error en creación de Round Trip: {str(e)}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("Error en creación de Round Trip")
         
         send_message(
             wa_user.phone,
             "❌ Error al crear el viaje. Intenta nuevamente.\nEscribe *menu*"
         )
-        wa_user.flow = "menu"
-        wa_user.step = None
-        wa_user.temp_data = None
-        db.session.commit()
+
+    data.clear()
+    return to_menu()
 
 
 def prepare_round_trip_data(data):
@@ -456,7 +375,7 @@ def prepare_round_trip_data(data):
     addresses = []
     
     # Ubicaciones de ida (order 1-99)
-    locations_ida = data.get('locations_ida', [])
+    locations_ida = data.locations_ida
     for i, loc in enumerate(locations_ida, 1):
         addresses.append({
             "address_text": loc.get("address_text"),
@@ -466,20 +385,12 @@ def prepare_round_trip_data(data):
             "order": i
         })
     
-    # Ubicaciones de vuelta (order 100+)
-    if data.get('reuse_outbound_locations'):
-        # Invertir orden de ubicaciones de ida
-        for i, loc in enumerate(reversed(locations_ida), 1):
-            addresses.append({
-                "address_text": loc.get("address_text"),
-                "latitude": loc.get("latitude"),
-                "longitude": loc.get("longitude"),
-                "type": loc.get("type", "waypoint"),
-                "order": 100 + i
-            })
-    else:
+    # Ubicaciones de vuelta (order 100+). Si se reutilizan las de ida, la
+    # vuelta queda implícita (RoundTrip: origen y destino, con
+    # reuse_outbound_locations): repetirlas invertidas haría fallar validate()
+    if not data.get('reuse_outbound_locations'):
         # Usar ubicaciones de vuelta específicas
-        locations_vuelta = data.get('locations_vuelta', [])
+        locations_vuelta = data.locations_vuelta
         for i, loc in enumerate(locations_vuelta, 1):
             addresses.append({
                 "address_text": loc.get("address_text"),
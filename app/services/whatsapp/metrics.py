@@ -0,0 +1,171 @@
+import threading
+from collections import defaultdict, deque
+
+
+class Metrics:
+    """
+    Registro en memoria de métricas del bot de WhatsApp.
+
+    - Contadores: eventos acumulados (mensajes procesados, rechazados, ...)
+    - Gauges: valores instantáneos calculados al leer (profundidad de cola, ...)
+    - Tiempos: latencias en segundos con conteo, suma, máximo y percentiles
+      calculados sobre una ventana de las últimas muestras.
+    - Distribuciones: igual que los tiempos, para valores sin unidad
+      (consultas SQL por mensaje, envíos por mensaje, ...).
+    """
+
+    def __init__(self, reservoir_size=2048):
+        self._lock = threading.Lock()
+        self._reservoir_size = reservoir_size
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._timings = {}
+        self._distributions = {}
+
+    def init_app(self, app):
+        """
+        Configuración (app.config):
+        - WHATSAPP_QUERY_METRICS: contar las consultas SQL por hilo (default True)
+        """
+        if app.config.get("WHATSAPP_QUERY_METRICS", True):
+            thread_counters.count_queries()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def register_gauge(self, name, fn):
+        """Registra una función sin argumentos que devuelve el valor actual"""
+        with self._lock:
+            self._gauges[name] = fn
+
+    def observe(self, name, seconds):
+        self._sample(self._timings, name, seconds)
+
+    def observe_value(self, name, value):
+        self._sample(self._distributions, name, value)
+
+    def _sample(self, store, name, value):
+        with self._lock:
+            series = store.get(name)
+            if series is None:
+                series = {
+                    "count": 0,
+                    "sum": 0.0,
+                    "max": 0.0,
+                    "samples": deque(maxlen=self._reservoir_size)
+                }
+                store[name] = series
+
+            series["count"] += 1
+            series["sum"] += value
+            if value > series["max"]:
+                series["max"] = value
+            series["samples"].append(value)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timings = {
+                name: (t["count"], t["sum"], t["max"], sorted(t["samples"]))
+                for name, t in self._timings.items()
+            }
+            distributions = {
+                name: (d["count"], d["sum"], d["max"], sorted(d["samples"]))
+                for name, d in self._distributions.items()
+            }
+
+        gauge_values = {}
+        for name, fn in gauges.items():
+            try:
+                gauge_values[name] = fn()
+            except Exception:
+                gauge_values[name] = None
+
+        timing_values = {}
+        for name, (count, total, maximum, samples) in timings.items():
+            timing_values[name] = {
+                "count": count,
+                "avg_ms": round(total / count * 1000, 3) if count else 0,
+                "p50_ms": round(_percentile(samples, 50) * 1000, 3),
+                "p99_ms": round(_percentile(samples, 99) * 1000, 3),
+                "max_ms": round(maximum * 1000, 3)
+            }
+
+        distribution_values = {}
+        for name, (count, total, maximum, samples) in distributions.items():
+            distribution_values[name] = {
+                "count": count,
+                "avg": round(total / count, 3) if count else 0,
+                "p50": _percentile(samples, 50),
+                "p99": _percentile(samples, 99),
+                "max": maximum
+            }
+
+        return {
+            "counters": counters,
+            "gauges": gauge_values,
+            "timings": timing_values,
+            "distributions": distribution_values
+        }
+
+
+class ThreadCounters:
+    """
+    Contadores por hilo, para medir el costo de procesar un mensaje
+    (cada shard procesa sus mensajes en un solo hilo).
+
+    Uso:
+        before = thread_counters.values()
+        ...
+        used = thread_counters.since(before)  # {"db_queries": 7, ...}
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._queries_hooked = False
+
+    def incr(self, name, value=1):
+        counters = getattr(self._local, "counters", None)
+        if counters is None:
+            counters = self._local.counters = defaultdict(int)
+        counters[name] += value
+
+    def values(self):
+        return dict(getattr(self._local, "counters", None) or {})
+
+    def since(self, before):
+        return {
+            name: value - before.get(name, 0)
+            for name, value in self.values().items()
+        }
+
+    def count_queries(self):
+        """Cuenta las sentencias SQL (db_queries) y los commits (db_commits) de todas las engines"""
+        if self._queries_hooked:
+            return
+
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        event.listen(Engine, "before_cursor_execute", self._on_cursor_execute)
+        event.listen(Engine, "commit", self._on_commit)
+        self._queries_hooked = True
+
+    def _on_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.incr("db_queries")
+
+    def _on_commit(self, conn):
+        self.incr("db_commits")
+
+
+def _percentile(sorted_samples, percent):
+    if not sorted_samples:
+        return 0.0
+    index = int(round((percent / 100) * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+metrics = Metrics()
+thread_counters = ThreadCounters()
@@ -0,0 +1,286 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, exists, func, or_, update
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.models.outbound_message import OutboundMessage
+from app.services.whatsapp.client import get_client, WhatsAppAPIError, WhatsAppClient
+from app.services.whatsapp.metrics import metrics
+from app.services.whatsapp.rate_scheduler import outbound_scheduler
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+class OutboxSender:
+    """
+    Envía los mensajes del outbox (tabla outbound_messages) después del commit.
+
+    Un hilo drena el outbox por lotes: reclama los mensajes pendientes más
+    antiguos, los agrupa por destinatario y envía cada grupo en orden (los
+    distintos destinatarios en paralelo). Si un mensaje falla, los siguientes
+    del mismo destinatario esperan al próximo lote para no alterar el orden.
+
+    Un error reintentable deja el mensaje pendiente con next_attempt_at
+    (backoff exponencial con jitter): una caída de la Graph API no agota los
+    intentos en segundos. Los mensajes siguientes del mismo destinatario
+    esperan al reintento.
+
+    Al quedar enviado o fallido se borra el payload (puede contener datos
+    sensibles); las filas enviadas y fallidas se eliminan tras la retención.
+
+    Configuración (app.config):
+    - WHATSAPP_OUTBOX_BATCH_SIZE: mensajes por lote (default 100)
+    - WHATSAPP_OUTBOX_POLL_INTERVAL: segundos entre lecturas sin aviso (default 1.0)
+    - WHATSAPP_OUTBOX_CONCURRENCY: destinatarios enviados en paralelo (default 8)
+    - WHATSAPP_OUTBOX_MAX_ATTEMPTS: intentos antes de marcar como fallido (default 5)
+    - WHATSAPP_OUTBOX_RETRY_BASE: segundos de espera tras el primer error (default 2)
+    - WHATSAPP_OUTBOX_RETRY_MAX: espera máxima entre reintentos (default 300)
+    - WHATSAPP_OUTBOX_RETENTION_HOURS: horas que se conservan los enviados y fallidos (default 72)
+    """
+
+    def __init__(self, batch_size=100, poll_interval=1.0, concurrency=8,
+                 max_attempts=5, retention_hours=72, claim_timeout=300,
+                 retry_base=2.0, retry_max=300.0):
+        self.app = None
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retention_hours = retention_hours
+        self.claim_timeout = claim_timeout
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.purge_interval = 600
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._last_purge = 0
+        self._queue_lag = 0.0
+
+    def init_app(self, app):
+        self.app = app
+        self.batch_size = app.config.get("WHATSAPP_OUTBOX_BATCH_SIZE", self.batch_size)
+        self.poll_interval = app.config.get("WHATSAPP_OUTBOX_POLL_INTERVAL", self.poll_interval)
+        self.concurrency = app.config.get("WHATSAPP_OUTBOX_CONCURRENCY", self.concurrency)
+        self.max_attempts = app.config.get("WHATSAPP_OUTBOX_MAX_ATTEMPTS", self.max_attempts)
+        self.retention_hours = app.config.get("WHATSAPP_OUTBOX_RETENTION_HOURS", self.retention_hours)
+        self.retry_base = app.config.get("WHATSAPP_OUTBOX_RETRY_BASE", self.retry_base)
+        self.retry_max = app.config.get("WHATSAPP_OUTBOX_RETRY_MAX", self.retry_max)
+
+        metrics.register_gauge("outbox_queue_lag_seconds", lambda: round(self._queue_lag, 3))
+
+    def wake(self):
+        """Avisa al hilo de envío que hay mensajes nuevos (llamar tras el commit)"""
+        self._ensure_started()
+        self._wakeup.set()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency,
+                thread_name_prefix="whatsapp-outbox-send"
+            )
+            self._thread = threading.Thread(target=self._run, name="whatsapp-outbox", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+            try:
+                with self.app.app_context():
+                    # Seguir drenando mientras los lotes salgan llenos
+                    while self.drain() >= self.batch_size:
+                        pass
+                    self._purge_finished()
+            except Exception:
+                log.exception("Error drenando outbox de WhatsApp")
+
+    def drain(self):
+        """Envía un lote de mensajes pendientes. Devuelve el tamaño del lote."""
+        claimed = self._claim_batch()
+        if not claimed:
+            return 0
+
+        started_at = time.monotonic()
+
+        chains = OrderedDict()
+        for message in claimed:
+            chains.setdefault(message[1], []).append(message)
+
+        results = []
+        for chain_results in self._executor.map(self._send_chain, chains.values()):
+            results.extend(chain_results)
+
+        db.session.execute(update(OutboundMessage), results)
+        db.session.commit()
+
+        metrics.observe("outbox_batch", time.monotonic() - started_at)
+        return len(claimed)
+
+    def _claim_batch(self):
+        now = datetime.utcnow()
+
+        # Recuperar mensajes reclamados por un proceso que se detuvo a mitad de envío
+        OutboundMessage.query.filter(
+            OutboundMessage.status == OutboundMessage.STATUS_SENDING,
+            OutboundMessage.claimed_at < now - timedelta(seconds=self.claim_timeout)
+        ).update({"status": OutboundMessage.STATUS_PENDING}, synchronize_session=False)
+
+        # Excluir antes del LIMIT los mensajes detrás de otro del mismo destinatario
+        # que está en envío o esperando su reintento: no se pueden enviar todavía y
+        # llenarían el lote dejando sin turno a los demás destinatarios
+        earlier = aliased(OutboundMessage)
+        blocked = exists().where(
+            earlier.recipient == OutboundMessage.recipient,
+            earlier.id < OutboundMessage.id,
+            or_(
+                earlier.status == OutboundMessage.STATUS_SENDING,
+                and_(earlier.status == OutboundMessage.STATUS_PENDING, earlier.next_attempt_at > now)
+            )
+        )
+
+        rows = (
+            OutboundMessage.query
+            .filter(
+                OutboundMessage.status == OutboundMessage.STATUS_PENDING,
+                or_(OutboundMessage.next_attempt_at.is_(None), OutboundMessage.next_attempt_at <= now),
+                ~blocked
+            )
+            .order_by(OutboundMessage.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+
+        if not rows:
+            self._queue_lag = 0.0
+            db.session.commit()
+            return []
+
+        # Antigüedad del mensaje pendiente más viejo (retraso de la cola)
+        self._queue_lag = max((now - rows[0].created_at).total_seconds(), 0.0)
+        metrics.observe("outbox_queue_lag", self._queue_lag)
+
+        # Solo enviar un destinatario si su mensaje más antiguo está en este lote
+        # (otro proceso puede tener reclamados mensajes anteriores del mismo número)
+        first_ids = {}
+        for row in rows:
+            first_ids.setdefault(row.recipient, row.id)
+
+        heads = dict(
+            db.session.query(OutboundMessage.recipient, func.min(OutboundMessage.id))
+            .filter(
+                OutboundMessage.recipient.in_(list(first_ids)),
+                OutboundMessage.status.in_([OutboundMessage.STATUS_PENDING, OutboundMessage.STATUS_SENDING])
+            )
+            .group_by(OutboundMessage.recipient)
+            .all()
+        )
+
+        claimed = []
+        for row in rows:
+            if heads.get(row.recipient, row.id) < first_ids[row.recipient]:
+                continue
+            row.status = OutboundMessage.STATUS_SENDING
+            row.claimed_at = now
+            claimed.append((row.id, row.recipient, row.payload, row.attempts))
+
+        db.session.commit()
+        return claimed
+
+    def _send_chain(self, messages):
+        """Envía en orden los mensajes de un destinatario; se detiene en el primer error"""
+        client = get_client()
+        if client.throttle_listener is None:
+            client.throttle_listener = outbound_scheduler.on_throttled
+        results = []
+
+        for index, (message_id, recipient, payload, attempts) in enumerate(messages):
+            outbound_scheduler.acquire(client.phone_number_id, recipient)
+            try:
+                response = client.send_raw(payload.encode("utf-8"))
+            except WhatsAppAPIError as e:
+                retryable = e.status_code is None or e.status_code in WhatsAppClient.RETRY_STATUS
+                failed = not retryable or attempts + 1 >= self.max_attempts
+                metrics.incr("outbox_failed" if failed else "outbox_retried")
+                log.warning("Error enviando mensaje", message_id=message_id, recipient=recipient, error=str(e), retry=not failed)
+
+                if failed:
+                    results.append({
+                        "id": message_id,
+                        "status": OutboundMessage.STATUS_FAILED,
+                        "attempts": attempts + 1,
+                        "last_error": str(e)[:1000],
+                        "payload": None
+                    })
+                    continue
+
+                results.append({
+                    "id": message_id,
+                    "status": OutboundMessage.STATUS_PENDING,
+                    "attempts": attempts + 1,
+                    "last_error": str(e)[:1000],
+                    "next_attempt_at": datetime.utcnow() + timedelta(seconds=self._backoff(attempts + 1))
+                })
+
+                # Liberar el resto para conservar el orden en el próximo lote
+                for pending_id, _, _, _ in messages[index + 1:]:
+                    results.append({"id": pending_id, "status": OutboundMessage.STATUS_PENDING})
+                break
+
+            outbound_scheduler.on_success(client.phone_number_id)
+            metrics.incr("outbox_sent")
+            results.append({
+                "id": message_id,
+                "status": OutboundMessage.STATUS_SENT,
+                "attempts": attempts + 1,
+                "sent_at": datetime.utcnow(),
+                "provider_message_id": _provider_message_id(response),
+                "payload": None
+            })
+
+        return results
+
+    def _backoff(self, attempts):
+        """Segundos hasta el próximo intento: exponencial con jitter, acotado a retry_max"""
+        delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _purge_finished(self):
+        now = time.monotonic()
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+
+        cutoff = datetime.utcnow() - timedelta(hours=self.retention_hours)
+        OutboundMessage.query.filter(
+            OutboundMessage.status.in_([OutboundMessage.STATUS_SENT, OutboundMessage.STATUS_FAILED]),
+            func.coalesce(OutboundMessage.sent_at, OutboundMessage.created_at) < cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def _provider_message_id(response):
+    try:
+        return response["messages"][0]["id"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+outbox_sender = OutboxSender()
@@ -0,0 +1,153 @@
+import json
+import re
+
+
+_SLOT_PATTERN = re.compile(r'"@@(\w+)@@"')
+
+
+def slot(name):
+    """Marcador de un valor variable (p. ej. el destinatario) dentro de una plantilla"""
+    return f"@@{name}@@"
+
+
+def serialize_payload(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+
+class PayloadTemplate:
+    """
+    Payload de WhatsApp serializado una sola vez.
+
+    El JSON se genera al registrar la plantilla y se guarda partido en los
+    marcadores slot(...); render() solo intercala los valores (normalmente el
+    teléfono) entre los fragmentos ya serializados.
+    """
+
+    def __init__(self, payload):
+        parts = _SLOT_PATTERN.split(serialize_payload(payload))
+        self._literals = parts[0::2]
+        self._slots = parts[1::2]
+
+    def render(self, **values):
+        out = [self._literals[0]]
+        for name, literal in zip(self._slots, self._literals[1:]):
+            out.append(json.dumps(values[name], ensure_ascii=False))
+            out.append(literal)
+        return "".join(out)
+
+
+class PayloadRegistry:
+    """Plantillas de los menús estáticos, construidas al importar cada flujo"""
+
+    def __init__(self):
+        self._templates = {}
+
+    def register(self, name, payload):
+        template = PayloadTemplate(payload)
+        self._templates[name] = template
+        return template
+
+    def get(self, name):
+        return self._templates[name]
+
+    def names(self):
+        return list(self._templates)
+
+
+payload_registry = PayloadRegistry()
+
+
+def build_text_payload(to, text):
+    return {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "type": "text",
+        "text": {"body": text}
+    }
+
+
+def build_buttons_payload(to, body, buttons):
+    """
+    Payload de botones interactivos (máximo 3)
+    Raises ValueError si hay más de 3 botones
+    """
+    # ✅ Validar límite de 3 botones
+    if len(buttons) > 3:
+        raise ValueError(f"WhatsApp solo permite máximo 3 botones interactivos. Se intentaron enviar {len(buttons)}")
+
+    return {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "type": "interactive",
+        "interactive": {
+            "type": "button",
+            "body": {"text": body},
+            "action": {
+                "buttons": [
+                    {
+                        "type": "reply",
+                        "reply": {
+                            "id": btn["id"],
+                            "title": btn["title"][:20]  # ✅ WhatsApp limita títulos a 20 caracteres
+                        }
+                    }
+                    for btn in buttons
+                ]
+            }
+        }
+    }
+
+
+def build_list_payload(to, body, sections, button_text="Ver opciones", header=None, footer=None):
+    """
+    Payload de lista interactiva (hasta 10 opciones en total)
+    Raises ValueError si se superan los límites de WhatsApp
+    """
+    total_rows = sum(len(section.get("rows", [])) for section in sections)
+
+    # ✅ Validar límites de WhatsApp para listas
+    if total_rows == 0 or total_rows > 10:
+        raise ValueError(f"WhatsApp permite entre 1 y 10 opciones en una lista. Se intentaron enviar {total_rows}")
+    if len(sections) > 10:
+        raise ValueError(f"WhatsApp permite máximo 10 secciones. Se intentaron enviar {len(sections)}")
+
+    interactive = {
+        "type": "list",
+        "body": {"text": body},
+        "action": {
+            "button": button_text[:20],
+            "sections": [
+                {
+                    **({"title": section["title"][:24]} if section.get("title") else {}),
+                    "rows": [
+                        {
+                            "id": row["id"],
+                            "title": row["title"][:24],  # ✅ WhatsApp limita títulos de fila a 24 caracteres
+                            **({"description": row["description"][:72]} if row.get("description") else {})
+                        }
+                        for row in section.get("rows", [])
+                    ]
+                }
+                for section in sections
+            ]
+        }
+    }
+
+    if header:
+        interactive["header"] = {"type": "text", "text": header[:60]}
+    if footer:
+        interactive["footer"] = {"text": footer[:60]}
+
+    return {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "type": "interactive",
+        "interactive": interactive
+    }
+
+
+def build_options_payload(to, body, options, button_text="Ver opciones"):
+    """Botones para 1 a 3 opciones, lista para 4 a 10"""
+    if len(options) <= 3:
+        return build_buttons_payload(to, body, options)
+    return build_list_payload(to, body, [{"rows": options}], button_text=button_text)
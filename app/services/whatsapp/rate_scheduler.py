@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+
+from app.services.whatsapp.metrics import metrics
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket con reserva: cada reserve() consume un token y devuelve
+    cuántos segundos debe esperar el llamador antes de enviar. Los tokens
+    pueden quedar en negativo, lo que reparte la espera entre los hilos en
+    el orden en que reservaron.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now)
+
+    def block(self, seconds):
+        """Bloquea el bucket (p. ej. por un Retry-After) durante 'seconds'"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = float(rate)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class OutboundScheduler:
+    """
+    Planificador de envíos a la Graph API.
+
+    - Un token bucket global por PHONE_NUMBER_ID (nivel de throughput del número).
+    - Un token bucket por destinatario para espaciar los mensajes a un mismo usuario.
+    - Ajuste adaptativo (AIMD): ante un 429 el ritmo global se reduce a la mitad
+      y se respeta el Retry-After; con envíos exitosos se recupera gradualmente
+      hasta el máximo configurado.
+
+    Configuración (app.config):
+    - WHATSAPP_SEND_RATE: mensajes/s por número (default 80, nivel estándar de Cloud API)
+    - WHATSAPP_SEND_BURST: ráfaga máxima por número (default = WHATSAPP_SEND_RATE)
+    - WHATSAPP_SEND_MIN_RATE: ritmo mínimo tras reducciones (default 5)
+    - WHATSAPP_RECIPIENT_RATE: mensajes/s por destinatario (default 1)
+    - WHATSAPP_RECIPIENT_BURST: ráfaga por destinatario (default 5)
+    """
+
+    def __init__(self, rate=80, burst=None, min_rate=5, recipient_rate=1,
+                 recipient_burst=5, max_recipients=10000, recovery_per_second=None):
+        self.max_rate = rate
+        self.burst = burst or rate
+        self.min_rate = min_rate
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.max_recipients = max_recipients
+        self.recovery_per_second = recovery_per_second or rate * 0.05
+        self._senders = {}
+        self._recipients = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_adjust = time.monotonic()
+
+    def init_app(self, app):
+        self.max_rate = app.config.get("WHATSAPP_SEND_RATE", self.max_rate)
+        self.burst = app.config.get("WHATSAPP_SEND_BURST", self.max_rate)
+        self.min_rate = app.config.get("WHATSAPP_SEND_MIN_RATE", self.min_rate)
+        self.recipient_rate = app.config.get("WHATSAPP_RECIPIENT_RATE", self.recipient_rate)
+        self.recipient_burst = app.config.get("WHATSAPP_RECIPIENT_BURST", self.recipient_burst)
+        self.recovery_per_second = self.max_rate * 0.05
+
+        metrics.register_gauge("outbound_send_rate", self.current_rates)
+
+    def current_rates(self):
+        with self._lock:
+            return {sender: round(bucket.rate, 2) for sender, bucket in self._senders.items()}
+
+    def acquire(self, sender_id, recipient):
+        """Bloquea hasta que se pueda enviar un mensaje de sender_id a recipient"""
+        recipient_wait = self._recipient_bucket(recipient).reserve()
+        if recipient_wait > 0:
+            time.sleep(recipient_wait)
+
+        wait = self._sender_bucket(sender_id).reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+        metrics.observe("outbound_rate_wait", max(recipient_wait, 0) + max(wait, 0))
+
+    def on_success(self, sender_id):
+        bucket = self._sender_bucket(sender_id)
+        if bucket.rate >= self.max_rate:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._last_adjust
+            self._last_adjust = now
+        bucket.set_rate(min(self.max_rate, bucket.rate + self.recovery_per_second * elapsed))
+
+    def on_throttled(self, sender_id, retry_after=None):
+        """Llamar cuando la API responde 429"""
+        bucket = self._sender_bucket(sender_id)
+        bucket.set_rate(max(self.min_rate, bucket.rate / 2))
+        bucket.block(retry_after if retry_after is not None else 1.0)
+
+        with self._lock:
+            self._last_adjust = time.monotonic()
+
+        metrics.incr("outbound_throttled")
+        log.warning("WhatsApp API 429: ritmo reducido", rate=round(bucket.rate, 1), retry_after=retry_after)
+
+    def _sender_bucket(self, sender_id):
+        bucket = self._senders.get(sender_id)
+        if bucket is None:
+            with self._lock:
+                bucket = self._senders.setdefault(sender_id, TokenBucket(self.max_rate, self.burst))
+        return bucket
+
+    def _recipient_bucket(self, recipient):
+        with self._lock:
+            bucket = self._recipients.get(recipient)
+            if bucket is None:
+                bucket = TokenBucket(self.recipient_rate, self.recipient_burst)
+                self._recipients[recipient] = bucket
+                while len(self._recipients) > self.max_recipients:
+                    self._recipients.popitem(last=False)
+            else:
+                self._recipients.move_to_end(recipient)
+            return bucket
+
+
+outbound_scheduler = OutboundScheduler()
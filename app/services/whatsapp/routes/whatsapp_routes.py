@@ -1,19 +1,31 @@
+from flask import current_app, request
+
+from app import limiter
 from app.services.whatsapp import whatsapp_bp
 from app.services.whatsapp.whatsapp_controller import handle_webhook
+from app.services.whatsapp.metrics import metrics
+
 
+# Sin límite por IP (todo el tráfico llega desde las IPs de Meta): el límite
+# por remitente se aplica a cada mensaje en el control de admisión
 @whatsapp_bp.route("/webhook", methods=["POST"])
+@limiter.exempt
 def whatsapp_webhook():
     return handle_webhook()
 
 @whatsapp_bp.route("/webhook", methods=["GET"])
+@limiter.exempt
 def whatsapp_verify():
-    from flask import request
-    from config import Config
-
     token = request.args.get("hub.verify_token")
     challenge = request.args.get("hub.challenge")
 
-    if token == Config.VERIFY_TOKEN:
+    if token and token == current_app.config.get("VERIFY_TOKEN"):
         return challenge
 
     return "Invalid token", 403
+
+@whatsapp_bp.route("/webhook/metrics", methods=["GET"])
+def whatsapp_metrics():
+    from flask import jsonify
+
+    return jsonify(metrics.snapshot()), 200
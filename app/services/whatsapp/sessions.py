@@ -0,0 +1,186 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, insert, not_, or_, tuple_, update
+
+from app import db
+from app.models.conversation_archive import ConversationArchive
+from app.models.whatsapp_user import WhatsAppUser
+from app.services.whatsapp.metrics import metrics
+from app.services.whatsapp.state_cache import conversation_cache
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Resolución de last_activity_at: evita una escritura por mensaje solo para la fecha
+ACTIVITY_RESOLUTION = timedelta(seconds=60)
+
+
+def touch_activity(wa_user, now=None):
+    """Registra actividad de la conversación (llamar al recibir un mensaje)"""
+    now = now or datetime.utcnow()
+    if wa_user.last_activity_at is None or now - wa_user.last_activity_at >= ACTIVITY_RESOLUTION:
+        wa_user.last_activity_at = now
+
+
+def resting_state(row):
+    """(flow, step) al que vuelve una sesión expirada: menú o inicio del registro"""
+    if row.traveler_id:
+        return "menu", None
+    return "registration", "start"
+
+
+class SessionSweeper:
+    """
+    Expira las conversaciones abandonadas.
+
+    Periódicamente busca las sesiones sin actividad desde hace más de
+    WHATSAPP_SESSION_IDLE_MINUTES que no estén en reposo (menú o inicio del
+    registro sin datos temporales), copia su flow/step/temp_data a
+    whatsapp_conversation_archive con un INSERT por lotes y las reinicia con
+    un UPDATE por lotes.
+
+    Recorre la tabla por keyset (last_activity_at, id) sobre el índice
+    ix_whatsapp_users_last_activity: cada lote es una transacción corta que
+    solo bloquea sus propias filas (SKIP LOCKED donde se soporta).
+
+    Configuración (app.config):
+    - WHATSAPP_SESSION_SWEEP: activar el barrido (default True)
+    - WHATSAPP_SESSION_IDLE_MINUTES: minutos de inactividad para expirar (default 60)
+    - WHATSAPP_SESSION_SWEEP_INTERVAL: segundos entre barridos (default 300)
+    - WHATSAPP_SESSION_SWEEP_BATCH_SIZE: sesiones por lote (default 500)
+    """
+
+    def __init__(self, idle_minutes=60, interval=300, batch_size=500):
+        self.app = None
+        self.enabled = True
+        self.idle_minutes = idle_minutes
+        self.interval = interval
+        self.batch_size = batch_size
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("WHATSAPP_SESSION_SWEEP", self.enabled)
+        self.idle_minutes = app.config.get("WHATSAPP_SESSION_IDLE_MINUTES", self.idle_minutes)
+        self.interval = app.config.get("WHATSAPP_SESSION_SWEEP_INTERVAL", self.interval)
+        self.batch_size = app.config.get("WHATSAPP_SESSION_SWEEP_BATCH_SIZE", self.batch_size)
+
+    def ensure_started(self):
+        """Inicia el hilo de barrido (en el primer mensaje, después de un posible fork)"""
+        if not self.enabled or self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="whatsapp-session-sweeper", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                with self.app.app_context():
+                    self.sweep()
+            except Exception:
+                db.session.rollback()
+                log.exception("Error expirando sesiones de WhatsApp")
+
+    def sweep(self, now=None):
+        """Expira todas las sesiones inactivas. Devuelve cuántas se reiniciaron."""
+        started_at = time.monotonic()
+        now = now or datetime.utcnow()
+        cutoff = now - timedelta(minutes=self.idle_minutes)
+
+        expired = 0
+        last_key = None
+        while True:
+            rows = self._next_batch(cutoff, last_key)
+            if not rows:
+                db.session.commit()
+                break
+
+            last_key = (rows[-1].last_activity_at, rows[-1].id)
+            expired += self._expire(rows, cutoff, now)
+
+            if len(rows) < self.batch_size:
+                break
+
+        metrics.incr("sessions_expired", expired)
+        metrics.observe("session_sweep", time.monotonic() - started_at)
+        return expired
+
+    def _next_batch(self, cutoff, last_key):
+        # En reposo: menú (o sin flujo) o inicio del registro, sin datos temporales
+        at_rest = and_(
+            WhatsAppUser.temp_data.is_(None),
+            or_(
+                and_(func.coalesce(WhatsAppUser.flow, "menu") == "menu", WhatsAppUser.step.is_(None)),
+                and_(WhatsAppUser.flow == "registration", WhatsAppUser.step == "start")
+            )
+        )
+
+        query = db.session.query(
+            WhatsAppUser.id,
+            WhatsAppUser.phone,
+            WhatsAppUser.traveler_id,
+            WhatsAppUser.flow,
+            WhatsAppUser.step,
+            WhatsAppUser.temp_data,
+            WhatsAppUser.last_activity_at
+        ).filter(
+            WhatsAppUser.last_activity_at < cutoff,
+            not_(at_rest)
+        )
+
+        if last_key is not None:
+            query = query.filter(tuple_(WhatsAppUser.last_activity_at, WhatsAppUser.id) > last_key)
+
+        return (
+            query
+            .order_by(WhatsAppUser.last_activity_at, WhatsAppUser.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+
+    def _expire(self, rows, cutoff, now):
+        # La caché puede tener actividad más reciente que la tabla (escritura diferida)
+        rows = [row for row in rows if not conversation_cache.is_active_since(row.phone, cutoff)]
+        if not rows:
+            db.session.commit()
+            return 0
+
+        db.session.execute(insert(ConversationArchive), [
+            {
+                "whatsapp_user_id": row.id,
+                "phone": row.phone,
+                "flow": row.flow,
+                "step": row.step,
+                "temp_data": row.temp_data,
+                "last_activity_at": row.last_activity_at,
+                "archived_at": now
+            }
+            for row in rows
+        ])
+
+        resets = []
+        for row in rows:
+            flow, step = resting_state(row)
+            resets.append({"id": row.id, "flow": flow, "step": step, "temp_data": None})
+        db.session.execute(update(WhatsAppUser), resets)
+        db.session.commit()
+
+        for row in rows:
+            conversation_cache.evict(row.phone)
+
+        return len(rows)
+
+
+session_sweeper = SessionSweeper()
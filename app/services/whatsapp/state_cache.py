@@ -0,0 +1,389 @@
+import atexit
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import update
+
+from app import db
+from app.models.whatsapp_user import WhatsAppUser
+from app.services.whatsapp.metrics import metrics
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+STATE_FIELDS = ("id", "phone", "traveler_id", "flow", "step", "temp_data", "last_activity_at")
+
+
+class MemoryStateStore:
+    """
+    Almacén en memoria del proceso: LRU con TTL.
+    Solo es coherente con un único proceso atendiendo el webhook.
+    """
+
+    def __init__(self, ttl_seconds=1800, max_entries=10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, phone):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(phone)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= now:
+                del self._items[phone]
+                return None
+            self._items.move_to_end(phone)
+            return value
+
+    def set(self, phone, value):
+        with self._lock:
+            self._items[phone] = (time.monotonic() + self.ttl_seconds, value)
+            self._items.move_to_end(phone)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def delete(self, phone):
+        with self._lock:
+            self._items.pop(phone, None)
+
+    def size(self):
+        return len(self._items)
+
+
+class RedisStateStore:
+    """
+    Almacén compartido en un servidor compatible con Redis (Redis, Valkey,
+    KeyDB, ...), p. ej. redis://localhost:6379/0. La expiración la maneja el
+    servidor (SETEX) y el desalojo su política maxmemory (allkeys-lru).
+    Requiere el paquete redis.
+    """
+
+    def __init__(self, url, ttl_seconds=1800, prefix="wa_state:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("WHATSAPP_STATE_CACHE_URL usa Redis pero el paquete redis no está instalado")
+
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, phone):
+        value = self._redis.get(self.prefix + phone)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, phone, value):
+        self._redis.setex(self.prefix + phone, int(self.ttl_seconds), value)
+
+    def delete(self, phone):
+        self._redis.delete(self.prefix + phone)
+
+    def size(self):
+        return None
+
+
+def create_state_store(url, ttl_seconds, max_entries):
+    if not url or url.startswith("memory://"):
+        return MemoryStateStore(ttl_seconds, max_entries)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStateStore(url, ttl_seconds)
+    raise ValueError(f"WHATSAPP_STATE_CACHE_URL no soportada: {url}")
+
+
+class ConversationStateCache:
+    """
+    Caché del estado de conversación (flow, step, temp_data, traveler_id) por teléfono.
+
+    Con la caché activa, process_message no lee whatsapp_users en cada mensaje:
+    el estado sale del almacén (memoria o Redis) y los flujos trabajan sobre un
+    WhatsAppUser transitorio (fuera de la sesión). Los cambios se escriben a la
+    tabla en segundo plano (write-behind), agrupados en UPDATEs por lotes.
+
+    Durabilidad: require_durable(wa_user) (p. ej. al crear un viaje o completar
+    el registro) escribe el estado en la misma transacción que el mensaje, así
+    el viaje y el estado final de la conversación se confirman juntos. Los
+    usuarios nuevos se insertan siempre de forma síncrona.
+
+    Orden de lectura: almacén -> cambios pendientes de escribir -> tabla.
+
+    Configuración (app.config):
+    - WHATSAPP_STATE_CACHE: activar la caché (default False)
+    - WHATSAPP_STATE_CACHE_URL: "memory://" (default) o "redis://host:port/db"
+    - WHATSAPP_STATE_CACHE_TTL: segundos sin actividad que se conserva un estado (default 1800)
+    - WHATSAPP_STATE_CACHE_MAX_ENTRIES: estados en memoria (default 10000)
+    - WHATSAPP_STATE_FLUSH_INTERVAL: segundos entre escrituras por lotes (default 1.0)
+    - WHATSAPP_STATE_FLUSH_BATCH_SIZE: estados por UPDATE (default 500)
+    """
+
+    def __init__(self, ttl_seconds=1800, max_entries=10000, flush_interval=1.0, flush_batch_size=500):
+        self.app = None
+        self.enabled = False
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.store = MemoryStateStore(ttl_seconds, max_entries)
+        self._pending = OrderedDict()
+        self._pending_lock = threading.Lock()
+        # Serializa las escrituras: un lote en curso termina antes de una escritura durable
+        self._flush_lock = threading.Lock()
+        self._staged = threading.local()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("WHATSAPP_STATE_CACHE", self.enabled)
+        self.ttl_seconds = app.config.get("WHATSAPP_STATE_CACHE_TTL", self.ttl_seconds)
+        self.max_entries = app.config.get("WHATSAPP_STATE_CACHE_MAX_ENTRIES", self.max_entries)
+        self.flush_interval = app.config.get("WHATSAPP_STATE_FLUSH_INTERVAL", self.flush_interval)
+        self.flush_batch_size = app.config.get("WHATSAPP_STATE_FLUSH_BATCH_SIZE", self.flush_batch_size)
+
+        if not self.enabled:
+            return
+
+        self.store = create_state_store(
+            app.config.get("WHATSAPP_STATE_CACHE_URL", "memory://"),
+            self.ttl_seconds,
+            self.max_entries
+        )
+
+        metrics.register_gauge("state_cache_entries", self.store.size)
+        metrics.register_gauge("state_cache_pending_writes", lambda: len(self._pending))
+
+        # Escribir los cambios pendientes al detener el proceso
+        atexit.register(self.flush_all)
+
+    # ============== LECTURA ==============
+
+    def load(self, phone):
+        """
+        WhatsAppUser del teléfono, o None si no existe.
+        Con la caché activa devuelve un objeto transitorio (no pertenece a la sesión).
+        """
+        if not self.enabled:
+            return WhatsAppUser.query.filter_by(phone=phone).first()
+
+        value = self._cached_value(phone)
+        if value is None:
+            metrics.incr("state_cache_misses")
+            wa_user = WhatsAppUser.query.filter_by(phone=phone).first()
+            if wa_user is None:
+                return None
+            value = json.dumps(_snapshot(wa_user))
+            # Trabajar siempre sobre una copia transitoria: la sesión no debe
+            # escribir la fila al hacer commit
+            db.session.expunge(wa_user)
+        else:
+            metrics.incr("state_cache_hits")
+
+        wa_user = WhatsAppUser(**_decode(json.loads(value)))
+        # Estado serializado al cargar: los flujos modifican temp_data en el lugar
+        wa_user.__dict__["_state_snapshot"] = value
+        return wa_user
+
+    def _cached_value(self, phone):
+        value = self.store.get(phone)
+        if value is not None:
+            return value
+
+        # Desalojado de la caché pero aún sin escribir en la tabla
+        with self._pending_lock:
+            return self._pending.get(phone)
+
+    # ============== ESCRITURA ==============
+
+    def require_durable(self, wa_user):
+        """Escribir el estado de este mensaje en su misma transacción (fin de un flujo)"""
+        wa_user.__dict__["_state_durable"] = True
+
+    def stage(self, wa_user):
+        """
+        Prepara el estado final del mensaje (llamar antes del commit).
+        Si es durable, agrega el UPDATE a la transacción del mensaje.
+        """
+        if not self.enabled:
+            return
+
+        state = _snapshot(wa_user)
+        value = json.dumps(state)
+        changed = value != wa_user.__dict__.get("_state_snapshot")
+        # Usuario nuevo (agregado a la sesión en este mensaje): el commit lo inserta
+        persistent = wa_user in db.session
+        durable = persistent or wa_user.__dict__.get("_state_durable", False)
+
+        replaced = None
+        if durable and changed and not persistent:
+            # Un lote anterior en curso debe terminar antes, y el estado pendiente
+            # (más viejo) ya no debe escribirse después de este
+            with self._flush_lock:
+                with self._pending_lock:
+                    replaced = self._pending.pop(wa_user.phone, None)
+            values = {name: v for name, v in _decode(state).items() if name not in ("id", "phone")}
+            db.session.execute(update(WhatsAppUser).where(WhatsAppUser.id == wa_user.id).values(**values))
+            metrics.incr("state_durable_writes")
+
+        if persistent:
+            # Usuario nuevo: el INSERT asigna el id
+            db.session.flush()
+            value = json.dumps(_snapshot(wa_user))
+
+        self._staged_list().append((wa_user.phone, value, changed and not durable, replaced))
+
+    def publish(self):
+        """Publica en la caché los estados preparados (llamar después del commit)"""
+        staged = self._staged_list()
+        if not staged:
+            return
+        self._staged.items = []
+
+        write_behind = False
+        for phone, value, pending, _ in staged:
+            self.store.set(phone, value)
+            if pending:
+                with self._pending_lock:
+                    self._pending[phone] = value
+                    self._pending.move_to_end(phone)
+                write_behind = True
+
+        if write_behind:
+            self._ensure_started()
+
+    def discard(self, phone=None):
+        """Descarta lo preparado tras un rollback; el próximo mensaje vuelve a leer el estado"""
+        if not self.enabled:
+            return
+
+        staged = self._staged_list()
+        self._staged.items = []
+        for staged_phone, _, _, replaced in staged:
+            # El UPDATE durable se revirtió: el estado pendiente anterior sigue vigente
+            if replaced is not None:
+                with self._pending_lock:
+                    self._pending.setdefault(staged_phone, replaced)
+
+        if phone:
+            self.store.delete(phone)
+
+    def is_active_since(self, phone, cutoff):
+        """True si el estado en caché (o pendiente de escribir) tuvo actividad desde cutoff"""
+        if not self.enabled:
+            return False
+        value = self._cached_value(phone)
+        if value is None:
+            return False
+        last_activity_at = _decode(json.loads(value)).get("last_activity_at")
+        return last_activity_at is not None and last_activity_at >= cutoff
+
+    def evict(self, phone):
+        """
+        Olvida el estado en caché y su escritura pendiente
+        (la tabla fue modificada por fuera, p. ej. por el SessionSweeper).
+        """
+        if not self.enabled:
+            return
+        with self._flush_lock:
+            with self._pending_lock:
+                self._pending.pop(phone, None)
+        self.store.delete(phone)
+
+    def _staged_list(self):
+        items = getattr(self._staged, "items", None)
+        if items is None:
+            items = self._staged.items = []
+        return items
+
+    # ============== WRITE-BEHIND ==============
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="whatsapp-state-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            try:
+                with self.app.app_context():
+                    while self.flush() >= self.flush_batch_size:
+                        pass
+            except Exception:
+                log.exception("Error escribiendo estados de conversación")
+
+    def flush(self):
+        """Escribe un lote de estados pendientes con un UPDATE por lotes. Devuelve su tamaño."""
+        with self._flush_lock:
+            with self._pending_lock:
+                batch = []
+                while self._pending and len(batch) < self.flush_batch_size:
+                    batch.append(self._pending.popitem(last=False))
+
+            if not batch:
+                return 0
+
+            started_at = time.monotonic()
+            rows = []
+            for _, value in batch:
+                state = _decode(json.loads(value))
+                rows.append({name: v for name, v in state.items() if name != "phone"})
+
+            try:
+                db.session.execute(update(WhatsAppUser), rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Reencolar sin pisar estados más nuevos del mismo teléfono
+                with self._pending_lock:
+                    for phone, value in batch:
+                        self._pending.setdefault(phone, value)
+                raise
+
+        metrics.incr("state_flushed", len(batch))
+        metrics.observe("state_flush_batch", time.monotonic() - started_at)
+        return len(batch)
+
+    def flush_all(self):
+        if self.app is None or not self._pending:
+            return
+        try:
+            with self.app.app_context():
+                while self.flush():
+                    pass
+        except Exception as e:
+            log.error("No se pudieron escribir estados de conversación", pending=len(self._pending), error=str(e))
+
+
+def _snapshot(wa_user):
+    """Estado serializable a JSON (fechas en ISO 8601)"""
+    state = {field: getattr(wa_user, field) for field in STATE_FIELDS}
+    if state["last_activity_at"] is not None:
+        state["last_activity_at"] = state["last_activity_at"].isoformat()
+    return state
+
+
+def _decode(state):
+    """Inverso de _snapshot: valores listos para el modelo"""
+    state = {field: state.get(field) for field in STATE_FIELDS}
+    if state["last_activity_at"] is not None:
+        state["last_activity_at"] = datetime.fromisoformat(state["last_activity_at"])
+    return state
+
+
+conversation_cache = ConversationStateCache()
@@ -1,157 +1,126 @@
 from flask import request, jsonify
-from app.services.whatsapp import extract_message, send_message
-from app.services.whatsapp.flows.driver_flow import driver_flow
-from app.services.whatsapp.flows.registration_flow import registration_flow
-from app.models.whatsapp_user import WhatsAppUser
+from app.services.whatsapp import extract_messages
 from app import db
-from app.models.traveler import Traveler
-from app.services.whatsapp.flows.menu_flow import menu_flow, send_menu
+from app.services.whatsapp.flow_engine import flow_engine
+from app.services.whatsapp.flows.registration_flow import registration_flow
+from app.services.whatsapp.flows.menu_flow import menu_flow, freight_flow
 from app.services.whatsapp.flows.parcel_flow import parcel_flow
 from app.services.whatsapp.flows.location_flow import location_flow
 from app.services.whatsapp.flows.driver_flow import driver_flow
 from app.services.whatsapp.flows.one_way_flow import custom_trip_flow
 from app.services.whatsapp.flows.round_flow import round_trip_flow
 from app.services.whatsapp.flows.multilocation_flow import multilocation_flow
+from app.services.whatsapp.admission import admission_controller, DEFER
+from app.services.whatsapp.metrics import metrics, thread_counters
+from app.services.whatsapp.dedup import message_deduplicator
+from app.services.whatsapp.outbox import outbox_sender
+from app.services.whatsapp.state_cache import conversation_cache
+from app.services.whatsapp.sessions import session_sweeper
+from app.services.whatsapp.event_log import conversation_log
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Tabla de flujos de conversación (flow -> pasos)
+for _flow in (
+    registration_flow,
+    menu_flow,
+    custom_trip_flow,
+    round_trip_flow,
+    parcel_flow,
+    location_flow,
+    multilocation_flow,
+    freight_flow,
+    driver_flow,
+):
+    flow_engine.register(_flow)
 
 
-def get_or_create_whatsapp_user(phone):
-    wa_user = WhatsAppUser.query.filter_by(phone=phone).first()
-
-    if wa_user:
-        return wa_user
+def handle_webhook():
+    """
+    Valida el payload, reparte sus mensajes entre los shards del despachador
+    y responde de inmediato. Los flujos se ejecutan en process_messages
+    (segundo plano), en serie para cada remitente.
+
+    Cada mensaje pasa por el control de admisión (ver AdmissionController),
+    que también aplica el límite por remitente: si alguno se difiere se
+    responde 503 para que Meta reintente la entrega; los descartados
+    (sobrecarga o remitente sobre el límite) no cambian la respuesta.
+    """
+    data = request.get_json(silent=True)
+
+    if not isinstance(data, dict) or not isinstance(data.get("entry"), list):
+        return jsonify({"status": "ignored"}), 200
 
-    traveler = Traveler.query.filter_by(phone=phone).first()
+    log.debug("Webhook recibido", sample=0.01, payload=data)
 
-    wa_user = WhatsAppUser(
-        phone=phone,
-        traveler_id=traveler.id if traveler else None,
-        flow="menu" if traveler else "registration",
-        step=None if traveler else "start",
-        temp_data={}
-    )
+    deferred = False
+    for message in extract_messages(data):
+        if message[1] and admission_controller.admit(message) == DEFER:
+            deferred = True
 
-    db.session.add(wa_user)
-    db.session.commit()
+    if deferred:
+        # Shard saturado: Meta reintentará la entrega más tarde
+        # (los mensajes ya encolados se descartan por wamid)
+        return jsonify({"status": "busy"}), 503
 
-    return wa_user
+    return jsonify({"status": "queued"}), 200
 
 
-def handle_webhook():
-    data = request.get_json()
-    print("📩 WhatsApp:", data)
+def process_webhook(data):
+    """Procesa de forma síncrona todos los mensajes de un payload de webhook"""
+    process_messages(extract_messages(data))
 
-    sender, text, location_data = extract_message(data)
-    if not sender:
-        return jsonify({"status": "ignored"}), 200
 
-    print(f"👤 Mensaje de: {sender}, Texto: '{text}', Location: {location_data is not None} ,Location_data: {location_data }")
+def process_messages(messages):
+    """
+    Procesa una secuencia de mensajes (message_id, sender, text, location_data).
+    Todos se despachan en la misma sesión de BD; un error en un mensaje
+    no impide procesar los siguientes.
+    """
+    for message_id, sender, text, location_data in messages:
+        if not sender:
+            continue
 
-    wa_user = WhatsAppUser.query.filter_by(phone=sender).first()
+        conversation_log.inbound(message_id, sender, text, location_data)
 
-    # 🆕 Usuario nuevo
-    if not wa_user:
-        print(f"🆕 Usuario nuevo detectado: {sender}")
-        wa_user = WhatsAppUser(
-            phone=sender,
-            flow="registration",
-            step="start"
-        )
-        db.session.add(wa_user)
-        db.session.commit()
-    
-    print(f"📊 Estado actual - Flow: {wa_user.flow}, Step: {wa_user.step}, Traveler: {wa_user.traveler_id}")
+        try:
+            # 🔁 Reenvío de Meta ya procesado: no repetir el flujo
+            if not message_deduplicator.claim(message_id):
+                log.info("Mensaje duplicado ignorado", message_id=message_id)
+                continue
 
-    if text is None and location_data is None:
-        return jsonify({"status": "ignored"}), 200
-    
-    # ✅ ORDEN CORRECTO: Primero registro, luego menú
-    
-    # 🔀 Flujo de registro
-    if wa_user.flow == "registration":
-        print("🔄 Procesando flujo de registro")
-        registration_flow(wa_user, text)
-        return jsonify({"status": "ok"}), 200
-   
-    # 🍔 Flujo de menú (usuario ya registrado) 
-    elif wa_user.flow == "menu" or wa_user.flow == "Menu" or wa_user.flow == "Menú" or wa_user.flow is None:
-        print("🍔 Procesando flujo de menú")
-        # Si flow es None, actualizarlo a menu
-        if wa_user.flow is None:
-            wa_user.flow = "menu"
+            # Unidad de trabajo: los flujos solo modifican la sesión y
+            # todo el mensaje se confirma con un único commit
+            before = thread_counters.values()
+            result = process_message(sender, text, location_data)
             db.session.commit()
-        
-        menu_flow(wa_user, text)
-        return jsonify({"status": "ok"}), 200
-    
-    # 🚕 Flujo de viaje
-    elif wa_user.flow == "trip_request":
-        print("🚕 Procesando solicitud de viaje")
-        custom_trip_flow(wa_user, text)
-        return jsonify({"status": "ok"}), 200
-
-    # 🗓️ Flujo de viaje programado
-    elif wa_user.flow == "round_trip":
-        print("🔄 Procesando flujo de viaje Round Trip")
-        round_trip_flow(wa_user, text)
-        return jsonify({"status": "ok"}), 200
-
-    # 📦 Flujo de encomiendas
-    elif wa_user.flow == "parcel":
-        print("📦 Procesando flujo de paquete")
-        parcel_flow(wa_user, text)
-        print("📦 Estado después del flujo de paquete - Flow:", wa_user.flow, "Step:", wa_user.step)
-        return jsonify({"status": "ok"}), 200
-    
-    # 📍 Flujo de ubicaciones (independiente)
-    elif wa_user.flow == "location":
-        print("📍 Procesando flujo de ubicación")
-        location_flow(wa_user, text=text, location_data=location_data)
-        return jsonify({"status": "ok"}), 200
-
-    elif wa_user.flow == "multilocation":
-        print("📍 Procesando flujo de ubicación")
-        multilocation_flow(wa_user, text=text, location_data=location_data)
-        return jsonify({"status": "ok"}), 200
-
-    # 🚚 Flujo de fletes
-    elif wa_user.flow == "freight":
-        print("🚚 Procesando fletes")
-        send_message(wa_user.phone, "🚧 Función en desarrollo\n\nEscribe *menu* para volver al menú principal.")
-        wa_user.flow = "menu"
-        db.session.commit()
-        return jsonify({"status": "ok"}), 200
-    
-    # 🚗 Flujo de selección de conductor
-    elif wa_user.flow == "driver_selection":
-        print("🚗 Procesando selección de conductor")
-        driver_flow(wa_user, text)
-        return jsonify({"status": "ok"}), 200
-    
-    # ❌ Flujo desconocido
-    else:
-        print(f"❌ Flujo desconocido: {wa_user.flow}")
-        wa_user.flow = "menu"
-        db.session.commit()
-        return jsonify({"status": "ok"}), 200
-    
-
-
-
-#    modo de uso del flujo de driver en otros flujos
-#  elif wa_user.step == "select_driver":
-#         # Guardar contexto para volver después
-#         if not wa_user.temp_data:
-#             wa_user.temp_data = {}
-        
-#         wa_user.temp_data['previous_flow'] = 'parcel'
-#         wa_user.temp_data['previous_step'] = 'payment_method'  # O el step que sigue
-        
-#         # Cambiar a flujo de conductor
-#         wa_user.flow = "driver_selection"
-#         wa_user.step = "start"
-#         db.session.commit()
-        
-#         # Iniciar el flujo
-#         from app.services.whatsapp.flows.driver_flow import driver_flow
-#         driver_flow(wa_user, "")
-#         return
\ No newline at end of file
+            conversation_cache.publish()
+            conversation_log.transition(message_id, sender, result)
+            metrics.incr("messages_processed")
+
+            # Costo del mensaje: consultas SQL, commits y mensajes salientes generados
+            used = thread_counters.since(before)
+            metrics.observe_value("db_queries_per_message", used.get("db_queries", 0))
+            metrics.observe_value("db_commits_per_message", used.get("db_commits", 0))
+            metrics.observe_value("outbound_per_message", used.get("outbound_messages", 0))
+        except Exception as e:
+            db.session.rollback()
+            conversation_cache.discard(sender)
+            message_deduplicator.release(message_id)
+            metrics.incr("messages_failed")
+            conversation_log.failure(message_id, sender, e)
+            log.exception("Error procesando mensaje", sender=sender, message_id=message_id)
+
+    # 📤 Los mensajes salientes quedaron en el outbox: enviarlos tras el commit
+    outbox_sender.wake()
+    session_sweeper.ensure_started()
+
+
+def process_message(sender, text, location_data):
+    """Despacha un mensaje individual al flujo correspondiente del usuario"""
+    log.debug("Mensaje recibido", sender=sender, text=text, location=location_data)
+
+    return flow_engine.process(sender, text, location_data)
@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+import zlib
+
+from app.services.whatsapp.metrics import metrics
+from app.utils.log import get_logger
+
+
+log = get_logger(__name__)
+
+
+class ShardedDispatcher:
+    """
+    Despachador de mensajes de WhatsApp en segundo plano, particionado por remitente.
+
+    El endpoint solo valida y encola; cada mensaje se asigna a un shard fijo
+    según el hash del teléfono del remitente (wa_user.phone). Cada shard tiene
+    su propia cola acotada y un único hilo, por lo que los mensajes de un mismo
+    teléfono se procesan en serie (sin carreras sobre flow/step/temp_data) y
+    los de teléfonos distintos en paralelo.
+
+    Configuración (app.config):
+    - WHATSAPP_SHARDS: número de shards/hilos (default 4)
+    - WHATSAPP_SHARD_QUEUE_SIZE: máximo de mensajes en espera por shard (default 250)
+    - WHATSAPP_SHARD_BATCH_SIZE: mensajes procesados por app context (default 20)
+    """
+
+    def __init__(self, shards=4, max_queue=250, batch_size=20):
+        self.app = None
+        self.handler = None
+        self.shards = shards
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self._queues = []
+        self._threads = []
+        self._lock = threading.Lock()
+        # Mensajes aceptados que todavía no terminaron de procesarse (en cola o en curso)
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    def init_app(self, app, handler):
+        """
+        handler: función que recibe una lista de mensajes
+        (message_id, sender, text, location_data) y los procesa en orden.
+        """
+        self.app = app
+        self.handler = handler
+        self.shards = app.config.get("WHATSAPP_SHARDS", self.shards)
+        self.max_queue = app.config.get("WHATSAPP_SHARD_QUEUE_SIZE", self.max_queue)
+        self.batch_size = app.config.get("WHATSAPP_SHARD_BATCH_SIZE", self.batch_size)
+        self._queues = [queue.Queue(maxsize=self.max_queue) for _ in range(self.shards)]
+
+        metrics.register_gauge("webhook_queue_depth", self.qsize)
+        metrics.register_gauge("webhook_max_shard_depth", self.max_shard_depth)
+        metrics.register_gauge("webhook_workers", lambda: len(self._threads))
+        metrics.register_gauge("webhook_in_flight", lambda: self.in_flight)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def max_shard_depth(self):
+        return max((q.qsize() for q in self._queues), default=0)
+
+    def shard_for(self, phone):
+        return zlib.crc32((phone or "").encode("utf-8")) % self.shards
+
+    def shard_depth(self, phone):
+        """Mensajes en espera en el shard del teléfono"""
+        return self._queues[self.shard_for(phone)].qsize()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _add_in_flight(self, count):
+        with self._in_flight_lock:
+            self._in_flight += count
+
+    def submit(self, message):
+        """
+        Encola un mensaje (message_id, sender, text, location_data) en el shard
+        de su remitente. Devuelve False si la cola del shard está llena.
+        Los hilos se inician en el primer envío (después de un posible fork).
+        """
+        self._ensure_started()
+
+        shard = self.shard_for(message[1])
+        self._add_in_flight(1)
+        try:
+            self._queues[shard].put_nowait((time.monotonic(), message))
+        except queue.Full:
+            self._add_in_flight(-1)
+            metrics.incr("webhook_rejected_queue_full")
+            return False
+
+        metrics.incr("webhook_enqueued")
+        return True
+
+    def join(self):
+        """Espera a que se procesen todos los mensajes encolados"""
+        for shard_queue in self._queues:
+            shard_queue.join()
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+
+        with self._lock:
+            if self._threads:
+                return
+            for i, shard_queue in enumerate(self._queues):
+                thread = threading.Thread(
+                    target=self._run,
+                    args=(shard_queue,),
+                    name=f"whatsapp-shard-{i}",
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self, shard_queue):
+        while True:
+            batch = [shard_queue.get()]
+
+            # Agrupar lo que ya esté en cola para usar una sola sesión de BD
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(shard_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            started_at = time.monotonic()
+            for enqueued_at, _ in batch:
+                metrics.observe("webhook_queue_wait", started_at - enqueued_at)
+
+            try:
+                with self.app.app_context():
+                    self.handler([message for _, message in batch])
+            except Exception:
+                metrics.incr("webhook_failed")
+                log.exception("Error procesando mensajes en segundo plano", messages=len(batch))
+            finally:
+                finished_at = time.monotonic()
+                metrics.observe("webhook_processing", finished_at - started_at)
+                self._add_in_flight(-len(batch))
+                for enqueued_at, _ in batch:
+                    metrics.observe("webhook_end_to_end", finished_at - enqueued_at)
+                    shard_queue.task_done()
+
+
+message_dispatcher = ShardedDispatcher()
@@ -0,0 +1,267 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+
+
+class LogSettings:
+    """Parámetros globales leídos en configure_logging (muestreo y redacción)"""
+
+    debug_sample_rate = 1.0
+    redact_phones = True
+
+
+REDACTED = "[REDACTED]"
+
+# Claves cuyo valor nunca se escribe (se compara en minúsculas, por subcadena)
+SECRET_KEYS = ("token", "authorization", "password", "secret", "claims", "api_key", "dni")
+
+# Claves que contienen teléfonos: se enmascaran (los correos se enmascaran en todo texto)
+PHONE_KEYS = ("phone", "sender", "recipient", "wa_id", "from", "to")
+
+# Claves con datos personales (nombres, direcciones, coordenadas): se compara la clave exacta
+PERSONAL_KEYS = (
+    "name", "full_name", "first_name", "last_name", "address", "pickup_address",
+    "delivery_address", "latitude", "longitude", "lat", "lng", "notes"
+)
+
+_JWT_RE = re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]*")
+_BEARER_RE = re.compile(r"(?i)bearer\s+[\w.~+/-]+=*")
+_PHONE_RE = re.compile(r"(?<![\w.])\+?\d{8,15}(?![\w.])")
+_EMAIL_RE = re.compile(r"([\w.+-])[\w.+-]*@([\w-]+\.[\w.-]+)")
+
+
+def mask_phone(value):
+    digits = str(value)
+    if len(digits) <= 4:
+        return "*" * len(digits)
+    return "*" * (len(digits) - 4) + digits[-4:]
+
+
+def redact_text(text):
+    text = _JWT_RE.sub(REDACTED, text)
+    text = _BEARER_RE.sub("Bearer " + REDACTED, text)
+    text = _EMAIL_RE.sub(r"\1***@\2", text)
+    if LogSettings.redact_phones:
+        text = _PHONE_RE.sub(lambda match: mask_phone(match.group(0)), text)
+    return text
+
+
+def redact(value, key=None):
+    """Copia de value sin tokens, con teléfonos y correos enmascarados"""
+    if key is not None:
+        lowered = str(key).lower()
+        if lowered in PERSONAL_KEYS or any(secret in lowered for secret in SECRET_KEYS):
+            return REDACTED if value is not None else None
+        if LogSettings.redact_phones and lowered in PHONE_KEYS and isinstance(value, (str, int)):
+            return mask_phone(value)
+
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return redact_text(value)
+    return value
+
+
+class StructuredLogger:
+    """
+    Logger con campos estructurados:
+
+        log = get_logger(__name__)
+        log.info("Mensaje duplicado ignorado", message_id=message_id)
+        log.debug("Contexto actualizado", sample=0.01, keys=sorted(data))
+
+    - Los campos se serializan (y se redactan) en el hilo del QueueListener,
+      no en el hilo que atiende la petición.
+    - Si el nivel está desactivado no se construye el registro.
+    - sample: fracción de eventos que se escriben (los debug usan
+      LOG_DEBUG_SAMPLE_RATE si no se indica).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._logger = logging.getLogger(name)
+
+    def isEnabledFor(self, level):
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, msg, sample=None, **fields):
+        self._log(logging.DEBUG, msg, fields, sample)
+
+    def info(self, msg, sample=None, **fields):
+        self._log(logging.INFO, msg, fields, sample)
+
+    def warning(self, msg, sample=None, **fields):
+        self._log(logging.WARNING, msg, fields, sample)
+
+    def error(self, msg, **fields):
+        self._log(logging.ERROR, msg, fields, None)
+
+    def exception(self, msg, **fields):
+        """Error con el traceback de la excepción que se está manejando"""
+        self._log(logging.ERROR, msg, fields, None, exc_info=True)
+
+    def _log(self, level, msg, fields, sample, exc_info=None):
+        if not self._logger.isEnabledFor(level):
+            return
+
+        if sample is None and level <= logging.DEBUG:
+            sample = LogSettings.debug_sample_rate
+        if sample is not None and sample < 1.0 and random.random() >= sample:
+            return
+
+        self._logger.log(level, msg, exc_info=exc_info, extra={"fields": fields}, stacklevel=3)
+
+
+def get_logger(name):
+    return StructuredLogger(name)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler con cola acotada: si el QueueListener no alcanza a escribir,
+    el registro se descarta (y se cuenta) en lugar de bloquear la petición.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Solo lo indispensable en el hilo de la petición: el mensaje, una
+        # copia de los campos mutables (p. ej. el contexto de la conversación
+        # sigue cambiando) y el traceback (los frames no se pueden formatear
+        # después). Los campos se formatean en el hilo del listener.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        fields = getattr(record, "fields", None)
+        if fields:
+            record.fields = {
+                key: copy.deepcopy(value) if isinstance(value, (dict, list, set)) else value
+                for key, value in fields.items()
+            }
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro: ts, level, logger, msg, campos y exc"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact_text(record.getMessage())
+        }
+
+        fields = getattr(record, "fields", None)
+        if fields:
+            for key, value in fields.items():
+                entry.setdefault(key, redact(value, key))
+
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formato legible para desarrollo: hora nivel logger mensaje clave=valor"""
+
+    def format(self, record):
+        line = (
+            f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]} "
+            f"{record.levelname:<7} {record.name} {redact_text(record.getMessage())}"
+        )
+
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(
+                f"{key}={json.dumps(redact(value, key), ensure_ascii=False, default=str)}"
+                for key, value in fields.items()
+            )
+
+        if record.exc_text:
+            line += "\n" + record.exc_text
+
+        return line
+
+
+_listener = None
+
+
+def _stop_listener():
+    """Escribe los registros pendientes y detiene el hilo del listener"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+def configure_logging(app):
+    """
+    Logging estructurado para la aplicación (logger "app" y sus hijos).
+
+    Los registros pasan por una cola acotada (NonBlockingQueueHandler) y un
+    QueueListener los formatea y escribe en stdout en su propio hilo.
+
+    Configuración (app.config):
+    - LOG_LEVEL: nivel del logger "app" (default "INFO")
+    - LOG_LEVELS: niveles por módulo, p. ej. {"app.services.whatsapp.flows": "DEBUG"}
+    - LOG_FORMAT: "json" o "text" (default "json")
+    - LOG_QUEUE_SIZE: registros en espera de escritura (default 10000)
+    - LOG_DEBUG_SAMPLE_RATE: fracción de eventos debug que se escriben (default 1.0)
+    - LOG_REDACT_PHONES: enmascarar teléfonos (default True)
+
+    Devuelve el handler de la cola (su atributo dropped cuenta los descartes).
+    """
+    global _listener
+
+    LogSettings.debug_sample_rate = app.config.get("LOG_DEBUG_SAMPLE_RATE", LogSettings.debug_sample_rate)
+    LogSettings.redact_phones = app.config.get("LOG_REDACT_PHONES", LogSettings.redact_phones)
+
+    formatter = TextFormatter() if app.config.get("LOG_FORMAT", "json") == "text" else JsonFormatter()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(formatter)
+
+    _stop_listener()
+
+    log_queue = queue.Queue(maxsize=app.config.get("LOG_QUEUE_SIZE", 10000))
+    handler = NonBlockingQueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+
+    # Flask usa el logger "app" (el nombre del paquete): con un handler ya
+    # configurado no agrega el suyo
+    root = logging.getLogger("app")
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(app.config.get("LOG_LEVEL", "INFO"))
+    root.propagate = False
+
+    for name, level in (app.config.get("LOG_LEVELS") or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    return handler
@@ -0,0 +1,42 @@
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from flask_limiter.util import get_remote_address
+
+
+# Límites por defecto de las rutas de la API (por usuario autenticado o por IP)
+DEFAULT_LIMITS = "200 per day;50 per hour"
+
+
+def identity_or_address():
+    """
+    Clave de rate limiting de la API: la identidad del JWT si la petición
+    trae un token válido (cada usuario tiene su propio cupo aunque comparta
+    IP, p. ej. detrás de un NAT) y la IP remota en otro caso.
+    """
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except Exception:
+        identity = None
+
+    if identity is not None:
+        return f"user:{identity}"
+    return f"ip:{get_remote_address()}"
+
+
+def configure_rate_limits(app):
+    """
+    Valores por defecto de Flask-Limiter (se pueden sobrescribir en la configuración):
+    - RATELIMIT_DEFAULT: límites por defecto de la API (DEFAULT_LIMITS)
+    - RATELIMIT_STORAGE_URI: almacenamiento compartido entre procesos, p. ej.
+      redis://localhost:6379/1 (Redis, KeyDB, Valkey, ...). Con "memory://"
+      (default) cada worker cuenta por separado: los límites, incluido el
+      límite por remitente del webhook, se multiplican por la cantidad de
+      workers.
+    - RATELIMIT_IN_MEMORY_FALLBACK_ENABLED: si el almacenamiento compartido no
+      responde, contar en memoria en lugar de fallar la petición (default True)
+    - RATELIMIT_KEY_PREFIX: prefijo de las claves en el almacenamiento compartido
+    """
+    app.config.setdefault("RATELIMIT_DEFAULT", DEFAULT_LIMITS)
+    app.config.setdefault("RATELIMIT_STORAGE_URI", "memory://")
+    app.config.setdefault("RATELIMIT_IN_MEMORY_FALLBACK_ENABLED", True)
+    app.config.setdefault("RATELIMIT_KEY_PREFIX", "transporte")
@@ -0,0 +1,27 @@
+from app import db
+
+
+class ServiceTransaction:
+    """
+    Transacción de un servicio.
+
+    - commit=True: el servicio confirma o revierte la sesión completa (uso desde la API).
+    - commit=False: el servicio trabaja dentro de un savepoint; si falla solo se
+      revierte su propio trabajo y el commit queda a cargo del llamador
+      (p. ej. el procesamiento de un mensaje de WhatsApp, que confirma una sola vez).
+    """
+
+    def __init__(self, commit=True):
+        self.savepoint = None if commit else db.session.begin_nested()
+
+    def commit(self):
+        if self.savepoint is None:
+            db.session.commit()
+        elif self.savepoint.is_active:
+            self.savepoint.commit()
+
+    def rollback(self):
+        if self.savepoint is None:
+            db.session.rollback()
+        elif self.savepoint.is_active:
+            self.savepoint.rollback()
@@ -0,0 +1,78 @@
+"""temp_data de whatsapp_users como JSONB y sin textos JSON antiguos
+
+Revision ID: 3f1c2a7d9e10
+Revises: 
+Create Date: 2026-10-18 12:00:00
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7d9e10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _column_type(bind, table, column):
+    for info in sa.inspect(bind).get_columns(table):
+        if info["name"] == column:
+            return info["type"]
+    return None
+
+
+def upgrade():
+    bind = op.get_bind()
+    is_postgresql = bind.dialect.name == "postgresql"
+
+    # El guardado parcial del contexto (temp_data - claves || cambios) usa
+    # operadores de jsonb: la columna creada como json debe convertirse
+    if is_postgresql and not isinstance(_column_type(bind, "whatsapp_users", "temp_data"), JSONB):
+        op.execute(
+            "ALTER TABLE whatsapp_users "
+            "ALTER COLUMN temp_data TYPE jsonb USING temp_data::jsonb"
+        )
+
+    # Valores antiguos guardados con json.dumps: un string JSON que contiene
+    # el objeto. Se reemplazan por el objeto (o NULL si no era un objeto).
+    column_type = JSONB(none_as_null=True) if is_postgresql else sa.JSON(none_as_null=True)
+    users = sa.table(
+        "whatsapp_users",
+        sa.column("id", sa.Integer),
+        sa.column("temp_data", column_type)
+    )
+
+    query = sa.select(users.c.id, users.c.temp_data)
+    if is_postgresql:
+        query = query.where(sa.func.jsonb_typeof(users.c.temp_data).in_(("string", "null")))
+    else:
+        query = query.where(users.c.temp_data.isnot(None))
+
+    for user_id, value in bind.execute(query).all():
+        if isinstance(value, dict):
+            continue
+
+        normalized = None
+        if isinstance(value, str):
+            try:
+                normalized = json.loads(value)
+            except ValueError:
+                normalized = None
+        if not isinstance(normalized, dict):
+            normalized = None
+
+        bind.execute(users.update().where(users.c.id == user_id).values(temp_data=normalized))
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        op.execute(
+            "ALTER TABLE whatsapp_users "
+            "ALTER COLUMN temp_data TYPE json USING temp_data::json"
+        )
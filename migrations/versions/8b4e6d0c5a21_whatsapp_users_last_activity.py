@@ -0,0 +1,41 @@
+"""last_activity_at e índice de barrido en whatsapp_users
+
+Revision ID: 8b4e6d0c5a21
+Revises: 3f1c2a7d9e10
+Create Date: 2026-10-18 12:05:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4e6d0c5a21'
+down_revision = '3f1c2a7d9e10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    columns = {column["name"] for column in inspector.get_columns("whatsapp_users")}
+    indexes = {index["name"] for index in inspector.get_indexes("whatsapp_users")}
+
+    if "last_activity_at" not in columns:
+        op.add_column("whatsapp_users", sa.Column("last_activity_at", sa.DateTime(), nullable=True))
+
+    # La tabla no tiene updated_at: las conversaciones existentes cuentan
+    # como activas desde ahora (UTC, como datetime.utcnow del modelo), así el
+    # SessionSweeper les da el plazo completo en lugar de archivarlas de una
+    now = sa.text("timezone('utc', now())") if bind.dialect.name == "postgresql" else sa.func.current_timestamp()
+    users = sa.table("whatsapp_users", sa.column("last_activity_at", sa.DateTime()))
+    op.execute(users.update().where(users.c.last_activity_at.is_(None)).values(last_activity_at=now))
+
+    if "ix_whatsapp_users_last_activity" not in indexes:
+        op.create_index("ix_whatsapp_users_last_activity", "whatsapp_users", ["last_activity_at", "id"])
+
+
+def downgrade():
+    op.drop_index("ix_whatsapp_users_last_activity", table_name="whatsapp_users")
+    op.drop_column("whatsapp_users", "last_activity_at")
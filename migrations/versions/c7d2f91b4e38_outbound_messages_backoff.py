@@ -0,0 +1,47 @@
+"""Backoff de reintentos y payload borrable en outbound_messages
+
+Revision ID: c7d2f91b4e38
+Revises: 8b4e6d0c5a21
+Create Date: 2026-10-18 12:10:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2f91b4e38'
+down_revision = '8b4e6d0c5a21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "outbound_messages" not in inspector.get_table_names():
+        return
+
+    columns = {column["name"]: column for column in inspector.get_columns("outbound_messages")}
+
+    with op.batch_alter_table("outbound_messages") as batch:
+        if "next_attempt_at" not in columns:
+            batch.add_column(sa.Column("next_attempt_at", sa.DateTime(), nullable=True))
+        if not columns["payload"]["nullable"]:
+            batch.alter_column("payload", existing_type=sa.Text(), nullable=True)
+
+    # Los mensajes ya terminados no conservan su contenido (p. ej. contraseñas temporales)
+    messages = sa.table("outbound_messages", sa.column("status", sa.String), sa.column("payload", sa.Text))
+    op.execute(
+        messages.update()
+        .where(messages.c.status.in_(("sent", "failed")), messages.c.payload.isnot(None))
+        .values(payload=None)
+    )
+
+
+def downgrade():
+    messages = sa.table("outbound_messages", sa.column("payload", sa.Text))
+    op.execute(messages.update().where(messages.c.payload.is_(None)).values(payload=""))
+
+    with op.batch_alter_table("outbound_messages") as batch:
+        batch.alter_column("payload", existing_type=sa.Text(), nullable=False)
+        batch.drop_column("next_attempt_at")
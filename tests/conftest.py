@@ -0,0 +1,127 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+
+class TestConfig:
+    """Configuración mínima de las pruebas (SQLite en un archivo temporal por prueba)"""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SECRET_KEY = "test-secret-key-with-enough-length-32b"
+    JWT_SECRET_KEY = "test-jwt-secret-key-with-enough-length"
+    CORS_ORIGINS = "*"
+    VERIFY_TOKEN = "test-verify-token"
+    ACCESS_TOKEN = "test-access-token"
+    PHONE_NUMBER_ID = "1000"
+    WHATSAPP_API_BASE_URL = "http://127.0.0.1:9"
+    WHATSAPP_SESSION_SWEEP = False
+    WHATSAPP_EVENT_LOG_DIR = None
+    LOG_LEVEL = "WARNING"
+    RATELIMIT_ENABLED = False
+
+
+# config.py no forma parte del repositorio (credenciales de cada despliegue):
+# sin él, las pruebas usan TestConfig como configuración por defecto
+try:
+    import config  # noqa: F401
+except ImportError:
+    sys.modules["config"] = types.SimpleNamespace(Config=TestConfig)
+
+
+# Motores adicionales para las pruebas que dependen del dialecto,
+# p. ej. TEST_POSTGRES_URI=postgresql://localhost/transporte_test
+DATABASE_URIS = {"sqlite": None}
+if os.environ.get("TEST_POSTGRES_URI"):
+    DATABASE_URIS["postgresql"] = os.environ["TEST_POSTGRES_URI"]
+
+
+def make_app(tmp_path, database_uri=None, **overrides):
+    from app import create_app, db
+
+    settings = dict(
+        SQLALCHEMY_DATABASE_URI=database_uri or f"sqlite:///{tmp_path / 'test.db'}",
+        **overrides
+    )
+    app_config = type("AppTestConfig", (TestConfig,), settings)
+    app = create_app(app_config)
+
+    with app.app_context():
+        # Una BD compartida (PostgreSQL) puede traer datos de otra prueba
+        if database_uri:
+            db.drop_all()
+            db.create_all()
+    return app
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path)
+    with app.app_context():
+        yield app
+        _teardown()
+
+
+@pytest.fixture(params=sorted(DATABASE_URIS))
+def any_dialect_app(request, tmp_path):
+    """La aplicación sobre cada motor configurado (SQLite siempre; PostgreSQL con TEST_POSTGRES_URI)"""
+    app = make_app(tmp_path, DATABASE_URIS[request.param])
+    with app.app_context():
+        yield app
+        _teardown()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def create_driver(driver_id, **fields):
+    from app import db
+    from app.models.driver import Driver
+
+    driver = Driver(
+        id=driver_id,
+        email=f"driver{driver_id}@example.com",
+        password_hash="x",
+        full_name=f"Conductor {driver_id}",
+        license_number=f"LIC-{driver_id}",
+        **fields
+    )
+    db.session.add(driver)
+    db.session.commit()
+    return driver
+
+
+def create_package_trip(status=None, description="Sobre con documentos"):
+    from app import db
+    from app.models.enums import AddressType, TripStatus, TripType
+    from app.models.package import PackageTrip
+    from app.models.trip_addresses import Address
+
+    pickup = Address(address_text="Calle 26 #59-51", type=AddressType.PICKUP, order=1)
+    delivery = Address(address_text="Carrera 15 #93-60", type=AddressType.DELIVERY, order=2)
+    db.session.add_all([pickup, delivery])
+    db.session.flush()
+
+    trip = PackageTrip(
+        trip_type=TripType.PACKAGE,
+        status=status or TripStatus.AVAILABLE,
+        package_description=description,
+        pickup_address_id=pickup.id,
+        delivery_address_id=delivery.id
+    )
+    db.session.add(trip)
+    db.session.commit()
+    return trip
+
+
+def _teardown():
+    from app import db
+
+    db.session.remove()
+    db.engine.dispose()
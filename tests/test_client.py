@@ -0,0 +1,23 @@
+from conftest import make_app
+from app.services.whatsapp.client import get_client
+
+
+def test_client_uses_the_app_config(tmp_path):
+    make_app(tmp_path, WHATSAPP_API_BASE_URL="http://127.0.0.1:5005", PHONE_NUMBER_ID="2000")
+    assert get_client().url == "http://127.0.0.1:5005/v20.0/2000/messages"
+
+    # Otra aplicación (otra configuración) reemplaza al cliente anterior
+    make_app(tmp_path, WHATSAPP_API_BASE_URL="http://127.0.0.1:6006", WHATSAPP_API_VERSION="v21.0")
+    client = get_client()
+    assert client.url == "http://127.0.0.1:6006/v21.0/1000/messages"
+    assert client.headers["Authorization"] == "Bearer test-access-token"
+
+
+def test_webhook_verification_uses_the_app_config(tmp_path):
+    client = make_app(tmp_path, VERIFY_TOKEN="secreto-de-la-app").test_client()
+
+    accepted = client.get("/webhook", query_string={"hub.verify_token": "secreto-de-la-app", "hub.challenge": "42"})
+    assert accepted.status_code == 200 and accepted.get_data(as_text=True) == "42"
+
+    rejected = client.get("/webhook", query_string={"hub.verify_token": "test-verify-token", "hub.challenge": "42"})
+    assert rejected.status_code == 403
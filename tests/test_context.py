@@ -0,0 +1,83 @@
+from app import db
+from app.models.whatsapp_user import WhatsAppUser
+from app.services.whatsapp.context import ConversationContext, get_context, save_context
+
+
+def _create_user(temp_data):
+    wa_user = WhatsAppUser(phone="5491100000001", flow="multilocation", step="input_address_text", temp_data=temp_data)
+    db.session.add(wa_user)
+    db.session.commit()
+    wa_user_id = wa_user.id
+    db.session.remove()
+    return wa_user_id
+
+
+def _reload(wa_user_id):
+    db.session.remove()
+    return db.session.get(WhatsAppUser, wa_user_id)
+
+
+def test_nested_edits_are_saved(any_dialect_app):
+    wa_user_id = _create_user({
+        "current_location": {"address": "Av. Siempre Viva 742"},
+        "locations_ida": [{"address": "Origen", "type": "pickup"}]
+    })
+
+    wa_user = db.session.get(WhatsAppUser, wa_user_id)
+    data = get_context(wa_user)
+    data.current_location["type"] = "dropoff"
+    data.locations_ida.append(dict(data.current_location))
+    save_context(wa_user)
+    db.session.commit()
+
+    saved = _reload(wa_user_id).temp_data
+    assert saved["current_location"] == {"address": "Av. Siempre Viva 742", "type": "dropoff"}
+    assert saved["locations_ida"] == [
+        {"address": "Origen", "type": "pickup"},
+        {"address": "Av. Siempre Viva 742", "type": "dropoff"}
+    ]
+
+
+def test_removed_and_added_keys_are_saved(any_dialect_app):
+    wa_user_id = _create_user({"previous_flow": "round_trip", "notes": "x"})
+
+    wa_user = db.session.get(WhatsAppUser, wa_user_id)
+    data = get_context(wa_user)
+    del data["notes"]
+    data["pickup_address"] = {"latitude": -34.6, "longitude": -58.4}
+    save_context(wa_user)
+    db.session.commit()
+
+    assert _reload(wa_user_id).temp_data == {
+        "previous_flow": "round_trip",
+        "pickup_address": {"latitude": -34.6, "longitude": -58.4}
+    }
+
+
+def test_legacy_text_value_is_rewritten(any_dialect_app):
+    wa_user_id = _create_user('{"previous_flow": "parcel"}')
+
+    wa_user = db.session.get(WhatsAppUser, wa_user_id)
+    data = get_context(wa_user)
+    assert data.previous_flow == "parcel"
+    data.locations_ida.append({"address": "Origen"})
+    save_context(wa_user)
+    db.session.commit()
+
+    assert _reload(wa_user_id).temp_data == {
+        "previous_flow": "parcel",
+        "locations_ida": [{"address": "Origen"}]
+    }
+
+
+def test_context_does_not_share_nested_values():
+    raw = {"current_location": {"address": "Origen"}, "locations_ida": []}
+    data = ConversationContext(raw)
+
+    data.current_location["type"] = "pickup"
+    data.locations_ida.append({"address": "Destino"})
+
+    assert raw == {"current_location": {"address": "Origen"}, "locations_ida": []}
+    changed, removed = data.changes()
+    assert set(changed) == {"current_location", "locations_ida"}
+    assert removed == []
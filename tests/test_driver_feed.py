@@ -0,0 +1,66 @@
+import pytest
+from flask_jwt_extended import create_access_token
+
+from conftest import create_driver, create_package_trip
+
+
+@pytest.fixture
+def feed(app, client):
+    driver = create_driver(8001)
+    create_package_trip()
+    token = create_access_token(identity=str(driver.id), additional_claims={"role": "driver"})
+
+    def get(headers=None, **params):
+        return client.get(
+            f"/api/drivers/{driver.id}/feed",
+            query_string=params,
+            headers={"Authorization": f"Bearer {token}", **(headers or {})}
+        )
+    return get
+
+
+def test_same_page_returns_304(feed):
+    first = feed()
+    assert first.status_code == 200
+    assert len(first.get_json()["items"]) == 1
+    etag = first.headers["ETag"]
+
+    again = feed(headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+
+
+def test_new_work_changes_the_etag(feed):
+    etag = feed().headers["ETag"]
+    create_package_trip(description="Caja pequeña")
+
+    response = feed(headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.get_json()["items"]) == 2
+    assert response.headers["ETag"] != etag
+
+
+@pytest.mark.parametrize("limit", ["abc", "1.5", "0", "-3"])
+def test_invalid_limit_is_rejected(feed, limit):
+    response = feed(limit=limit)
+
+    assert response.status_code == 400
+    assert response.get_json() == {"success": False, "message": "limit debe ser un entero positivo"}
+
+
+def test_limit_is_capped_and_pages_follow_the_cursor(feed):
+    create_package_trip(description="Caja pequeña")
+
+    first = feed(limit=1).get_json()
+    assert len(first["items"]) == 1 and first["next_cursor"]
+
+    second = feed(limit=1000, cursor=first["next_cursor"]).get_json()
+    assert len(second["items"]) == 1 and second["next_cursor"] is None
+    assert second["items"][0]["id"] != first["items"][0]["id"]
+
+
+def test_invalid_cursor_is_rejected(feed):
+    response = feed(cursor="not-a-cursor")
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "Cursor inválido"
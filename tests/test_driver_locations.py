@@ -0,0 +1,68 @@
+import time
+from datetime import datetime
+
+from sqlalchemy.dialects import mysql
+
+from conftest import create_driver
+from app import db
+from app.models.driver_location import DriverLocation
+from app.services.driver_locations import _upsert_statement, driver_locations
+
+
+def _stored(driver_id):
+    db.session.expire_all()
+    return db.session.get(DriverLocation, driver_id)
+
+
+def test_flush_keeps_the_latest_position(app):
+    create_driver(7001)
+    now = time.time()
+
+    driver_locations.record([(7001, 4.60, -74.08, now - 10)])
+    driver_locations.flush_all()
+    driver_locations.record([(7001, 4.61, -74.09, now)])
+    driver_locations.flush_all()
+
+    stored = _stored(7001)
+    assert (stored.latitude, stored.longitude) == (4.61, -74.09)
+
+
+def test_late_batch_does_not_overwrite_a_newer_position(app):
+    create_driver(7002)
+    newer = datetime(2026, 1, 1, 12, 0, 5)
+    older = datetime(2026, 1, 1, 12, 0, 0)
+
+    for reported_at, lat in ((newer, 4.7), (older, 4.6)):
+        db.session.execute(_upsert_statement("sqlite"), [{
+            "driver_id": 7002, "latitude": lat, "longitude": -74.0,
+            "reported_at": reported_at, "updated_at": datetime.utcnow()
+        }])
+        db.session.commit()
+
+    stored = _stored(7002)
+    assert (stored.latitude, stored.reported_at) == (4.7, newer)
+
+
+def test_unknown_driver_does_not_block_the_batch(app):
+    create_driver(7003)
+    now = time.time()
+
+    driver_locations.record([(7003, 4.6, -74.0, now), (7999, 4.6, -74.0, now)])
+    driver_locations.flush_all()
+
+    assert _stored(7003) is not None
+    assert _stored(7999) is None
+    assert driver_locations.store.get(7999) is None
+
+
+def test_mysql_upsert_keeps_the_newer_position():
+    sql = str(_upsert_statement("mysql").compile(dialect=mysql.dialect()))
+
+    assert "ON DUPLICATE KEY UPDATE" in sql
+    # Cada columna se actualiza solo si la fila nueva no es más vieja, y
+    # reported_at va al final (MySQL aplica las asignaciones en orden)
+    assignments = sql.split("ON DUPLICATE KEY UPDATE", 1)[1].split(" END, ")
+    assert [assignment.split(" = ")[0].strip() for assignment in assignments] == [
+        "latitude", "longitude", "updated_at", "reported_at"
+    ]
+    assert all("driver_locations.reported_at <= VALUES(reported_at)" in assignment for assignment in assignments)
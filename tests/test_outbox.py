@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+from app import db
+from app.models.outbound_message import OutboundMessage
+from app.services.whatsapp.outbox import outbox_sender
+
+
+def _queue(recipient, count=1, **fields):
+    messages = [
+        OutboundMessage(recipient=recipient, payload='{"text": "hola"}', **fields)
+        for _ in range(count)
+    ]
+    db.session.add_all(messages)
+    db.session.commit()
+    return [message.id for message in messages]
+
+
+def _claimed_ids(monkeypatch, batch_size):
+    monkeypatch.setattr(outbox_sender, "batch_size", batch_size)
+    return [message_id for message_id, _, _, _ in outbox_sender._claim_batch()]
+
+
+def test_recipient_in_backoff_does_not_starve_others(app, monkeypatch):
+    # Un destinatario con el primer mensaje esperando su reintento y una cola
+    # más larga que el lote detrás de él
+    _queue("5491100000001", attempts=1, next_attempt_at=datetime.utcnow() + timedelta(minutes=5))
+    _queue("5491100000001", count=10)
+    other = _queue("5491100000002", count=2) + _queue("5491100000003")
+
+    assert _claimed_ids(monkeypatch, batch_size=5) == other
+
+
+def test_messages_behind_a_sending_message_wait(app, monkeypatch):
+    _queue("5491100000001", status=OutboundMessage.STATUS_SENDING, claimed_at=datetime.utcnow())
+    _queue("5491100000001", count=3)
+    other = _queue("5491100000002")
+
+    assert _claimed_ids(monkeypatch, batch_size=2) == other
+
+
+def test_recipient_chain_is_claimed_in_order(app, monkeypatch):
+    first = _queue("5491100000001", count=3)
+    second = _queue("5491100000002", count=2)
+
+    assert _claimed_ids(monkeypatch, batch_size=10) == first + second
+    statuses = {message.status for message in OutboundMessage.query}
+    assert statuses == {OutboundMessage.STATUS_SENDING}
+
+
+def test_due_retry_is_claimed_with_its_followers(app, monkeypatch):
+    head = _queue("5491100000001", attempts=1, next_attempt_at=datetime.utcnow() - timedelta(seconds=1))
+    followers = _queue("5491100000001", count=2)
+
+    assert _claimed_ids(monkeypatch, batch_size=10) == head + followers
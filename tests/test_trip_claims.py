@@ -0,0 +1,60 @@
+import threading
+
+from conftest import create_driver, create_package_trip
+from app import db
+from app.models.custom import CustomTrip
+from app.models.enums import TripStatus
+from app.models.package import PackageTrip
+from app.models.trip import Trip
+from app.services.trip_claims import claim_trip
+
+
+def test_second_claim_loses_and_reports_the_winner(app):
+    first, second = create_driver(9001), create_driver(9002)
+    trip_id = create_package_trip().id
+
+    won = claim_trip(PackageTrip, trip_id, first.id)
+    lost = claim_trip(PackageTrip, trip_id, second.id)
+
+    assert won == (True, True, TripStatus.PENDING, first.id)
+    assert lost == (False, True, TripStatus.PENDING, first.id)
+
+
+def test_claim_checks_the_trip_kind(app):
+    driver = create_driver(9003)
+    trip_id = create_package_trip().id
+
+    assert claim_trip(CustomTrip, trip_id, driver.id) == (False, False, None, None)
+    assert claim_trip(PackageTrip, trip_id + 1000, driver.id) == (False, False, None, None)
+    assert db.session.get(Trip, trip_id).status == TripStatus.AVAILABLE
+
+
+def test_simultaneous_claims_have_a_single_winner(app):
+    drivers = [create_driver(9100 + index).id for index in range(8)]
+    trip_id = create_package_trip().id
+
+    barrier = threading.Barrier(len(drivers))
+    results = {}
+
+    def attempt(driver_id):
+        with app.app_context():
+            db.session.connection()
+            barrier.wait()
+            try:
+                results[driver_id] = claim_trip(PackageTrip, trip_id, driver_id)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=attempt, args=(driver_id,)) for driver_id in drivers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [driver_id for driver_id, result in results.items() if result.claimed]
+    assert len(results) == len(drivers)
+    assert len(winners) == 1
+    assert all(result.driver_id == winners[0] for result in results.values())
+
+    db.session.expire_all()
+    assert db.session.get(Trip, trip_id).driver_id == winners[0]
@@ -0,0 +1,73 @@
+import pytest
+
+from conftest import make_app
+from app.services.whatsapp.admission import LIMITED, admission_controller
+from app.services.whatsapp.metrics import metrics
+from app.services.whatsapp.worker import message_dispatcher
+
+
+def _payload(*messages):
+    return {
+        "entry": [{
+            "changes": [{
+                "value": {
+                    "messages": [
+                        {"id": message_id, "from": sender, "type": "text", "text": {"body": "hola"}}
+                        for message_id, sender in messages
+                    ]
+                }
+            }]
+        }]
+    }
+
+
+@pytest.fixture
+def limited_app(tmp_path, monkeypatch):
+    app = make_app(tmp_path, RATELIMIT_ENABLED=True, WHATSAPP_WEBHOOK_RATE_LIMIT="2 per minute")
+    submitted = []
+    monkeypatch.setattr(message_dispatcher, "submit", lambda message: submitted.append(message) or True)
+    with app.app_context():
+        yield app, submitted
+
+
+def test_sender_over_limit_does_not_reject_the_batch(limited_app):
+    app, submitted = limited_app
+    before = metrics.snapshot().get("counters", {}).get("webhook_rate_limited", 0)
+
+    response = app.test_client().post("/webhook", json=_payload(
+        ("wamid.1", "5491100000001"),
+        ("wamid.2", "5491100000001"),
+        ("wamid.3", "5491100000001"),
+        ("wamid.4", "5491100000002"),
+    ))
+
+    assert response.status_code == 200
+    assert [message[0] for message in submitted] == ["wamid.1", "wamid.2", "wamid.4"]
+    after = metrics.snapshot().get("counters", {}).get("webhook_rate_limited", 0)
+    assert after - before == 1
+
+
+def test_sender_limit_holds_across_deliveries(limited_app):
+    app, submitted = limited_app
+    client = app.test_client()
+
+    for index in range(3):
+        response = client.post("/webhook", json=_payload((f"wamid.{index}", "5491100000001")))
+        assert response.status_code == 200
+
+    assert [message[0] for message in submitted] == ["wamid.0", "wamid.1"]
+    assert admission_controller.admit(("wamid.9", "5491100000001", "hola", None)) == LIMITED
+
+
+def test_sender_limit_can_be_disabled(tmp_path, monkeypatch):
+    app = make_app(tmp_path, RATELIMIT_ENABLED=True, WHATSAPP_WEBHOOK_RATE_LIMIT=None)
+    submitted = []
+    monkeypatch.setattr(message_dispatcher, "submit", lambda message: submitted.append(message) or True)
+
+    with app.app_context():
+        response = app.test_client().post("/webhook", json=_payload(
+            *[(f"wamid.{index}", "5491100000001") for index in range(5)]
+        ))
+
+    assert response.status_code == 200
+    assert len(submitted) == 5
@@ -0,0 +1,186 @@
+"""
+Benchmark de concurrencia al tomar viajes (ver app/services/trip_claims.py).
+
+Lanza N intentos simultáneos de tomar el mismo viaje (un hilo y una conexión
+por conductor, liberados a la vez con una barrera) y verifica que haya
+exactamente un ganador. Repite --rounds veces, devolviendo el viaje a
+AVAILABLE antes de cada ronda.
+
+Modos:
+- claim (default): UPDATE condicional (claim_trip), como la API
+- naive: lectura → verificación de status → escritura → commit, como lo
+  hacía la API antes; sirve para ver la doble asignación que se corrige
+
+La BD de --database se modifica (el viaje queda asignado a algún conductor
+de la prueba): usar una BD de pruebas.
+
+Uso:
+    python tools/claim_bench.py --database postgresql://localhost/transporte_bench \\
+        --trip-id 42 --kind package --claims 200 --rounds 20
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Intentos simultáneos de tomar un mismo viaje")
+    parser.add_argument("--database", required=True, help="URI de la BD de pruebas (se modifica)")
+    parser.add_argument("--trip-id", type=int, required=True, help="Viaje (paquete o personalizado) a disputar")
+    parser.add_argument("--kind", choices=("package", "custom"), default="package")
+    parser.add_argument("--claims", type=int, default=100, help="Intentos simultáneos por ronda")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--mode", choices=("claim", "naive"), default="claim")
+    return parser.parse_args()
+
+
+def create_bench_app(args):
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = args.database
+        # Una conexión por hilo: todos los intentos llegan a la BD a la vez
+        SQLALCHEMY_ENGINE_OPTIONS = {"pool_size": args.claims, "max_overflow": 10}
+        WHATSAPP_EVENT_LOG_DIR = None
+        WHATSAPP_SESSION_SWEEP = False
+
+    from app import create_app
+    return create_app(BenchConfig)
+
+
+def naive_claim(model, trip_id, driver_id, vehicle_id=None):
+    """Lectura → verificación → escritura (el patrón anterior, con la carrera)"""
+    from app import db
+    from app.models.enums import TripStatus
+
+    trip = db.session.get(model, trip_id)
+    if trip is None or trip.status != TripStatus.AVAILABLE:
+        db.session.rollback()
+        return False
+
+    trip.driver_id = driver_id
+    trip.vehicle_id = vehicle_id
+    trip.status = TripStatus.PENDING
+    db.session.commit()
+    return True
+
+
+def reset_trip(model, trip_id):
+    from app import db
+    from app.models.enums import TripStatus
+    from app.models.trip import Trip
+
+    trip = db.session.get(model, trip_id)
+    if trip is None:
+        raise SystemExit(f"No existe el viaje {trip_id} del tipo indicado")
+
+    db.session.query(Trip).filter(Trip.id == trip_id).update(
+        {"status": TripStatus.AVAILABLE, "driver_id": None, "vehicle_id": None},
+        synchronize_session=False
+    )
+    db.session.commit()
+
+
+def run_round(app, model, args, driver_ids):
+    from app import db
+    from app.services.trip_claims import claim_trip
+
+    barrier = threading.Barrier(args.claims)
+    latencies = [0.0] * args.claims
+    winners = []
+    errors = []
+    lock = threading.Lock()
+
+    def attempt(index):
+        driver_id = driver_ids[index % len(driver_ids)]
+        with app.app_context():
+            # Conexión abierta antes de la barrera: solo se mide el intento
+            db.session.connection()
+            barrier.wait()
+            started_at = time.perf_counter()
+            try:
+                if args.mode == "claim":
+                    won = claim_trip(model, args.trip_id, driver_id).claimed
+                else:
+                    won = naive_claim(model, args.trip_id, driver_id)
+            except Exception as e:
+                db.session.rollback()
+                with lock:
+                    errors.append(type(e).__name__)
+                return
+            finally:
+                latencies[index] = time.perf_counter() - started_at
+                db.session.remove()
+
+            if won:
+                with lock:
+                    winners.append(driver_id)
+
+    threads = [threading.Thread(target=attempt, args=(i,)) for i in range(args.claims)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+
+    return winners, errors, latencies, elapsed
+
+
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main():
+    args = parse_args()
+    app = create_bench_app(args)
+
+    from app import db
+    from app.models.custom import CustomTrip
+    from app.models.driver import Driver
+    from app.models.package import PackageTrip
+
+    model = PackageTrip if args.kind == "package" else CustomTrip
+
+    with app.app_context():
+        driver_ids = [row.id for row in db.session.query(Driver.id).order_by(Driver.id).limit(args.claims)]
+    if not driver_ids:
+        raise SystemExit("La BD no tiene conductores")
+
+    print(f"🏁 {args.claims} intentos simultáneos x {args.rounds} rondas sobre el viaje {args.trip_id} "
+          f"(modo {args.mode}, {len(driver_ids)} conductores distintos)")
+
+    outcomes = Counter()
+    all_latencies = []
+    all_errors = Counter()
+    for round_number in range(1, args.rounds + 1):
+        with app.app_context():
+            reset_trip(model, args.trip_id)
+
+        winners, errors, latencies, elapsed = run_round(app, model, args, driver_ids)
+        outcomes[len(winners)] += 1
+        all_latencies.extend(latencies)
+        all_errors.update(errors)
+
+        print(f"   ronda {round_number:>3}: ganadores={len(winners)} errores={len(errors)} "
+              f"en {elapsed * 1000:.1f} ms")
+
+    print(f"\n📊 Ganadores por ronda: {dict(sorted(outcomes.items()))}")
+    if set(outcomes) != {1}:
+        print("   ⚠️ Hubo rondas sin exactamente un ganador")
+    if all_errors:
+        print(f"   Errores: {dict(all_errors)}")
+    print(f"   Latencia por intento: p50 {percentile(all_latencies, 50) * 1000:.2f} ms, "
+          f"p99 {percentile(all_latencies, 99) * 1000:.2f} ms, "
+          f"max {max(all_latencies) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
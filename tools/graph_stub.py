@@ -0,0 +1,308 @@
+"""
+Servidor local que imita la Graph API de WhatsApp (pruebas de carga e integración).
+
+- POST /<version>/<phone_number_id>/messages: registra el payload y responde como
+  la Cloud API ({"messages": [{"id": "wamid..."}]}), con latencia y errores
+  (429 / 5xx) inyectables.
+- /_stub/*: control del servidor (mensajes recibidos, fallas, webhooks).
+
+Uso:
+    python tools/graph_stub.py --port 5005 --webhook-url http://localhost:5000/webhook
+
+y en la configuración del backend:
+    WHATSAPP_API_BASE_URL = "http://localhost:5005"
+"""
+import argparse
+import itertools
+import random
+import threading
+import time
+import uuid
+
+import requests
+from flask import Flask, jsonify, request
+
+
+class GraphStub:
+    """
+    Estado del servidor: mensajes recibidos y fallas configuradas.
+
+    Fallas (todas opcionales, modificables con POST /_stub/config):
+    - latency_ms / latency_jitter_ms: demora de cada respuesta
+    - rate_429: probabilidad (0-1) de responder 429 con Retry-After
+    - rate_5xx: probabilidad (0-1) de responder 500/502/503
+    - retry_after: segundos enviados en el header Retry-After
+    - max_rps: límite de mensajes/s; por encima responde 429 (como el throughput de Meta)
+    - status_callbacks: enviar al webhook los estados sent/delivered de cada mensaje
+    """
+
+    DEFAULTS = {
+        "latency_ms": 0,
+        "latency_jitter_ms": 0,
+        "rate_429": 0.0,
+        "rate_5xx": 0.0,
+        "retry_after": 1,
+        "max_rps": None,
+        "status_callbacks": False
+    }
+
+    def __init__(self, webhook_url=None, max_records=100000, listener=None, **faults):
+        self.webhook_url = webhook_url
+        self.max_records = max_records
+        # Callback (wamid, payload, received_at) por cada mensaje aceptado (ver loadgen.py)
+        self.listener = listener
+        self.faults = {**self.DEFAULTS, **faults}
+        self.messages = []
+        self.counters = {"received": 0, "accepted": 0, "throttled": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+        self._sequence = itertools.count(1)
+        self._callbacks = requests.Session()
+
+    def configure(self, **faults):
+        with self._lock:
+            unknown = set(faults) - set(self.DEFAULTS)
+            if unknown:
+                raise ValueError(f"Parámetros desconocidos: {sorted(unknown)}")
+            self.faults.update(faults)
+            return dict(self.faults)
+
+    def reset(self):
+        with self._lock:
+            self.messages = []
+            self.counters = {key: 0 for key in self.counters}
+
+    def received(self, to=None, since=0):
+        with self._lock:
+            messages = self.messages[since:]
+        if to:
+            messages = [m for m in messages if m["payload"].get("to") == to]
+        return messages
+
+    def handle_send(self, phone_number_id, payload):
+        """Devuelve (status_code, body, headers) para un POST a /messages"""
+        faults = self.faults
+
+        delay = faults["latency_ms"] + random.uniform(0, faults["latency_jitter_ms"])
+        if delay:
+            time.sleep(delay / 1000.0)
+
+        with self._lock:
+            self.counters["received"] += 1
+
+            if self._over_rate_limit(faults["max_rps"]) or random.random() < faults["rate_429"]:
+                self.counters["throttled"] += 1
+                return 429, _error(130429, "Rate limit hit"), {"Retry-After": str(faults["retry_after"])}
+
+            if random.random() < faults["rate_5xx"]:
+                self.counters["errors"] += 1
+                return random.choice([500, 502, 503]), _error(131000, "Something went wrong"), {}
+
+            wamid = f"wamid.STUB{next(self._sequence):012d}"
+            received_at = time.time()
+            self.counters["accepted"] += 1
+            self.messages.append({
+                "id": wamid,
+                "phone_number_id": phone_number_id,
+                "payload": payload,
+                "received_at": received_at
+            })
+            if len(self.messages) > self.max_records:
+                del self.messages[:len(self.messages) - self.max_records]
+
+        if self.listener is not None:
+            self.listener(wamid, payload, received_at)
+
+        if faults["status_callbacks"] and self.webhook_url:
+            threading.Thread(
+                target=self._post_statuses,
+                args=(phone_number_id, wamid, payload.get("to")),
+                daemon=True
+            ).start()
+
+        return 200, {
+            "messaging_product": "whatsapp",
+            "contacts": [{"input": payload.get("to"), "wa_id": payload.get("to")}],
+            "messages": [{"id": wamid}]
+        }, {}
+
+    def _over_rate_limit(self, max_rps):
+        if not max_rps:
+            return False
+        second = int(time.monotonic())
+        start, count = self._window
+        if start != second:
+            start, count = second, 0
+        self._window = (start, count + 1)
+        return count + 1 > max_rps
+
+    # ============== WEBHOOKS HACIA EL BACKEND ==============
+
+    def post_inbound(self, sender, text=None, button_id=None, list_id=None,
+                     location=None, phone_number_id="STUB_PHONE_ID"):
+        """
+        Envía al webhook del backend un mensaje entrante con el formato de Meta.
+        Devuelve (wamid, status_code).
+        """
+        if not self.webhook_url:
+            raise ValueError("El stub no tiene webhook_url configurado")
+
+        message = build_inbound_message(sender, text, button_id, list_id, location)
+        response = self._callbacks.post(
+            self.webhook_url,
+            json=build_webhook(phone_number_id, messages=[message]),
+            timeout=10
+        )
+        return message["id"], response.status_code
+
+    def _post_statuses(self, phone_number_id, wamid, recipient):
+        for status in ("sent", "delivered"):
+            try:
+                self._callbacks.post(
+                    self.webhook_url,
+                    json=build_webhook(phone_number_id, statuses=[{
+                        "id": wamid,
+                        "status": status,
+                        "timestamp": str(int(time.time())),
+                        "recipient_id": recipient
+                    }]),
+                    timeout=10
+                )
+            except requests.RequestException as e:
+                print(f"⚠️ No se pudo enviar el estado {status} de {wamid}: {e}")
+
+
+def build_inbound_message(sender, text=None, button_id=None, list_id=None, location=None):
+    """Mensaje entrante tal como lo envía WhatsApp en value.messages[]"""
+    message = {
+        "from": sender,
+        "id": f"wamid.IN{uuid.uuid4().hex}",
+        "timestamp": str(int(time.time()))
+    }
+
+    if button_id is not None:
+        message["type"] = "interactive"
+        message["interactive"] = {"type": "button_reply", "button_reply": {"id": button_id, "title": button_id}}
+    elif list_id is not None:
+        message["type"] = "interactive"
+        message["interactive"] = {"type": "list_reply", "list_reply": {"id": list_id, "title": list_id}}
+    elif location is not None:
+        message["type"] = "location"
+        message["location"] = location
+    else:
+        message["type"] = "text"
+        message["text"] = {"body": text or ""}
+
+    return message
+
+
+def build_webhook(phone_number_id, messages=None, statuses=None):
+    value = {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "15550000000", "phone_number_id": phone_number_id}
+    }
+    if messages:
+        value["messages"] = messages
+        value["contacts"] = [{"profile": {"name": "Stub"}, "wa_id": m["from"]} for m in messages]
+    if statuses:
+        value["statuses"] = statuses
+
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "STUB_WABA_ID", "changes": [{"field": "messages", "value": value}]}]
+    }
+
+
+def _error(code, message):
+    return {"error": {"message": message, "type": "OAuthException", "code": code, "fbtrace_id": "stub"}}
+
+
+def create_stub_app(stub=None):
+    stub = stub or GraphStub()
+    app = Flask(__name__)
+    app.config["GRAPH_STUB"] = stub
+
+    @app.route("/<version>/<phone_number_id>/messages", methods=["POST"])
+    def messages(version, phone_number_id):
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return jsonify(_error(100, "Invalid JSON payload")), 400
+
+        status, body, headers = stub.handle_send(phone_number_id, payload)
+        return jsonify(body), status, headers
+
+    @app.route("/_stub/messages", methods=["GET"])
+    def list_messages():
+        since = request.args.get("since", 0, type=int)
+        return jsonify(stub.received(to=request.args.get("to"), since=since)), 200
+
+    @app.route("/_stub/messages", methods=["DELETE"])
+    def reset_messages():
+        stub.reset()
+        return jsonify({"status": "reset"}), 200
+
+    @app.route("/_stub/stats", methods=["GET"])
+    def stats():
+        return jsonify({"counters": stub.counters, "faults": stub.faults}), 200
+
+    @app.route("/_stub/config", methods=["POST"])
+    def configure():
+        try:
+            return jsonify(stub.configure(**(request.get_json(silent=True) or {}))), 200
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    @app.route("/_stub/inbound", methods=["POST"])
+    def inbound():
+        """Body: {"from", "text" | "button_id" | "list_id" | "location"}"""
+        data = request.get_json(silent=True) or {}
+        if not data.get("from"):
+            return jsonify({"error": "from es requerido"}), 400
+
+        try:
+            wamid, status = stub.post_inbound(
+                data["from"],
+                text=data.get("text"),
+                button_id=data.get("button_id"),
+                list_id=data.get("list_id"),
+                location=data.get("location")
+            )
+        except (ValueError, requests.RequestException) as e:
+            return jsonify({"error": str(e)}), 502
+
+        return jsonify({"id": wamid, "webhook_status": status}), 200
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor local que imita la Graph API de WhatsApp")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5005)
+    parser.add_argument("--webhook-url", help="URL del webhook del backend (p. ej. http://localhost:5000/webhook)")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--max-rps", type=int)
+    parser.add_argument("--status-callbacks", action="store_true")
+    args = parser.parse_args()
+
+    stub = GraphStub(
+        webhook_url=args.webhook_url,
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        retry_after=args.retry_after,
+        max_rps=args.max_rps,
+        status_callbacks=args.status_callbacks
+    )
+
+    print(f"🧪 Graph API stub en http://{args.host}:{args.port}")
+    create_stub_app(stub).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+Generador de carga: simula miles de teléfonos recorriendo los flujos del bot.
+
+Cada usuario virtual se registra y luego recorre los flujos elegidos
+(trip_request, round_trip, parcel), enviando al webhook del backend los mismos
+payloads que envía Meta (texto, button_reply, list_reply, location). Las
+respuestas del bot llegan a un stub de la Graph API que corre en este mismo
+proceso (ver graph_stub.py), así que se mide la latencia real de cada paso:
+desde el POST al webhook hasta que sale la última respuesta del bot.
+
+Uso:
+    # backend apuntando al stub: WHATSAPP_API_BASE_URL = "http://127.0.0.1:5005"
+    python tools/loadgen.py --backend http://127.0.0.1:5000 --users 1000 --concurrency 200
+
+Requiere al menos un conductor registrado para los pasos de selección de
+conductor (parcel y round_trip).
+
+Reporte:
+- p50 / p99 / máximo por paso de cada flujo, y pasos sin respuesta (timeouts)
+- consultas SQL y mensajes salientes por mensaje (de /webhook/metrics)
+- llamadas a la Graph API por mensaje entrante (contadas en el stub)
+"""
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+from graph_stub import GraphStub, build_inbound_message, build_webhook, create_stub_app
+
+
+Step = namedtuple("Step", "name message replies")
+
+
+def text(name, body, replies=1):
+    return Step(name, {"text": body}, replies)
+
+
+def button(name, button_id, replies=1):
+    return Step(name, {"button_id": button_id}, replies)
+
+
+def list_reply(name, row_id, replies=1):
+    return Step(name, {"list_id": row_id}, replies)
+
+
+def location(name, address=None, replies=1):
+    """Ubicación compartida; sin address el bot pide la dirección en texto"""
+    return Step(name, {"location": {
+        "latitude": round(4.65 + random.uniform(-0.05, 0.05), 6),
+        "longitude": round(-74.08 + random.uniform(-0.05, 0.05), 6),
+        "name": None,
+        "address": address
+    }}, replies)
+
+
+# ============== GUIONES DE CONVERSACIÓN ==============
+# replies: cantidad de mensajes que el bot envía en ese paso (0 = no responde)
+
+def registration_script(phone):
+    return [
+        text("start", "hola"),
+        text("name", f"Usuario Carga {phone[-6:]}"),
+        text("email", f"load{phone}@example.com"),
+        text("dni", phone[-10:]),
+        button("confirm", "confirm_yes", replies=2),
+    ]
+
+
+def trip_request_script(phone):
+    return [
+        text("menu", "menu"),
+        button("start", "1"),
+        list_reply("trip_style", "2"),
+        location("pickup_location", address="Calle 100 #15-20, Bogotá"),
+        location("delivery_location", address="Carrera 7 #32-16, Bogotá"),
+        button("confirm_driver_selection", "confirm_no", replies=0),
+        text("notes", "skip"),
+        button("confirm", "confirm_yes", replies=2),
+    ]
+
+
+def round_trip_script(phone):
+    return [
+        text("menu", "menu"),
+        button("start", "2", replies=2),
+        # Ida: recogida (GPS sin dirección) y destino. RoundTrip admite
+        # exactamente 2 direcciones; la vuelta reutiliza las de ida
+        button("ida.select_type", "1"),
+        location("ida.input_location"),
+        text("ida.input_address_text", "Calle 80 #68-20, Bogotá"),
+        button("ida.confirm_location", "confirm_yes"),
+        button("ida.ask_add_more", "confirm_yes"),
+        button("ida.select_type", "2"),
+        location("ida.input_location", address="Aeropuerto El Dorado"),
+        button("ida.confirm_location", "confirm_yes"),
+        button("ida.save_locations", "confirm_no", replies=2),
+        button("process_return_choice", "confirm_yes", replies=2),
+        button("confirm_driver_selection", "confirm_no"),
+        text("notes", "skip"),
+        button("requires_wait", "confirm_yes"),
+        text("wait_time", "30"),
+        button("confirm", "confirm_yes", replies=2),
+    ]
+
+
+def parcel_script(phone):
+    return [
+        text("menu", "menu"),
+        button("more", "more"),
+        button("start", "3"),
+        text("title", "Documentos"),
+        text("description", "Sobre con documentos firmados"),
+        text("weight", "2.5"),
+        text("dimensions", "skip"),
+        location("pickup_location", address="Calle 26 #59-51, Bogotá"),
+        location("delivery_location", address="Carrera 15 #93-60, Bogotá"),
+        text("notes", "Frágil"),
+        button("select_driver", "confirm_yes"),
+        button("driver.choose_option", "2"),
+        text("driver.select_from_list", "1"),
+        button("driver.confirm_selection", "confirm_yes", replies=2),
+        button("summary", "confirm_yes"),
+        button("confirm", "confirm_yes", replies=2),
+    ]
+
+
+SCRIPTS = {
+    "registration": registration_script,
+    "trip_request": trip_request_script,
+    "round_trip": round_trip_script,
+    "parcel": parcel_script,
+}
+
+
+class Conversation:
+    """Respuestas recibidas por el stub para un teléfono"""
+
+    def __init__(self):
+        self.arrivals = []
+        self.condition = threading.Condition()
+
+    def add(self, received_at):
+        with self.condition:
+            self.arrivals.append(received_at)
+            self.condition.notify_all()
+
+    def wait_for(self, count, timeout):
+        """Espera hasta tener 'count' respuestas; devuelve la hora de la última o None"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.arrivals) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.arrivals[count - 1] if count else None
+
+    def __len__(self):
+        with self.condition:
+            return len(self.arrivals)
+
+
+class LoadGenerator:
+
+    def __init__(self, backend, flows, reply_timeout=30, think_time=0.0,
+                 phone_number_id="STUB_PHONE_ID"):
+        self.webhook_url = f"{backend.rstrip('/')}/webhook"
+        self.metrics_url = f"{backend.rstrip('/')}/webhook/metrics"
+        self.flows = flows
+        self.reply_timeout = reply_timeout
+        self.think_time = think_time
+        self.phone_number_id = phone_number_id
+
+        self.conversations = {}
+        self.latencies = defaultdict(list)
+        self.timeouts = defaultdict(int)
+        self.acks = []
+        self.errors = defaultdict(int)
+        self.sent = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def on_outbound(self, wamid, payload, received_at):
+        to = payload.get("to")
+        if to:
+            self.conversation(to).add(received_at)
+
+    def conversation(self, phone):
+        # setdefault es atómico: el stub y los usuarios virtuales corren en hilos distintos
+        return self.conversations.get(phone) or self.conversations.setdefault(phone, Conversation())
+
+    def run_user(self, phone):
+        for flow in ["registration"] + self.flows:
+            for step in SCRIPTS[flow](phone):
+                self.run_step(phone, flow, step)
+                if self.think_time:
+                    time.sleep(random.uniform(0, self.think_time * 2))
+
+    def run_step(self, phone, flow, step):
+        conversation = self.conversation(phone)
+        expected = len(conversation) + step.replies
+        message = build_inbound_message(phone, **step.message)
+        payload = build_webhook(self.phone_number_id, messages=[message])
+
+        started_at = time.time()
+        if not self._post(payload, (flow, step.name)):
+            return
+        ack = time.time() - started_at
+
+        with self._lock:
+            self.sent += 1
+            self.acks.append(ack)
+
+        if not step.replies:
+            return
+
+        last_reply = conversation.wait_for(expected, self.reply_timeout)
+        with self._lock:
+            if last_reply is None:
+                self.timeouts[(flow, step.name)] += 1
+            else:
+                self.latencies[(flow, step.name)].append(max(last_reply - started_at, 0.0))
+
+    def _post(self, payload, key):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+
+        # Igual que Meta: reintentar mientras el backend responda 503 (cola llena)
+        for attempt in range(5):
+            try:
+                response = session.post(self.webhook_url, json=payload, timeout=10)
+            except requests.RequestException:
+                with self._lock:
+                    self.errors[key] += 1
+                return False
+
+            if response.status_code != 503:
+                return response.status_code < 400
+
+            with self._lock:
+                self.errors["webhook_503"] += 1
+            time.sleep(min(2 ** attempt * 0.1, 2))
+
+        return False
+
+    def server_metrics(self):
+        try:
+            return requests.get(self.metrics_url, timeout=5).json()
+        except (requests.RequestException, ValueError):
+            return None
+
+
+def percentile(samples, percent):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[int(round((percent / 100) * (len(ordered) - 1)))]
+
+
+def print_report(generator, stub, elapsed, before, after):
+    print("\n📊 Latencia por paso (POST al webhook → última respuesta del bot)\n")
+    print(f"{'flujo':<14} {'paso':<28} {'n':>6} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'timeouts':>9}")
+
+    # Pasos en el orden de los guiones
+    steps = []
+    for flow, script in SCRIPTS.items():
+        for step in script("0" * 12):
+            key = (flow, step.name)
+            if key not in steps and (key in generator.latencies or key in generator.timeouts):
+                steps.append(key)
+    slowest = None
+    for key in steps:
+        samples = generator.latencies.get(key, [])
+        p99 = percentile(samples, 99) * 1000
+        print(
+            f"{key[0]:<14} {key[1]:<28} {len(samples):>6} "
+            f"{percentile(samples, 50) * 1000:>9.1f} {p99:>9.1f} "
+            f"{max(samples, default=0) * 1000:>9.1f} {generator.timeouts.get(key, 0):>9}"
+        )
+        if slowest is None or p99 > slowest[1]:
+            slowest = (key, p99)
+
+    print(f"\nMensajes enviados al webhook: {generator.sent} en {elapsed:.1f}s "
+          f"({generator.sent / elapsed if elapsed else 0:.1f} msg/s)")
+    print(f"ACK del webhook: p50 {percentile(generator.acks, 50) * 1000:.1f} ms, "
+          f"p99 {percentile(generator.acks, 99) * 1000:.1f} ms")
+    if generator.errors:
+        print(f"Errores: {dict(generator.errors)}")
+    if slowest:
+        print(f"Paso más lento (p99): {slowest[0][0]}.{slowest[0][1]} ({slowest[1]:.1f} ms)")
+
+    counters = stub.counters
+    if generator.sent:
+        print(f"\nLlamadas a la Graph API por mensaje: {counters['received'] / generator.sent:.2f} "
+              f"(aceptadas {counters['accepted']}, 429 {counters['throttled']}, 5xx {counters['errors']})")
+
+    if before and after:
+        processed = (after["counters"].get("messages_processed", 0)
+                     - before["counters"].get("messages_processed", 0))
+        print(f"Mensajes procesados por el backend: {processed} "
+              f"(fallidos {after['counters'].get('messages_failed', 0) - before['counters'].get('messages_failed', 0)})")
+        for name in ("db_queries_per_message", "db_commits_per_message", "outbound_per_message"):
+            distribution = after.get("distributions", {}).get(name)
+            if distribution:
+                print(f"{name}: avg {distribution['avg']}, p50 {distribution['p50']}, "
+                      f"p99 {distribution['p99']}, max {distribution['max']}")
+        for name in ("webhook_queue_wait", "webhook_processing", "outbox_queue_lag"):
+            timing = after.get("timings", {}).get(name)
+            if timing:
+                print(f"{name}: p50 {timing['p50_ms']} ms, p99 {timing['p99_ms']} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de carga de conversaciones de WhatsApp")
+    parser.add_argument("--backend", default="http://127.0.0.1:5000", help="URL base del backend")
+    parser.add_argument("--users", type=int, default=100, help="teléfonos simulados")
+    parser.add_argument("--concurrency", type=int, default=50, help="conversaciones simultáneas")
+    parser.add_argument("--flows", default="trip_request,round_trip,parcel",
+                        help="flujos después del registro, separados por coma")
+    parser.add_argument("--phone-prefix", default=None, help="prefijo de los teléfonos (default aleatorio)")
+    parser.add_argument("--reply-timeout", type=float, default=30)
+    parser.add_argument("--think-time", type=float, default=0.0, help="pausa media entre pasos (s)")
+    parser.add_argument("--stub-host", default="127.0.0.1")
+    parser.add_argument("--stub-port", type=int, default=5005)
+    parser.add_argument("--stub-latency-ms", type=float, default=0)
+    parser.add_argument("--stub-rate-429", type=float, default=0.0)
+    parser.add_argument("--stub-rate-5xx", type=float, default=0.0)
+    args = parser.parse_args()
+
+    flows = [flow.strip() for flow in args.flows.split(",") if flow.strip()]
+    unknown = [flow for flow in flows if flow not in SCRIPTS]
+    if unknown:
+        parser.error(f"Flujos desconocidos: {unknown}. Disponibles: {list(SCRIPTS)}")
+
+    generator = LoadGenerator(args.backend, flows, args.reply_timeout, args.think_time)
+    stub = GraphStub(
+        listener=generator.on_outbound,
+        latency_ms=args.stub_latency_ms,
+        rate_429=args.stub_rate_429,
+        rate_5xx=args.stub_rate_5xx
+    )
+    server = make_server(args.stub_host, args.stub_port, create_stub_app(stub), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"🧪 Graph API stub en http://{args.stub_host}:{args.stub_port}")
+
+    prefix = args.phone_prefix or f"57399{random.randint(0, 99):02d}"
+    phones = [f"{prefix}{index:06d}" for index in range(args.users)]
+
+    before = generator.server_metrics()
+    started_at = time.time()
+    print(f"🚀 {args.users} usuarios, {args.concurrency} simultáneos, flujos: registration + {flows}")
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(generator.run_user, phone) for phone in phones]:
+            future.result()
+
+    elapsed = time.time() - started_at
+    print_report(generator, stub, elapsed, before, generator.server_metrics())
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
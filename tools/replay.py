@@ -0,0 +1,254 @@
+"""
+Replay del registro de eventos de conversación (ver app/services/whatsapp/event_log.py).
+
+Vuelve a ejecutar los mensajes entrantes registrados (eventos "in") a través
+de los flujos del bot, contra una BD de pruebas y el stub local de la Graph API
+(graph_stub.py), y compara el resultado de cada mensaje con el registrado
+(estado final y cantidad de mensajes salientes).
+
+Sirve para:
+- medir un cambio en los flujos con el tráfico real de un día (mismo orden,
+  mismos remitentes y, con --speed, los mismos intervalos entre mensajes)
+- reproducir un incidente: --phone y --since/--until acotan la conversación
+
+La BD de --database debe ser una copia (p. ej. el backup del inicio del
+período a reproducir): el replay escribe en ella. Las conversaciones que ya
+estaban en curso solo se reproducen fielmente si la copia tiene su estado.
+
+Uso:
+    python tools/replay.py --log-dir /var/log/whatsapp-events --day 2026-10-17 \\
+        --database postgresql://localhost/transporte_replay
+
+Modos:
+- por defecto, los mensajes se procesan en orden en este hilo (determinista)
+- --concurrent: se encolan en el despachador por shards, como en producción
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from werkzeug.serving import make_server
+
+from graph_stub import GraphStub, create_stub_app
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+
+def parse_time(value):
+    return (datetime.fromisoformat(value) - datetime(1970, 1, 1)).total_seconds()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay del registro de eventos de WhatsApp")
+    parser.add_argument("--log-dir", required=True, help="Directorio de segmentos del registro")
+    parser.add_argument("--database", required=True, help="URI de la BD de pruebas (se modifica)")
+    parser.add_argument("--day", help="Día a reproducir (YYYY-MM-DD, UTC)")
+    parser.add_argument("--since", help="Desde (ISO, UTC)")
+    parser.add_argument("--until", help="Hasta (ISO, UTC)")
+    parser.add_argument("--phone", action="append", help="Reproducir solo estos remitentes")
+    parser.add_argument("--limit", type=int, help="Máximo de mensajes")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="Factor de tiempo real (1 = mismos intervalos, 0 = sin esperas)")
+    parser.add_argument("--concurrent", action="store_true", help="Procesar con el despachador por shards")
+    parser.add_argument("--stub-host", default="127.0.0.1")
+    parser.add_argument("--stub-port", type=int, default=5006)
+    parser.add_argument("--stub-latency-ms", type=float, default=0)
+    parser.add_argument("--show-divergences", type=int, default=20)
+    return parser.parse_args()
+
+
+def time_window(args):
+    since = parse_time(args.since) if args.since else None
+    until = parse_time(args.until) if args.until else None
+    if args.day:
+        since = parse_time(args.day)
+        until = since + timedelta(days=1).total_seconds()
+    return since, until
+
+
+def load_recording(args, read_events):
+    """(mensajes entrantes en orden, resultado registrado por wamid)"""
+    since, until = time_window(args)
+    phones = set(args.phone or [])
+
+    inbound = []
+    recorded = {}
+    for event in read_events(args.log_dir, since=since, until=until):
+        if phones and event.get("from") not in phones:
+            continue
+        if event["type"] == "in":
+            if args.limit and len(inbound) >= args.limit:
+                continue
+            inbound.append(event)
+        else:
+            recorded[event.get("id")] = event
+
+    return inbound, recorded
+
+
+def create_replay_app(args, stub_url):
+    from config import Config
+
+    class ReplayConfig(Config):
+        SQLALCHEMY_DATABASE_URI = args.database
+        WHATSAPP_API_BASE_URL = stub_url
+        WHATSAPP_EVENT_LOG_DIR = None
+        WHATSAPP_SESSION_SWEEP = False
+
+    from app import create_app
+    return create_app(ReplayConfig)
+
+
+def outcome(event):
+    """Lo comparable de un resultado: estado final y mensajes salientes"""
+    if event is None:
+        return None
+    if event["type"] == "error":
+        return ("error",)
+    return ("ok", tuple(event.get("end") or ()), len(event.get("out") or ()))
+
+
+class Replayer:
+    def __init__(self, app, inbound, recorded, speed=0, concurrent=False):
+        self.app = app
+        self.inbound = inbound
+        self.recorded = recorded
+        self.speed = speed
+        self.concurrent = concurrent
+        self.replayed = {}
+        self._lock = threading.Lock()
+
+    def on_event(self, event):
+        if event["type"] != "in":
+            with self._lock:
+                self.replayed[event.get("id")] = event
+
+    def run(self):
+        from app.services.whatsapp.event_log import conversation_log
+        from app.services.whatsapp.whatsapp_controller import process_messages
+        from app.services.whatsapp.worker import message_dispatcher
+
+        conversation_log.listener = self.on_event
+
+        started_at = time.monotonic()
+        first_ts = self.inbound[0]["ts"] if self.inbound else 0
+
+        with self.app.app_context():
+            for event in self.inbound:
+                if self.speed:
+                    delay = (event["ts"] - first_ts) / self.speed - (time.monotonic() - started_at)
+                    if delay > 0:
+                        time.sleep(delay)
+
+                message = (event["id"], event["from"], event.get("text"), event.get("loc"))
+                if not self.concurrent:
+                    process_messages([message])
+                    continue
+
+                # Igual que Meta: reintentar mientras el shard esté lleno
+                while not message_dispatcher.submit(message):
+                    time.sleep(0.05)
+
+        if self.concurrent:
+            message_dispatcher.join()
+
+        return time.monotonic() - started_at
+
+    def divergences(self):
+        diverged = []
+        for event in self.inbound:
+            expected = outcome(self.recorded.get(event["id"]))
+            actual = outcome(self.replayed.get(event["id"]))
+            if expected is not None and expected != actual:
+                diverged.append((event, expected, actual))
+        return diverged
+
+
+def wait_for_outbox(stub, timeout=30):
+    """Espera a que el outbox deje de enviar al stub"""
+    deadline = time.monotonic() + timeout
+    last = -1
+    while time.monotonic() < deadline:
+        current = stub.counters["received"]
+        if current == last:
+            return
+        last = current
+        time.sleep(1)
+
+
+def print_report(replayer, stub, elapsed, snapshot, show):
+    inbound = replayer.inbound
+    results = Counter(outcome(event)[0] for event in replayer.replayed.values())
+
+    print(f"\n📼 Mensajes reproducidos: {len(inbound)} en {elapsed:.1f}s "
+          f"({len(inbound) / elapsed if elapsed else 0:.1f} msg/s)")
+    print(f"   Resultados: {dict(results)}")
+    print(f"   Llamadas a la Graph API (stub): {dict(stub.counters)}")
+
+    timings = snapshot["timings"]
+    steps = sorted(
+        (name for name in timings if name.startswith("flow_step.")),
+        key=lambda name: timings[name]["p99_ms"],
+        reverse=True
+    )
+    if steps:
+        print("\n⏱️ Duración por paso (FlowEngine)\n")
+        print(f"{'paso':<52} {'n':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for name in steps:
+            t = timings[name]
+            print(f"{name[len('flow_step.'):]:<52} {t['count']:>7} {t['p50_ms']:>9.2f} {t['p99_ms']:>9.2f} {t['max_ms']:>9.2f}")
+
+    distributions = snapshot["distributions"]
+    for name in ("db_queries_per_message", "db_commits_per_message", "outbound_per_message"):
+        if name in distributions:
+            d = distributions[name]
+            print(f"{name}: avg {d['avg']} p99 {d['p99']} max {d['max']}")
+
+    diverged = replayer.divergences()
+    compared = sum(1 for event in inbound if event["id"] in replayer.recorded)
+    print(f"\n🔍 Divergencias con lo registrado: {len(diverged)} de {compared} mensajes comparables")
+
+    by_sender = defaultdict(int)
+    for event, _, _ in diverged:
+        by_sender[event["from"]] += 1
+    for event, expected, actual in diverged[:show]:
+        print(f"   {event['from']} {event['id']} texto={event.get('text')!r}: "
+              f"registrado={expected} replay={actual}")
+    if by_sender:
+        print(f"   Remitentes con divergencias: {len(by_sender)}")
+
+
+def main():
+    args = parse_args()
+
+    stub = GraphStub(latency_ms=args.stub_latency_ms)
+    server = make_server(args.stub_host, args.stub_port, create_stub_app(stub), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = f"http://{args.stub_host}:{args.stub_port}"
+    print(f"🧪 Graph API stub en {stub_url}")
+
+    app = create_replay_app(args, stub_url)
+
+    from app.services.whatsapp.event_log import read_events
+    from app.services.whatsapp.metrics import metrics
+
+    inbound, recorded = load_recording(args, read_events)
+    if not inbound:
+        print("No hay mensajes registrados en el período indicado")
+        return
+
+    print(f"📼 {len(inbound)} mensajes de {len({event['from'] for event in inbound})} remitentes")
+
+    replayer = Replayer(app, inbound, recorded, speed=args.speed, concurrent=args.concurrent)
+    elapsed = replayer.run()
+    wait_for_outbox(stub)
+
+    print_report(replayer, stub, elapsed, metrics.snapshot(), args.show_divergences)
+
+
+if __name__ == "__main__":
+    main()